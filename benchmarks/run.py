@@ -0,0 +1,291 @@
+"""
+This module times the routing engine and the data analysis steps on synthetic data, so a
+change can be checked for making things faster or slower.
+
+Each benchmark runs repeat times on a dataset from benchmarks/synthetic_data.py (10k, 100k or
+1M road nodes) and records the wall and CPU time of every run; one more run measures the peak
+memory it allocates with tracemalloc. The results are written as JSON, and can be compared
+with a saved baseline: benchmarks that got slower than the baseline by more than the
+tolerance are reported, and make the command exit with status 1.
+
+Run it from the root of the repository with:
+python -m benchmarks.run --size 100k --baseline benchmarks/baseline_100k.json
+(add --save-baseline to store the results as the new baseline)
+"""
+
+import argparse  # for the command line options
+import datetime  # for the time stamp of the results
+import json  # for the results
+import os  # for the file paths
+import platform  # for describing the machine
+import shutil  # for removing the csv cache
+import subprocess  # for the git commit
+import sys  # for the exit status
+import tempfile  # for the saved model
+import time  # for the timings
+import tracemalloc  # for the peak memory
+import joblib  # for saving the model
+import numpy as np  # for picking the queries
+import pandas as pd  # for the version
+from benchmarks.synthetic_data import write_dataset, make_features, STATE
+from codecare.data_analysis.create_mo_dataset import snap_hospitals, snapper_for
+from codecare.data_cache import read_csv_cached
+from codecare.risk_score_model import train_risk_model
+from codecare.risk_scoring import RiskScorer
+from codecare.routing_engine import (
+    read_data,
+    construct_graph,
+    construct_road_graph,
+    astar_shortest_path,
+    astar_many_nodes,
+)
+
+# The folder this script is in
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The dataset sizes, by name
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# Number of searches in the A* benchmarks and stops in the tour benchmark
+QUERIES = 50
+TOUR_STOPS = 10
+
+
+class Benchmark:
+    """
+    One timed step. setup runs before every run (untimed) and returns the arguments of run.
+    items is the number of things one run handles (queries, rows, ...), for the per item time.
+    """
+
+    def __init__(self, name, run, setup=None, items=1):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: ())
+        self.items = items
+
+
+def make_benchmarks(paths, seed=0, skip=()):
+    """
+    This function prepares the data every benchmark needs and returns the benchmarks for
+    the dataset at paths.
+    """
+    rng = np.random.default_rng(seed)
+    nodes, edges = read_data(paths["data"], paths["edges"])
+    road_graph = construct_road_graph(nodes, edges)
+    hospitals = read_csv_cached(paths["hospitals"])
+    road_nodes = read_csv_cached(paths["nodes"])
+    snapper = snapper_for(paths["nodes"], road_nodes)
+
+    # Searches between random hospitals, and a tour through a few of them
+    hospital_nodes = nodes.loc[nodes["hospital_name"].notna(), "# index"].to_numpy()
+    pairs = rng.choice(hospital_nodes, (QUERIES, 2))
+    stops = rng.choice(hospital_nodes, TOUR_STOPS, replace=False)
+    tour = list(zip(stops[:-1].tolist(), stops[1:].tolist()))
+
+    # A model trained on the synthetic hospitals, and as many rows to score as road nodes
+    model, *_ = train_risk_model(hospitals, STATE)
+    with tempfile.TemporaryDirectory(prefix="codecare_bench_") as model_dir:
+        model_path = os.path.join(model_dir, "model.joblib")
+        joblib.dump(model, model_path)
+        scorer = RiskScorer(model_path)
+    rows = make_features(len(road_nodes), seed)
+
+    def clear_cache():
+        for path in (paths["data"], paths["edges"]):
+            shutil.rmtree(
+                os.path.join(os.path.dirname(path), ".cache", os.path.basename(path)),
+                ignore_errors=True,
+            )
+        return ()
+
+    benchmarks = [
+        Benchmark(
+            "read_data_csv",
+            lambda: read_data(paths["data"], paths["edges"]),
+            setup=clear_cache,
+        ),
+        Benchmark("read_data_cached", lambda: read_data(paths["data"], paths["edges"])),
+        Benchmark("construct_graph", lambda: construct_graph(nodes, edges)),
+        Benchmark("construct_road_graph", lambda: construct_road_graph(nodes, edges)),
+        Benchmark(
+            "astar_shortest_path",
+            lambda: [astar_shortest_path(road_graph, s, t) for s, t in pairs.tolist()],
+            items=QUERIES,
+        ),
+        Benchmark(
+            "astar_many_nodes",
+            lambda: astar_many_nodes(road_graph, tour),
+            items=len(tour),
+        ),
+        Benchmark(
+            "snap_hospitals",
+            lambda: snap_hospitals(hospitals, road_nodes, STATE, snapper=snapper),
+            items=len(hospitals),
+        ),
+        Benchmark(
+            "snap_hospitals_new_index",
+            lambda: snap_hospitals(hospitals, road_nodes, STATE),
+            items=len(hospitals),
+        ),
+        Benchmark("risk_scoring", lambda: scorer.score(rows), items=len(rows)),
+    ]
+    return [benchmark for benchmark in benchmarks if benchmark.name not in skip]
+
+
+def run_benchmark(benchmark, repeat=3, memory=True):
+    """
+    This function runs one benchmark and returns its timings (and peak memory).
+    """
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        args = benchmark.setup()
+        started_wall = time.perf_counter()
+        started_cpu = time.process_time()
+        benchmark.run(*args)
+        wall.append(time.perf_counter() - started_wall)
+        cpu.append(time.process_time() - started_cpu)
+
+    result = {
+        "seconds": float(np.median(wall)),
+        "min_seconds": min(wall),
+        "cpu_seconds": float(np.median(cpu)),
+        "runs": wall,
+        "items": benchmark.items,
+        "seconds_per_item": float(np.median(wall)) / benchmark.items,
+    }
+
+    if memory:
+        args = benchmark.setup()
+        tracemalloc.start()
+        try:
+            benchmark.run(*args)
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def run_all(size="10k", seed=0, repeat=3, memory=True, skip=(), data_dir=None):
+    """
+    This function runs every benchmark on the dataset of the given size and returns the
+    results with a description of the run.
+    """
+    num_nodes = SIZES[size]
+    paths = write_dataset(
+        data_dir or os.path.join(HERE, "data", size), num_nodes, seed
+    )
+
+    results = {}
+    for benchmark in make_benchmarks(paths, seed, skip):
+        results[benchmark.name] = run_benchmark(benchmark, repeat, memory)
+        print(
+            f"{benchmark.name:24s} {results[benchmark.name]['seconds']:9.4f} s"
+            + (
+                f" {results[benchmark.name]['peak_mb']:9.1f} MB"
+                if memory
+                else ""
+            )
+        )
+
+    return {
+        "meta": {
+            "size": size,
+            "nodes": num_nodes,
+            "seed": seed,
+            "repeat": repeat,
+            "commit": _git_commit(),
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "benchmarks": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    This function compares the results with a baseline and returns one row per benchmark
+    in both: (name, baseline seconds, seconds, ratio, "slower", "faster" or "same"). A
+    benchmark is slower or faster if its time changed by more than tolerance (0.2 = 20%).
+    """
+    if results["meta"]["size"] != baseline["meta"]["size"]:
+        raise ValueError(
+            f"The baseline is for size {baseline['meta']['size']}, "
+            f"not {results['meta']['size']}"
+        )
+
+    rows = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        before = baseline["benchmarks"][name]["seconds"]
+        ratio = result["seconds"] / before if before > 0 else float("inf")
+        if ratio > 1 + tolerance:
+            status = "slower"
+        elif ratio < 1 / (1 + tolerance):
+            status = "faster"
+        else:
+            status = "same"
+        rows.append((name, before, result["seconds"], ratio, status))
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CodeCare on synthetic data.")
+    parser.add_argument("--size", choices=list(SIZES), default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="don't measure the peak memory"
+    )
+    parser.add_argument(
+        "--skip", nargs="*", default=[], help="benchmarks to leave out (e.g. construct_graph)"
+    )
+    parser.add_argument("--output", default=None, help="where to write the results")
+    parser.add_argument("--baseline", default=None, help="results to compare with")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="write the results to --baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_all(args.size, args.seed, args.repeat, not args.no_memory, args.skip)
+
+    output = args.output or os.path.join(HERE, "results", f"latest_{args.size}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = False
+        for name, before, after, ratio, status in compare(
+            results, baseline, args.tolerance
+        ):
+            print(f"{name:24s} {before:9.4f} s -> {after:9.4f} s  x{ratio:5.2f}  {status}")
+            slower = slower or status == "slower"
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,203 @@
+"""
+This module makes synthetic road networks and hospital data of any size for the benchmarks,
+with the same files and columns as the real data:
+
+    <name>_nodes.csv      road nodes: "# index", "latitude", "longitude"
+    <name>_edges.csv      road edges: "# source", " target", " distance" (in meters)
+    <name>_hospitals.csv  cleaned hospital data (like codecare_data.csv): "state", "latitude",
+                          "longitude", the model features, "risk_score", "risk_class", ...
+    <name>_data.csv       the road nodes with the risk of the hospitals snapped to them (like
+                          mo_data.csv), which is what read_data reads
+
+The road network is a jittered grid (like a city map) with a few diagonal shortcuts, with the
+node ids spread out like OpenStreetMap ids. Everything comes from one seed, so the same size
+and seed always give the same files.
+
+Run it from the root of the repository with:
+python -m benchmarks.synthetic_data --nodes 100000 --output benchmarks/data/100k
+"""
+
+import argparse  # for the command line options
+import json  # for the description of the generated files
+import os  # for the file paths
+import numpy as np  # for generating the data
+import pandas as pd  # for writing the csv files
+from codecare.risk_score_model import X_VARS
+from codecare.data_analysis.create_mo_dataset import snap_hospitals, snapper_for
+from codecare.data_analysis.process_risk_nodes import merge_risk_nodes
+
+# Bumped whenever the generated data changes, so old files are made again
+GENERATOR_VERSION = 1
+
+# The corner of the grid and the distance between neighbouring nodes (in degrees)
+ORIGIN = (36.5, -95.5)
+SPACING = 0.002
+
+# One hospital for this many road nodes (and at least MIN_HOSPITALS)
+NODES_PER_HOSPITAL = 200
+MIN_HOSPITALS = 50
+
+# Share of the hospitals in the state the benchmarks route in
+STATE = "MO"
+STATE_SHARE = 0.5
+
+
+def make_road_network(num_nodes, seed=0):
+    """
+    This function returns the (nodes, edges) DataFrames of a road network with num_nodes
+    nodes. Every node is connected to the others.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_nodes)))
+    row, column = np.divmod(np.arange(num_nodes), side)
+
+    node_ids = np.arange(num_nodes, dtype=np.int64) * 37 + 1_000_003
+    latitude = ORIGIN[0] + row * SPACING + rng.normal(0, SPACING / 5, num_nodes)
+    longitude = ORIGIN[1] + column * SPACING + rng.normal(0, SPACING / 5, num_nodes)
+
+    # Every row is one street; the first column and 90% of the other column links are cross
+    # streets, so the network stays connected
+    index = np.arange(num_nodes)
+    right = index[(column < side - 1) & (index + 1 < num_nodes)]
+    down = index[index + side < num_nodes]
+    down = down[(column[down] == 0) | (rng.random(len(down)) < 0.9)]
+    diagonal = index[(column < side - 1) & (index + side + 1 < num_nodes)]
+    diagonal = diagonal[rng.random(len(diagonal)) < 0.05]
+
+    source = np.concatenate([right, down, diagonal])
+    target = np.concatenate([right + 1, down + side, diagonal + side + 1])
+
+    # Road distance is the straight line distance times a detour factor
+    distance = _haversine_m(
+        latitude[source], longitude[source], latitude[target], longitude[target]
+    ) * rng.uniform(1.0, 1.4, len(source))
+
+    nodes = pd.DataFrame(
+        {"# index": node_ids, "latitude": latitude, "longitude": longitude}
+    )
+    edges = pd.DataFrame(
+        {
+            "# source": node_ids[source],
+            " target": node_ids[target],
+            " distance": np.round(distance, 2),
+        }
+    )
+    return nodes, edges
+
+
+def make_hospitals(nodes, count, seed=0):
+    """
+    This function returns cleaned hospital data for count hospitals, each a little away
+    from a road node, in STATE and another state.
+    """
+    rng = np.random.default_rng(seed + 1)
+    at = rng.choice(len(nodes), count, replace=False)
+
+    hospitals = pd.DataFrame(
+        {
+            "date": "2021/01/01",
+            "state": np.where(rng.random(count) < STATE_SHARE, STATE, "KS"),
+            "hospital_name": [f"HOSPITAL {i}" for i in range(count)],
+            "address": [f"{i} MAIN STREET" for i in range(count)],
+            "city": rng.choice(["SPRINGFIELD", "COLUMBIA", "JOPLIN", "ROLLA"], count),
+            "hospital_subtype": rng.choice(
+                ["Short Term", "Critical Access Hospitals"], count
+            ),
+            "latitude": nodes["latitude"].to_numpy()[at] + rng.normal(0, 1e-4, count),
+            "longitude": nodes["longitude"].to_numpy()[at] + rng.normal(0, 1e-4, count),
+        }
+    )
+
+    features = make_features(count, seed)
+    for name in X_VARS:
+        hospitals[name] = features[name]
+
+    # The risk score depends on the features, so the model has something to learn
+    risk = features[X_VARS[0]] / (features[X_VARS[3]] / 7 + 1)
+    risk = (risk - risk.min()) / (risk.max() - risk.min())
+    hospitals["risk_score"] = risk
+    hospitals["risk_class"] = np.searchsorted([0.25, 0.5, 0.75], risk, side="left") + 1
+    return hospitals
+
+
+def make_features(rows, seed=0):
+    """
+    This function returns rows rows of the model features (X_VARS).
+    """
+    rng = np.random.default_rng(seed + 2)
+    beds = rng.gamma(2.0, 60.0, rows) + 10
+    used = beds * rng.uniform(0.2, 1.0, rows)
+    return pd.DataFrame(
+        {
+            "inpatient_beds_used_7_day_avg": used,
+            "a_adult_hospinpbed_occ_7d_avg": used * 0.8,
+            "hospconf_flucovid_7d_cov": rng.integers(0, 8, rows).astype(np.float64),
+            "total_beds_7_day_sum": beds * 7,
+            "a_adult_hospbeds_7d_sum": beds * 7 * 0.85,
+            "total_beds_7_day_avg": beds,
+            "a_adult_hospbeds_7d_avg": beds * 0.85,
+            "a_adult_hospbeds_7d_cov": rng.integers(5, 8, rows).astype(np.float64),
+            "total_beds_7_day_coverage": rng.integers(5, 8, rows).astype(np.float64),
+        }
+    )
+
+
+def write_dataset(directory, num_nodes, seed=0, name="bench"):
+    """
+    This function writes the four csv files of a dataset with num_nodes road nodes to
+    directory and returns their paths. Files made earlier with the same size and seed are
+    kept as they are.
+    """
+    paths = {
+        kind: os.path.join(directory, f"{name}_{kind}.csv")
+        for kind in ("nodes", "edges", "hospitals", "data")
+    }
+    description = {"version": GENERATOR_VERSION, "nodes": num_nodes, "seed": seed}
+    description_path = os.path.join(directory, f"{name}.json")
+
+    try:
+        with open(description_path) as f:
+            if json.load(f) == description and all(map(os.path.exists, paths.values())):
+                return paths
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    nodes, edges = make_road_network(num_nodes, seed)
+    hospitals = make_hospitals(
+        nodes, max(MIN_HOSPITALS, num_nodes // NODES_PER_HOSPITAL), seed
+    )
+
+    nodes.to_csv(paths["nodes"], index=False)
+    edges.to_csv(paths["edges"], index=False)
+    hospitals.to_csv(paths["hospitals"], index=False)
+
+    # The same steps as the data analysis scripts make mo_data.csv
+    # (the node index is saved next to the nodes file, where the benchmarks load it from)
+    snapper = snapper_for(paths["nodes"], nodes)
+    nodes_with_risk = snap_hospitals(hospitals, nodes, STATE, snapper=snapper)
+    merge_risk_nodes(nodes_with_risk, nodes).to_csv(paths["data"])
+
+    with open(description_path, "w") as f:
+        json.dump(description, f)
+    return paths
+
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(a)) * 6_371_000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make a synthetic CodeCare dataset.")
+    parser.add_argument("--nodes", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join("benchmarks", "data", "custom"))
+    args = parser.parse_args()
+
+    for kind, path in write_dataset(args.output, args.nodes, args.seed).items():
+        print(f"{kind}: {path}")
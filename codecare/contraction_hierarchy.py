@@ -0,0 +1,519 @@
+"""
+This module builds a contraction hierarchy (CH) over the road graph for very fast route queries.
+
+The preprocessing contracts the nodes from least to most important, in rounds, and adds a
+shortcut edge between two neighbors whenever the contracted node was on their only shortest
+path. A query then only has to search "upward" (towards more important nodes) from both ends,
+which touches a few hundred nodes instead of a large part of the state. The hierarchy is built
+once offline and saved to disk, keyed by a hash of the edges file it was built from.
+
+Measured on the synthetic benchmark graphs (one CPU, default settings, medians over random
+pairs):
+
+- 10k nodes / 19,323 edges: 12 s to build, 43,412 shortcuts, no core; 3.7 ms per query
+  against 11.9 ms for astar_shortest_path.
+- 100k nodes / 194,334 edges: 208 s to build, 489,634 shortcuts, a core of 777 nodes;
+  42 ms per query against 101 ms for astar_shortest_path.
+
+That is well short of the sub-millisecond queries a CH gives on real road networks: the
+benchmark graphs are jittered grids without a road hierarchy (the worst case for a CH, hence
+the shortcut counts), and the query runs in plain Python. The degree cap keeps the build from
+blowing up on such graphs at the cost of a core that queries have to search in full.
+"""
+
+import heapq  # priority queue for the searches
+import math  # for inf
+import os  # for building the file paths
+import numpy as np  # for the arrays
+import networkx as nx  # for the same exceptions as the A* search
+from codecare.road_graph import RoadGraph
+from codecare.data_cache import file_digest  # for keying the saved hierarchy by the edges file
+
+# Bumped whenever the on-disk layout changes
+FORMAT_VERSION = 1
+
+
+class ContractionHierarchy:
+    """
+    The upward search graph of a contraction hierarchy, stored as CSR arrays.
+
+    Row i holds the edges from node index i to the more important nodes it is connected to
+    (original edges and shortcuts); the core_size most important nodes (the core, which was
+    not contracted) hold all their edges to each other instead. up_middle is the node a
+    shortcut skips over, or -1 for an original road edge, which is what lets a query unpack
+    shortcuts back into the road path.
+    """
+
+    def __init__(
+        self,
+        weight,
+        node_ids,
+        rank,
+        up_offsets,
+        up_targets,
+        up_weights,
+        up_middle,
+        core_size=0,
+    ):
+        self.weight = weight
+        self.node_ids = node_ids
+        self.rank = rank
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_weights = up_weights
+        self.up_middle = up_middle
+        self.core_size = core_size
+
+        # memoryviews give back plain Python numbers, which is much faster in a loop than numpy scalars
+        self._views = None
+
+    @classmethod
+    def build(
+        cls,
+        G: RoadGraph,
+        weight=" travel_time",
+        max_degree=32,
+        witness_hops=5,
+        chunk_size=50_000,
+    ):
+        """
+        This function contracts the nodes of the graph and returns the hierarchy.
+
+        The nodes are contracted in rounds: every round takes the nodes whose priority is
+        lower than that of all their neighbors (so no two of them are adjacent) and contracts
+        them at once, with NumPy operations on the table of remaining edges instead of one
+        search per node. Nodes with more than max_degree remaining edges are not contracted;
+        whatever is left when no node can be contracted any more is the core, which queries
+        search like a plain bidirectional Dijkstra. chunk_size caps how many nodes the
+        priorities are computed for at once (and so the memory used).
+        """
+        n = G.num_nodes
+        weights = np.asarray(G.weights(weight), dtype=np.float64)
+        sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(G.offsets))
+        targets = G.targets.astype(np.int64)
+        loop = sources == targets
+        sources, targets, weights = sources[~loop], targets[~loop], weights[~loop]
+        graph = _RemainingGraph(
+            n,
+            np.concatenate([sources, targets]),
+            np.concatenate([targets, sources]),
+            np.concatenate([weights, weights]),
+            np.full(2 * len(sources), -1, dtype=np.int64),
+        )
+
+        # The priority is the edge difference plus the number of contracted neighbors and the
+        # node's depth in the hierarchy, so the contraction spreads out evenly over the graph.
+        # The edge difference of a node whose neighbors were contracted is out of date
+        # (stale) until the node comes up for contraction again
+        edge_difference = np.zeros(n, dtype=np.int64)
+        contracted_neighbors = np.zeros(n, dtype=np.int64)
+        depth = np.zeros(n, dtype=np.int64)
+        stale = np.zeros(n, dtype=bool)
+
+        def update_edge_difference(nodes):
+            for start in range(0, len(nodes), chunk_size):
+                chunk = nodes[start : start + chunk_size]
+                middle, _, _, _ = graph.shortcuts(chunk, hops=witness_hops)
+                shortcuts = np.bincount(middle, minlength=n)[chunk]
+                edge_difference[chunk] = 2 * shortcuts - graph.degree[chunk]
+            stale[nodes] = False
+
+        update_edge_difference(np.arange(n))
+
+        # Random tie breaking, so equal priorities don't block each other
+        tiebreak = np.random.default_rng(0).permutation(n)
+        blocked = np.iinfo(np.int64).max
+
+        def first_nearby(eligible):
+            # The eligible nodes with the lowest priority of all nodes up to two edges away
+            priority = edge_difference + contracted_neighbors + depth
+            key = np.where(eligible, priority * n + tiebreak, blocked)
+            nearby_key = key.copy()
+            for _ in range(2):
+                spread = nearby_key.copy()
+                np.minimum.at(spread, graph.sources, nearby_key[graph.targets])
+                nearby_key = spread
+            return eligible & (key == nearby_key)
+
+        rank = np.empty(n, dtype=np.int32)
+        remaining = np.ones(n, dtype=bool)
+        up_edges = []
+        next_rank = 0
+
+        while True:
+            eligible = remaining & (graph.degree <= max_degree)
+            if not eligible.any():
+                break
+
+            # The nodes that come before all nodes up to two edges away are contracted this
+            # round, once their priority is up to date
+            contracted = first_nearby(eligible)
+            update_edge_difference(np.flatnonzero(contracted & stale))
+            contracted = first_nearby(eligible)
+            nodes = np.flatnonzero(contracted & ~stale)
+            contracted[:] = False
+            contracted[nodes] = True
+
+            # A witness may not pass through any node of this round, as they all go at once
+            middle, u, x, w = graph.shortcuts(nodes, avoid=contracted, hops=witness_hops)
+
+            # Everything still connected to the nodes is contracted later: their upward edges
+            outgoing = contracted[graph.sources]
+            up_edges.append(graph.edges(outgoing))
+            rank[nodes] = np.arange(next_rank, next_rank + len(nodes))
+            next_rank += len(nodes)
+            remaining[nodes] = False
+
+            neighbors = graph.targets[outgoing]
+            np.add.at(contracted_neighbors, neighbors, 1)
+            np.maximum.at(depth, neighbors, depth[graph.sources[outgoing]] + 1)
+
+            keep = ~outgoing & ~contracted[graph.targets]
+            kept = graph.edges(keep)
+            graph = _RemainingGraph(
+                n,
+                np.concatenate([kept[0], u, x]),
+                np.concatenate([kept[1], x, u]),
+                np.concatenate([kept[2], w, w]),
+                np.concatenate([kept[3], middle, middle]),
+            )
+            stale[neighbors] = True
+
+        # The core keeps all its edges, both ways
+        core = np.flatnonzero(remaining)
+        rank[core] = np.arange(next_rank, next_rank + len(core))
+        up_edges.append(graph.edges(np.ones(len(graph.sources), dtype=bool)))
+
+        up_sources, up_targets, up_weights, up_middle = (
+            np.concatenate(column) for column in zip(*up_edges)
+        )
+        order = np.argsort(up_sources, kind="stable")
+        up_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(up_sources, minlength=n), out=up_offsets[1:])
+
+        return cls(
+            weight=G.weight_key(weight),
+            node_ids=np.array(G.node_ids, dtype=np.int64),
+            rank=rank,
+            up_offsets=up_offsets,
+            up_targets=up_targets[order].astype(np.int32),
+            up_weights=up_weights[order],
+            up_middle=up_middle[order].astype(np.int32),
+            core_size=len(core),
+        )
+
+    def save(self, path):
+        """
+        This function writes the hierarchy to a single .npz file.
+        """
+        np.savez(
+            path,
+            format_version=FORMAT_VERSION,
+            weight=self.weight,
+            node_ids=self.node_ids,
+            rank=self.rank,
+            up_offsets=self.up_offsets,
+            up_targets=self.up_targets,
+            up_weights=self.up_weights,
+            up_middle=self.up_middle,
+            core_size=self.core_size,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        This function loads a hierarchy written by save().
+        """
+        with np.load(path) as data:
+            if int(data["format_version"]) != FORMAT_VERSION:
+                raise ValueError(f"Unsupported hierarchy format in {path}")
+            return cls(
+                weight=str(data["weight"]),
+                node_ids=data["node_ids"],
+                rank=data["rank"],
+                up_offsets=data["up_offsets"],
+                up_targets=data["up_targets"],
+                up_weights=data["up_weights"],
+                up_middle=data["up_middle"],
+                core_size=int(data["core_size"]) if "core_size" in data.files else 0,
+            )
+
+    @property
+    def num_shortcuts(self):
+        return int(np.count_nonzero(self.up_middle >= 0))
+
+    def index_of(self, node):
+        i = int(np.searchsorted(self.node_ids, node))
+        if i >= len(self.node_ids) or self.node_ids[i] != node:
+            raise KeyError(node)
+        return i
+
+    def views(self):
+        if self._views is None:
+            self._views = (
+                memoryview(self.rank),
+                memoryview(self.up_offsets),
+                memoryview(self.up_targets),
+                memoryview(self.up_weights),
+                memoryview(self.up_middle),
+            )
+        return self._views
+
+
+def contraction_hierarchy_for(
+    G: RoadGraph, edges_path, weight=" travel_time", cache_dir=None
+):
+    """
+    This function loads the hierarchy for an edges file from disk, building and saving it
+    first if there is none yet. The file name carries a hash of the edges file, so a changed
+    edges file gets a new hierarchy instead of a stale one.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(edges_path))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    path = os.path.join(
+        cache_dir, f"ch_{G.weight_key(weight)}_{file_digest(edges_path)[:16]}.npz"
+    )
+    if os.path.exists(path):
+        return ContractionHierarchy.load(path)
+
+    ch = ContractionHierarchy.build(G, weight)
+    ch.save(path)
+
+    return ch
+
+
+def ch_shortest_path(CH: ContractionHierarchy, start_node, end_node, weight=" travel_time"):
+    """
+    This function answers a route query on the hierarchy, with the same (path, total cost)
+    result as astar_shortest_path. Both searches only follow upward edges and the shortcuts
+    on the best path are unpacked back into road nodes at the end.
+    """
+    if RoadGraph.weight_key(weight) != CH.weight:
+        raise ValueError(f"This hierarchy was built for {CH.weight!r}, not {weight!r}")
+
+    try:
+        start = CH.index_of(start_node)
+        end = CH.index_of(end_node)
+    except KeyError as e:
+        raise nx.NodeNotFound(f"Node {e.args[0]} is not in the graph") from None
+
+    rank, offsets, targets, weights, middle = CH.views()
+
+    # Index 0 is the search from the start, index 1 the one from the end
+    dist = ({start: 0.0}, {end: 0.0})
+    parent = ({start: -1}, {end: -1})
+    queues = ([(0.0, start)], [(0.0, end)])
+
+    best = math.inf
+    meeting = -1
+
+    while queues[0] or queues[1]:
+        # A side is done once nothing in its queue can still beat the best path
+        for queue in queues:
+            if queue and queue[0][0] >= best:
+                queue.clear()
+        if not queues[0] and not queues[1]:
+            break
+
+        if queues[0] and (not queues[1] or queues[0][0][0] <= queues[1][0][0]):
+            side = 0
+        else:
+            side = 1
+
+        cost, u = heapq.heappop(queues[side])
+        my_dist, other_dist = dist[side], dist[1 - side]
+        if cost > my_dist[u]:
+            continue
+
+        if u in other_dist and cost + other_dist[u] < best:
+            best = cost + other_dist[u]
+            meeting = u
+
+        # Stall-on-demand: the graph is undirected, so u's upward edges also lead down into u.
+        # If a more important node already reaches u cheaper that way, u can't be on a
+        # shortest up-down path and its edges don't need relaxing
+        edges = range(offsets[u], offsets[u + 1])
+        if any(my_dist.get(targets[e], math.inf) + weights[e] < cost for e in edges):
+            continue
+
+        for e in edges:
+            v = targets[e]
+            new_cost = cost + weights[e]
+            if new_cost < my_dist.get(v, math.inf):
+                my_dist[v] = new_cost
+                parent[side][v] = u
+                heapq.heappush(queues[side], (new_cost, v))
+
+    if meeting == -1:
+        raise nx.NetworkXNoPath(f"Node {end_node} not reachable from {start_node}")
+
+    # The upward path from the start to the meeting node, then down to the end
+    hierarchy_path = []
+    i = meeting
+    while i != -1:
+        hierarchy_path.append(i)
+        i = parent[0][i]
+    hierarchy_path.reverse()
+    i = parent[1][meeting]
+    while i != -1:
+        hierarchy_path.append(i)
+        i = parent[1][i]
+
+    # Unpack every shortcut into the two edges it stands for, until only road edges are left
+    path = [hierarchy_path[0]]
+    for a, b in zip(hierarchy_path[:-1], hierarchy_path[1:]):
+        stack = [(a, b)]
+        while stack:
+            u, v = stack.pop()
+            low, high = (u, v) if rank[u] < rank[v] else (v, u)
+            m = -1
+            for e in range(offsets[low], offsets[low + 1]):
+                if targets[e] == high:
+                    m = middle[e]
+                    break
+            if m == -1:
+                path.append(v)
+            else:
+                stack.append((m, v))
+                stack.append((u, m))
+
+    return CH.node_ids[path].tolist(), best
+
+
+class _RemainingGraph:
+    """
+    The not yet contracted part of the graph during build(), as a table of directed edges
+    (both directions of every edge, the cheapest one of parallel edges) sorted by source.
+    middle is the node a shortcut skips over, or -1.
+    """
+
+    def __init__(self, n, sources, targets, weights, middle):
+        self.n = n
+        key = sources * n + targets
+        order = np.lexsort((weights, key))
+        key = key[order]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        order = order[first]
+
+        self.key = key[first]
+        self.sources = sources[order]
+        self.targets = targets[order]
+        self.weights = weights[order]
+        self.middle = middle[order]
+        self.offsets = np.searchsorted(self.sources, np.arange(n + 1))
+        self.degree = np.diff(self.offsets)
+
+    def edges(self, mask):
+        return self.sources[mask], self.targets[mask], self.weights[mask], self.middle[mask]
+
+    def shortcuts(self, nodes, avoid=None, hops=5):
+        """
+        This function returns the (middle, u, x, weight) arrays of the shortcuts contracting
+        the nodes would need: one for every pair of neighbors u, x of a node whose path
+        through the node is shorter than any witness path of up to hops edges around it.
+        Witnesses don't pass through the node itself or, if given, any node in avoid.
+        """
+        # Every pair of edges (v, u), (v, x) of the same node, u before x
+        starts = self.offsets[nodes]
+        first = _ranges(starts, self.degree[nodes])
+        after = np.repeat(starts + self.degree[nodes], self.degree[nodes]) - first - 1
+        second = _ranges(first + 1, after)
+        first = np.repeat(first, after)
+
+        middle = self.sources[first]
+        u, x = self.targets[first], self.targets[second]
+        through = self.weights[first] + self.weights[second]
+
+        # One witness search from u for all pairs of the edge (v, u), as far as the longest
+        searches, search_of = np.unique(first, return_inverse=True)
+        limits = np.zeros(len(searches))
+        np.maximum.at(limits, search_of, through)
+        keys, distances = self.witness_search(searches, limits, avoid, hops)
+
+        needed = _lookup(keys, distances, search_of * self.n + x) > through
+        return middle[needed], u[needed], x[needed], through[needed]
+
+    def witness_search(self, searches, limits, avoid, hops):
+        """
+        This function runs one search from the target u of every edge (v, u) in searches at
+        once, hop by hop, that doesn't pass through v (or the nodes in avoid) and stops at the
+        search's limit. It returns the sorted search * n + node keys of the nodes reached and
+        their distances.
+        """
+        n = self.n
+        skip = self.sources[searches]
+        search = np.arange(len(searches), dtype=np.int64)
+        node = self.targets[searches]
+        distance = np.zeros(len(searches))
+        keys, distances = search * n + node, distance
+
+        for _ in range(hops):
+            # Every edge out of the nodes reached in the last hop
+            degree = self.degree[node]
+            edges = _ranges(self.offsets[node], degree)
+            search = np.repeat(search, degree)
+            distance = np.repeat(distance, degree) + self.weights[edges]
+            node = self.targets[edges]
+
+            usable = (node != skip[search]) & (distance <= limits[search])
+            if avoid is not None:
+                usable &= ~avoid[node]
+            key, distance = _shortest(search[usable] * n + node[usable], distance[usable])
+
+            # Only the nodes reached on a shorter path than before go on
+            position = np.searchsorted(keys, key)
+            found = np.minimum(position, len(keys) - 1)
+            known = keys[found] == key
+            better = ~known | (distance < distances[found])
+            key, distance, position, known = (
+                key[better],
+                distance[better],
+                position[better],
+                known[better],
+            )
+            if not len(key):
+                break
+            distances[position[known]] = distance[known]
+            keys = np.insert(keys, position[~known], key[~known])
+            distances = np.insert(distances, position[~known], distance[~known])
+            search, node = np.divmod(key, n)
+
+        return keys, distances
+
+
+def _shortest(keys, values):
+    """
+    This function returns the distinct keys, sorted, with the smallest value of each.
+    """
+    if not len(keys):
+        return keys, values
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return keys[first], np.minimum.reduceat(values, np.flatnonzero(first))
+
+
+def _lookup(keys, values, query):
+    """
+    This function returns the values of the query keys in the sorted keys, inf for the
+    ones that aren't there.
+    """
+    if not len(keys):
+        return np.full(len(query), np.inf)
+    position = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[position] == query, values[position], np.inf)
+
+
+def _ranges(starts, lengths):
+    """
+    This function returns the concatenation of range(start, start + length) for every
+    start and length, as one array.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    skip = np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    return np.arange(total, dtype=np.int64) - skip
@@ -0,0 +1,213 @@
+"""
+This module finds which hospitals can be reached from candidate depots (where a mobile clinic
+could be based) within a travel time, and picks the depots that cover the most risk.
+
+Instead of one A* per depot and hospital, every depot gets one one-to-all search that stops at
+the travel time limit (scipy's Dijkstra with a limit, through travel_time_matrix), and the
+depots are searched in batches, in parallel worker processes if asked. The result is a sparse
+coverage matrix: one row per depot, one column per hospital, with the travel time stored only
+where the hospital is within the limit. The depots are then picked greedily: each next depot is
+the one that covers the most risk score not covered yet (with lazy re-evaluation, since what a
+depot adds can only go down as others are picked).
+
+Run it from the root of the repository with:
+python -m codecare.coverage --hours 1 --depots 5 --candidates 500
+"""
+
+import argparse  # for the command line options
+import heapq  # for the lazy greedy selection
+import os  # for the data paths
+import numpy as np  # for the coverage arrays
+import pandas as pd  # for the depot table
+from scipy.sparse import csr_matrix  # for the coverage matrix
+from codecare import instrumentation  # stage timers
+from codecare.routing_engine import (
+    load_state_graph,
+    travel_time_matrix,
+    as_road_graph,
+    graph_worker_pool,
+    worker_graph,
+)
+
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+
+def hospital_targets(nodes, min_risk_class=4):
+    """
+    This function returns the hospitals (one row per road node) with a risk class of at
+    least min_risk_class, from the node data read by read_data (or the hospitals of a
+    graph's attributes, G.attributes.hospitals()).
+    """
+    hospitals = nodes[nodes["hospital_name"].notna()]
+    hospitals = hospitals[hospitals["risk_class"] >= min_risk_class]
+    return hospitals.drop_duplicates(subset="# index")[
+        ["# index", "hospital_name", "risk_score", "risk_class"]
+    ].reset_index(drop=True)
+
+
+def coverage_matrix(G, depots, targets, hours, workers=None, batch_size=32):
+    """
+    This function returns the (len(depots), len(targets)) sparse matrix of travel times (in
+    seconds) from every depot to the targets it reaches within hours. A target is covered by a
+    depot exactly when the matrix stores an entry for it, even if the time is 0.
+    """
+    with instrumentation.stage("coverage.matrix", depots=len(depots), targets=len(targets)):
+        costs = travel_time_matrix(
+            G,
+            depots,
+            targets,
+            batch_size=batch_size,
+            limit=hours * 3600,
+            workers=workers,
+        )
+
+    rows, columns = np.nonzero(np.isfinite(costs))
+    return csr_matrix((costs[rows, columns], (rows, columns)), shape=costs.shape)
+
+
+def reachable_sets(coverage, depots, targets):
+    """
+    This function returns {depot: array of the target node ids it covers}.
+    """
+    targets = np.asarray(targets)
+    return {
+        depot: targets[coverage.indices[coverage.indptr[i] : coverage.indptr[i + 1]]]
+        for i, depot in enumerate(depots)
+    }
+
+
+def isochrones(G, sources, hours, weight=" travel_time", workers=None, batch_size=8):
+    """
+    This function returns {source: array of the node ids within hours of it} for every
+    source, the whole reachable area rather than only some targets.
+    """
+    G = as_road_graph(G)
+    sources = list(sources)
+    batches = [sources[i : i + batch_size] for i in range(0, len(sources), batch_size)]
+    limit = hours * 3600
+
+    with instrumentation.stage("coverage.isochrones", sources=len(sources)):
+        if workers is not None and workers > 1 and len(batches) > 1:
+            with graph_worker_pool(G, workers) as pool:
+                results = pool.map(
+                    _isochrone_task, batches, [weight] * len(batches), [limit] * len(batches)
+                )
+                areas = [area for batch in results for area in batch]
+        else:
+            areas = [area for batch in batches for area in _isochrones(G, batch, weight, limit)]
+
+    return dict(zip(sources, areas))
+
+
+def select_depots(coverage, weights, count):
+    """
+    This function picks up to count depots (rows of the coverage matrix) that together cover
+    the most weight, greedily, and returns [(row, weight the depot added)] in the order they
+    were picked. It stops early when no depot adds any weight.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    covered = np.zeros(coverage.shape[1], dtype=bool)
+    indptr, indices = coverage.indptr, coverage.indices
+
+    def gain(row):
+        columns = indices[indptr[row] : indptr[row + 1]]
+        return float(weights[columns[~covered[columns]]].sum())
+
+    # (-gain, row, number of depots picked when the gain was computed)
+    heap = [(-gain(row), row, 0) for row in range(coverage.shape[0])]
+    heapq.heapify(heap)
+
+    selected = []
+    while heap and len(selected) < count:
+        negative_gain, row, picked = heapq.heappop(heap)
+        if picked == len(selected):
+            # The gain is up to date, so no other depot can add more
+            if -negative_gain <= 0:
+                break
+            selected.append((row, -negative_gain))
+            covered[indices[indptr[row] : indptr[row + 1]]] = True
+        else:
+            heapq.heappush(heap, (-gain(row), row, len(selected)))
+
+    return selected
+
+
+def plan_depots(G, nodes, candidates, hours, count, min_risk_class=4, workers=None):
+    """
+    This function picks count depots out of the candidate node ids that cover the most risk
+    score of the hospitals with at least min_risk_class within hours. It returns one row per
+    picked depot with the risk score and hospitals it adds and the running totals.
+    """
+    hospitals = hospital_targets(nodes, min_risk_class)
+    G = as_road_graph(G)
+    hospitals = hospitals[hospitals["# index"].isin(G.node_ids)]
+    targets = hospitals["# index"].tolist()
+    weights = hospitals["risk_score"].to_numpy(dtype=np.float64)
+
+    coverage = coverage_matrix(G, candidates, targets, hours, workers)
+    with instrumentation.stage("coverage.select", candidates=len(candidates)):
+        selected = select_depots(coverage, weights, count)
+
+    covered = np.zeros(len(targets), dtype=bool)
+    rows = []
+    for row, added in selected:
+        columns = coverage.indices[coverage.indptr[row] : coverage.indptr[row + 1]]
+        new = columns[~covered[columns]]
+        covered[new] = True
+        rows.append(
+            {
+                "depot": candidates[row],
+                "risk_added": added,
+                "hospitals_added": len(new),
+                "risk_covered": float(weights[covered].sum()),
+                "hospitals_covered": int(covered.sum()),
+                "share_of_risk": float(weights[covered].sum() / weights.sum())
+                if weights.sum() > 0
+                else 0.0,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def _isochrones(G, sources, weight, limit):
+    from scipy.sparse.csgraph import dijkstra  # C-speed one-to-all searches
+
+    distances = dijkstra(G.to_scipy(weight), indices=G.indices_of(sources), limit=limit)
+    return [G.node_ids[np.isfinite(row)] for row in distances]
+
+
+def _isochrone_task(sources, weight, limit):
+    return _isochrones(worker_graph(), sources, weight, limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pick depots for the mobile clinics.")
+    parser.add_argument("--state", default="MO")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--depots", type=int, default=5, help="how many depots to pick")
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=500,
+        help="how many random road nodes to consider as depots",
+    )
+    parser.add_argument("--min-risk-class", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # The same graph (and hospitals) the GUI and the routing service use
+    G = load_state_graph(DATA_DIR, args.state)
+    nodes = G.attributes.hospitals()
+
+    rng = np.random.default_rng(args.seed)
+    candidates = rng.choice(
+        G.node_ids, min(args.candidates, G.num_nodes), replace=False
+    ).tolist()
+
+    print(
+        plan_depots(
+            G, nodes, candidates, args.hours, args.depots, args.min_risk_class, args.workers
+        ).to_string(index=False)
+    )
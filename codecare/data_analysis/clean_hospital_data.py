@@ -3,38 +3,54 @@ This module will help to do the first step in data cleaning for the CodeCare dat
 It will load the dataset, rename columns for clarity, drop unnecessary columns,
 ensure no negative values in specific columns, and create a risk score and risk class/label
 based on hospital bed occupancy, ICU occupancy, infectious pressure, and emergency department pressure.
+
+For files that don't fit in memory, run it with --stream: the file is then read in chunks
+(only the columns that are kept, with the repeated text values as categories) and the cleaned rows are written out
+chunk by chunk. The risk score needs the min/max of the whole column and a Box-Cox lambda
+fitted on all rows, so the streaming mode makes two passes: the first one only keeps the raw
+risk score (one float per row, in a temporary file on disk) to fit the normalization, the
+second one writes the output. Both modes write the same file, byte for byte: the numbers are
+read as float64 like in memory, only the text columns are stored more compactly.
+
+The fitted normalization (the raw min/max, the Box-Cox lambda and the min/max after Box-Cox)
+is saved to risk_normalization.json next to the output. A new collection week can then be
+added with --week: only its rows are cleaned and scored with the saved normalization and
+appended to the output, so the scores of past weeks don't change. A week that was already
+added is skipped. If the new rows drift too far from the data the normalization was fitted
+on, they are not appended (unless --force is given); --refit --week fits it again on the whole
+history (the input, every week added since and the new weeks).
 """
 
 # Import in pandas for data manipulation
+import argparse  # for the command line options
+import json  # for saving the fitted normalization
+import os  # for the temporary file and the default paths
+import shutil  # for appending the staged rows of a new week
+import tempfile  # for the temporary file
+import numpy as np  # for the on-disk risk score column
 import pandas as pd
 from scipy.stats import boxcox
+from codecare.data_cache import read_csv_cached, file_digest  # binary copy of the csv
+
+# The folder this script is in, the default paths are relative to it
+HERE = os.path.dirname(os.path.abspath(__file__))
 
-# Load the CodeCare dataset from a CSV file
-codecare_df = pd.read_csv("../../data/codecare_data.csv")
-
-# Rename columns for better clarity
-codecare_df.rename(
-    # Rename specific columns to more descriptive names
-    columns={
-        "X": "latitude",
-        "Y": "longitude",
-        "collection_week": "date",
-    },
-    # Perform the renaming operation in place
-    inplace=True,
-)
-
-# Drop unnecessary columns from the dataset
-codecare_df = codecare_df.drop(
-    columns=[
-        "OBJECTID",
-        "hospital_pk",
-        "ccn",
-        "fips_code",
-        "is_metro_micro",
-        "last_updated",
-    ],
-)
+# Columns renamed for better clarity
+RENAMED_COLUMNS = {
+    "X": "latitude",
+    "Y": "longitude",
+    "collection_week": "date",
+}
+
+# Unnecessary columns dropped from the dataset
+DROPPED_COLUMNS = [
+    "OBJECTID",
+    "hospital_pk",
+    "ccn",
+    "fips_code",
+    "is_metro_micro",
+    "last_updated",
+]
 
 # Ensure that specific columns have no negative values by clipping them at zero
 X_values = [
@@ -122,59 +138,402 @@ X_values = [
     "prevadmit_flu_conf_7d_sum",
 ]
 
-# Clip negative values to zero for the specified columns
-codecare_df[X_values] = codecare_df[X_values].clip(lower=1)
-
-# Now, create the y-value (risk)
-
-# Calculate intermediate metrics for risk score calculation
-codecare_df["bed_occupancy"] = (
-    codecare_df["inpatient_beds_used_7_day_avg"] / codecare_df["total_beds_7_day_avg"]
-)
-
-# Calculate ICU occupancy
-codecare_df["icu_occupancy"] = (
-    codecare_df["icu_beds_used_7_day_avg"] / codecare_df["total_icu_beds_7_day_avg"]
-)
-
-# Calculate infectious pressure
-codecare_df["infectious_pressure"] = (
-    codecare_df["adults_hospconf_7d_avg"] + codecare_df["hospconf_flucovid_7d_avg"]
-) / codecare_df["total_beds_7_day_avg"]
-
-# Calculate emergency department pressure
-codecare_df["ed_pressure"] = (
-    codecare_df["prevday_totED_visits_7d_sum"] / codecare_df["total_beds_7_day_avg"]
-)
-
-# Combine the metrics into a single risk score
-codecare_df["risk_score"] = (
-    0.5 * codecare_df["bed_occupancy"]
-    + 0.3 * codecare_df["icu_occupancy"]
-    + 0.1 * codecare_df["infectious_pressure"]
-    + 0.1 * codecare_df["ed_pressure"]
-)
-
-# Normalize the risk score to a 0-1 scale
-codecare_df["risk_score"] = (
-    codecare_df["risk_score"] - codecare_df["risk_score"].min()
-) / (codecare_df["risk_score"].max() - codecare_df["risk_score"].min()) + 0.01
-
-codecare_df["risk_score"], lambda_value = boxcox(codecare_df["risk_score"])
-
-codecare_df["risk_score"] = codecare_df["risk_score"] + 125
-
-codecare_df["risk_score"] = (
-    codecare_df["risk_score"] - codecare_df["risk_score"].min()
-) / (codecare_df["risk_score"].max() - codecare_df["risk_score"].min())
-
-# Create risk classes/labels based on the risk score
-codecare_df["risk_class"] = pd.cut(
-    codecare_df["risk_score"],
-    bins=[0, 0.25, 0.50, 0.75, 1.0],
-    labels=[1, 2, 3, 4],
-    include_lowest=True,
-)
-
-# Output the summary statistics of the risk score and save the cleaned dataset to a new CSV file
-codecare_df.to_csv("../data/codecare_data.csv", index=False)
+# Text columns with few distinct values, read as categories in the streaming mode
+CATEGORY_COLUMNS = ["state", "city", "hospital_subtype"]
+
+
+def add_risk_metrics(codecare_df):
+    """
+    This function clips the X values and adds the intermediate metrics and the raw
+    (not yet normalized) risk score to the DataFrame, in place.
+    """
+    # Clip negative values to zero for the specified columns
+    codecare_df[X_values] = codecare_df[X_values].clip(lower=1)
+
+    # Now, create the y-value (risk)
+
+    # Calculate intermediate metrics for risk score calculation
+    codecare_df["bed_occupancy"] = (
+        codecare_df["inpatient_beds_used_7_day_avg"] / codecare_df["total_beds_7_day_avg"]
+    )
+
+    # Calculate ICU occupancy
+    codecare_df["icu_occupancy"] = (
+        codecare_df["icu_beds_used_7_day_avg"] / codecare_df["total_icu_beds_7_day_avg"]
+    )
+
+    # Calculate infectious pressure
+    codecare_df["infectious_pressure"] = (
+        codecare_df["adults_hospconf_7d_avg"] + codecare_df["hospconf_flucovid_7d_avg"]
+    ) / codecare_df["total_beds_7_day_avg"]
+
+    # Calculate emergency department pressure
+    codecare_df["ed_pressure"] = (
+        codecare_df["prevday_totED_visits_7d_sum"] / codecare_df["total_beds_7_day_avg"]
+    )
+
+    # Combine the metrics into a single risk score
+    codecare_df["risk_score"] = (
+        0.5 * codecare_df["bed_occupancy"]
+        + 0.3 * codecare_df["icu_occupancy"]
+        + 0.1 * codecare_df["infectious_pressure"]
+        + 0.1 * codecare_df["ed_pressure"]
+    )
+
+    return codecare_df
+
+
+def normalize_risk_score(risk_score):
+    """
+    This function turns the raw risk scores of all rows into the final 0-1 scores: a
+    min-max normalization, a Box-Cox transform and a second min-max normalization.
+    It returns the scores and the fitted parameters, which apply_risk_normalization can
+    use to score new rows the same way.
+    """
+    raw_score = np.asarray(risk_score, dtype=np.float64)
+
+    # Normalize the risk score to a 0-1 scale
+    risk_score = (raw_score - np.nanmin(raw_score)) / (
+        np.nanmax(raw_score) - np.nanmin(raw_score)
+    ) + 0.01
+
+    risk_score, lambda_value = boxcox(risk_score)
+
+    risk_score = risk_score + 125
+
+    params = {
+        "raw_min": float(np.nanmin(raw_score)),
+        "raw_max": float(np.nanmax(raw_score)),
+        "lambda": float(lambda_value),
+        "boxcox_min": float(np.nanmin(risk_score)),
+        "boxcox_max": float(np.nanmax(risk_score)),
+    }
+
+    risk_score = (risk_score - np.nanmin(risk_score)) / (
+        np.nanmax(risk_score) - np.nanmin(risk_score)
+    )
+
+    params["score_mean"] = float(np.nanmean(risk_score))
+    params["score_std"] = float(np.nanstd(risk_score))
+    params["rows"] = len(risk_score)
+
+    return risk_score, params
+
+
+def apply_risk_normalization(risk_score, params):
+    """
+    This function scores raw risk scores with the parameters fitted by
+    normalize_risk_score. On the rows they were fitted on, this gives exactly the same
+    scores; scores of new rows outside the fitted range are clipped to 0-1.
+    """
+    risk_score = np.asarray(risk_score, dtype=np.float64)
+
+    risk_score = (risk_score - params["raw_min"]) / (
+        params["raw_max"] - params["raw_min"]
+    ) + 0.01
+
+    # Box-Cox needs positive values, new rows far below the fitted minimum get the lowest score
+    risk_score = boxcox(np.maximum(risk_score, 1e-6), params["lambda"]) + 125
+
+    risk_score = (risk_score - params["boxcox_min"]) / (
+        params["boxcox_max"] - params["boxcox_min"]
+    )
+
+    return np.clip(risk_score, 0.0, 1.0)
+
+
+def risk_drift(raw_score, params, max_out_of_range=0.01, max_mean_shift=0.25):
+    """
+    This function measures how far new rows are from the rows the normalization was
+    fitted on: the share of raw scores outside the fitted range, and how far the mean
+    score moved (in standard deviations of the fitted scores). It reports a refit as
+    needed when either is above its limit.
+    """
+    raw_score = np.asarray(raw_score, dtype=np.float64)
+    raw_score = raw_score[~np.isnan(raw_score)]
+    if len(raw_score) == 0:
+        return {"rows": 0, "out_of_range": 0.0, "mean_shift": 0.0, "needs_refit": False}
+
+    out_of_range = float(
+        np.mean((raw_score < params["raw_min"]) | (raw_score > params["raw_max"]))
+    )
+    scores = apply_risk_normalization(raw_score, params)
+    mean_shift = abs(float(scores.mean()) - params["score_mean"]) / max(
+        params["score_std"], 1e-12
+    )
+
+    return {
+        "rows": len(raw_score),
+        "out_of_range": out_of_range,
+        "mean_shift": mean_shift,
+        "needs_refit": out_of_range > max_out_of_range or mean_shift > max_mean_shift,
+    }
+
+
+def save_risk_normalization(params, path):
+    """
+    This function writes the fitted parameters to a json file.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump(params, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_risk_normalization(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def add_risk_class(codecare_df):
+    """
+    This function adds the risk classes/labels based on the (normalized) risk score.
+    """
+    codecare_df["risk_class"] = pd.cut(
+        codecare_df["risk_score"],
+        bins=[0, 0.25, 0.50, 0.75, 1.0],
+        labels=[1, 2, 3, 4],
+        include_lowest=True,
+    )
+    return codecare_df
+
+
+def clean_hospital_data(codecare_df, params=None):
+    """
+    This function cleans the whole dataset in memory and returns the cleaned DataFrame.
+    Without params the normalization is fitted on the dataset and its parameters are kept
+    in the DataFrame's attrs["risk_normalization"]; with params the rows are scored with
+    those instead.
+    """
+    # Rename columns for better clarity
+    codecare_df = codecare_df.rename(columns=RENAMED_COLUMNS)
+
+    # Drop unnecessary columns from the dataset
+    codecare_df = codecare_df.drop(columns=DROPPED_COLUMNS)
+
+    codecare_df = add_risk_metrics(codecare_df)
+    if params is None:
+        codecare_df["risk_score"], params = normalize_risk_score(codecare_df["risk_score"])
+    else:
+        codecare_df["risk_score"] = apply_risk_normalization(
+            codecare_df["risk_score"], params
+        )
+
+    codecare_df = add_risk_class(codecare_df)
+    codecare_df.attrs["risk_normalization"] = params
+    return codecare_df
+
+
+def clean_hospital_data_streaming(input_paths, output_path, chunksize=100_000):
+    """
+    This function cleans the dataset at input_paths (one file or a list of files with the
+    same columns) chunk by chunk and writes the result to output_path, so only one chunk
+    (plus one float per row) is in memory at a time. It returns the fitted parameters.
+    """
+    if isinstance(input_paths, str):
+        input_paths = [input_paths]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # First pass: compute the raw risk score of every row into a file on disk
+        scores_path = os.path.join(tmp, "risk_score.f8")
+        rows = 0
+        with open(scores_path, "wb") as scores_file:
+            for chunk in _read_chunks(input_paths, chunksize):
+                chunk = add_risk_metrics(chunk.rename(columns=RENAMED_COLUMNS))
+                chunk["risk_score"].to_numpy(dtype=np.float64).tofile(scores_file)
+                rows += len(chunk)
+
+        # Fit the normalization on all rows at once, like the in-memory version
+        raw_scores = np.memmap(scores_path, dtype=np.float64, mode="r", shape=(rows,))
+        risk_score, params = normalize_risk_score(raw_scores)
+        del raw_scores
+
+        # Second pass: clean each chunk again and append it to the output file
+        start = 0
+        for chunk in _read_chunks(input_paths, chunksize):
+            chunk = add_risk_metrics(chunk.rename(columns=RENAMED_COLUMNS))
+            chunk["risk_score"] = risk_score[start : start + len(chunk)]
+            add_risk_class(chunk).to_csv(
+                output_path, mode="a" if start else "w", header=not start, index=False
+            )
+            start += len(chunk)
+
+    return params
+
+
+def add_week(
+    week_paths,
+    output_path,
+    params_path,
+    chunksize=100_000,
+    max_out_of_range=0.01,
+    max_mean_shift=0.25,
+    force=False,
+):
+    """
+    This function cleans the rows of newly arrived weeks, scores them with the saved
+    normalization and appends them to the cleaned dataset at output_path. The rows already
+    there are not touched. Weeks already added (same file contents) are skipped, and the new
+    rows are only appended if they didn't drift from the fitted data, or force is True.
+
+    It returns the drift report of the new rows (see risk_drift), with "appended" (whether
+    the rows were added) and "skipped" (the paths of the weeks already added).
+    """
+    if isinstance(week_paths, str):
+        week_paths = [week_paths]
+    params = load_risk_normalization(params_path)
+    weeks, skipped = _new_weeks(week_paths, params.get("weeks", []))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stage the scored rows, they are only appended once the drift check passed
+        staged_path = os.path.join(tmp, "week.csv")
+        raw_scores = []
+        with open(staged_path, "w", newline="") as staged:
+            for chunk in _read_chunks([week["path"] for week in weeks], chunksize):
+                chunk = add_risk_metrics(chunk.rename(columns=RENAMED_COLUMNS))
+                raw_scores.append(chunk["risk_score"].to_numpy(dtype=np.float64))
+                chunk["risk_score"] = apply_risk_normalization(chunk["risk_score"], params)
+                add_risk_class(chunk).to_csv(staged, header=False, index=False)
+
+        report = risk_drift(
+            np.concatenate(raw_scores) if raw_scores else [],
+            params,
+            max_out_of_range,
+            max_mean_shift,
+        )
+        report["appended"] = bool(weeks) and (force or not report["needs_refit"])
+        report["skipped"] = skipped
+        if not report["appended"]:
+            return report
+
+        with open(staged_path, "rb") as staged, open(output_path, "ab") as output:
+            shutil.copyfileobj(staged, output)
+
+    # Remember the weeks, a refit needs them as part of the history
+    params.setdefault("weeks", []).extend(weeks)
+    save_risk_normalization(params, params_path)
+
+    return report
+
+
+def refit(input_path, output_path, params_path, chunksize=100_000, week_paths=()):
+    """
+    This function fits the normalization again on the whole history (input_path plus the
+    weeks added since the last fit, plus the new week_paths) and rewrites the cleaned
+    dataset and the parameters.
+    """
+    if isinstance(week_paths, str):
+        week_paths = [week_paths]
+    weeks = []
+    if os.path.exists(params_path):
+        weeks = load_risk_normalization(params_path).get("weeks", [])
+    weeks = weeks + _new_weeks(week_paths, weeks)[0]
+
+    params = clean_hospital_data_streaming(
+        [input_path] + [week["path"] for week in weeks], output_path, chunksize
+    )
+    params["weeks"] = weeks
+    save_risk_normalization(params, params_path)
+    return params
+
+
+def _new_weeks(week_paths, weeks):
+    """
+    This function returns the weeks of week_paths that aren't in weeks yet (as {"path",
+    "sha256"} entries, by file contents) and the paths of the ones that are.
+    """
+    known = {week["sha256"] for week in weeks}
+    new, skipped = [], []
+    for path in week_paths:
+        digest = file_digest(path)
+        if digest in known:
+            skipped.append(path)
+        else:
+            known.add(digest)
+            new.append({"path": os.path.abspath(path), "sha256": digest})
+    return new, skipped
+
+
+def _read_chunks(paths, chunksize):
+    """
+    This function reads the files one after the other in chunks, with compact dtypes and
+    without the dropped columns.
+    """
+    for path in paths:
+        yield from pd.read_csv(
+            path,
+            usecols=lambda column: column not in DROPPED_COLUMNS,
+            dtype=_streaming_dtypes(),
+            chunksize=chunksize,
+        )
+
+
+def _streaming_dtypes():
+    # float64 like read_csv, so the written values don't change
+    dtypes = {column: np.float64 for column in X_values}
+    dtypes.update({column: "category" for column in CATEGORY_COLUMNS})
+    dtypes.update({"X": np.float64, "Y": np.float64})
+    return dtypes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean the CodeCare dataset.")
+    parser.add_argument(
+        "--input", default=os.path.join(HERE, "..", "..", "data", "codecare_data.csv")
+    )
+    parser.add_argument(
+        "--output", default=os.path.join(HERE, "..", "data", "codecare_data.csv")
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="process the file in chunks"
+    )
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument(
+        "--params", default=None, help="the saved normalization (next to the output)"
+    )
+    parser.add_argument(
+        "--week", nargs="+", default=None, help="only add these new weeks to the output"
+    )
+    parser.add_argument(
+        "--refit",
+        action="store_true",
+        help="fit again on the input, all added weeks and the --week files",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="add the --week files even if they drifted"
+    )
+    args = parser.parse_args()
+
+    params_path = args.params or os.path.join(
+        os.path.dirname(os.path.abspath(args.output)), "risk_normalization.json"
+    )
+
+    if args.refit:
+        refit(args.input, args.output, params_path, args.chunksize, args.week or [])
+    elif args.week:
+        report = add_week(
+            args.week, args.output, params_path, args.chunksize, force=args.force
+        )
+        for path in report["skipped"]:
+            print(f"Skipped {path}, it was already added")
+        print(
+            f"{'Added' if report['appended'] else 'Checked'} {report['rows']} rows: "
+            f"{report['out_of_range'] * 100:.1f}% outside the fitted range, mean shift "
+            f"{report['mean_shift']:.2f} std"
+        )
+        if report["needs_refit"] and not report["appended"]:
+            print(
+                "The new data drifted from the fitted normalization and was not added, "
+                "run with --refit --week to fit again including it (or --force to add it "
+                "as it is)"
+            )
+    elif args.stream:
+        params = clean_hospital_data_streaming(args.input, args.output, args.chunksize)
+        save_risk_normalization(params, params_path)
+    else:
+        # Load the CodeCare dataset from a CSV file
+        codecare_df = read_csv_cached(args.input)
+
+        # Save the cleaned dataset to a new CSV file
+        codecare_df = clean_hospital_data(codecare_df)
+        codecare_df.to_csv(args.output, index=False)
+        save_risk_normalization(codecare_df.attrs["risk_normalization"], params_path)
@@ -1,11 +1,23 @@
 """
 This module will analyze the correlation between the risk score and other variables in the CodeCare dataset.
+
+The correlations are computed in one pass over chunks of rows instead of with
+DataFrame.corr() on the whole dataset: StreamingCorrelation keeps, for every pair of columns,
+the number of rows where both are present, their means and their (co-)moments, and merges
+the totals of two chunks with Chan's formula. Partial results of several files (or states)
+can be computed in parallel and merged the same way. Like DataFrame.corr(), every pair only
+uses the rows where both columns are present. By default only the risk_score column of the
+matrix is computed.
 """
 
-import pandas as pd
+import os  # for the paths relative to this file
+from concurrent.futures import ProcessPoolExecutor  # for the files in parallel
+from itertools import repeat  # for passing the same arguments to every file
+import numpy as np  # for the moments
+import pandas as pd  # for reading the csv in chunks
 
-# Load the cleaned CodeCare dataset
-codecare_df = pd.read_csv("../../data/codecare_data.csv")
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
 
 # List of columns to analyze for correlation with the risk score
 X_values = [
@@ -93,23 +105,212 @@ X_values = [
     "prevadmit_flu_conf_7d_sum",
 ]
 
-# Get correlation matrix
-correlation_matrix = codecare_df[X_values + ["risk_score"]].corr()
 
-# Extract correlations with risk score
-risk_score_correlation = correlation_matrix["risk_score"].drop("risk_score")
+class StreamingCorrelation:
+    """
+    Running correlation statistics between columns (rows of the result) and targets
+    (columns of the result). With targets=None the full square matrix is kept.
+
+    For every (column, target) pair it keeps the count n of rows where both are present,
+    the means of both over those rows, their sums of squared deviations and the sum of the
+    products of their deviations (the co-moment).
+    """
+
+    def __init__(self, columns, targets=None):
+        self.columns = list(columns)
+        self.targets = list(columns if targets is None else targets)
+
+        shape = (len(self.columns), len(self.targets))
+        self.n = np.zeros(shape)
+        self.mean_x = np.zeros(shape)
+        self.mean_y = np.zeros(shape)
+        self.m2_x = np.zeros(shape)
+        self.m2_y = np.zeros(shape)
+        self.comoment = np.zeros(shape)
+
+    def update(self, df: pd.DataFrame):
+        """
+        This function adds the rows of a chunk to the statistics.
+        """
+        X = df[self.columns].to_numpy(dtype=np.float64)
+        Y = df[self.targets].to_numpy(dtype=np.float64)
+        self.merge(self._moments(X, Y))
+        return self
+
+    def merge(self, other):
+        """
+        This function adds the statistics of other (over different rows) to these ones.
+        """
+        n = self.n + other.n
+        with np.errstate(invalid="ignore", divide="ignore"):
+            share = np.where(n > 0, other.n / n, 0.0)
+        weight = self.n * share
+
+        dx = other.mean_x - self.mean_x
+        dy = other.mean_y - self.mean_y
+        self.comoment += other.comoment + dx * dy * weight
+        self.m2_x += other.m2_x + dx * dx * weight
+        self.m2_y += other.m2_y + dy * dy * weight
+        self.mean_x += dx * share
+        self.mean_y += dy * share
+        self.n = n
+        return self
+
+    def corr(self):
+        """
+        This function returns the correlations as a DataFrame, with the columns as rows and
+        the targets as columns. Pairs without two rows or without variance are NaN.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = self.comoment / np.sqrt(self.m2_x * self.m2_y)
+        r = np.where((self.n > 1) & (self.m2_x > 0) & (self.m2_y > 0), r, np.nan)
+        return pd.DataFrame(np.clip(r, -1, 1), index=self.columns, columns=self.targets)
+
+    def _moments(self, X, Y):
+        """
+        This function computes the statistics of one chunk with matrix products. Each column
+        is shifted by its chunk mean first, which keeps the sums small and accurate.
+        """
+        chunk = StreamingCorrelation(self.columns, self.targets)
+        present_x = ~np.isnan(X)
+        present_y = ~np.isnan(Y)
+        shift_x = _column_means(X, present_x)
+        shift_y = _column_means(Y, present_y)
+        X = np.where(present_x, X - shift_x, 0.0)
+        Y = np.where(present_y, Y - shift_y, 0.0)
+        px = present_x.astype(np.float64)
+        py = present_y.astype(np.float64)
+
+        n = px.T @ py
+        sum_x = X.T @ py
+        sum_y = px.T @ Y
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_x = np.where(n > 0, sum_x / n, 0.0)
+            mean_y = np.where(n > 0, sum_y / n, 0.0)
+
+        chunk.n = n
+        chunk.comoment = X.T @ Y - sum_x * mean_y
+        chunk.m2_x = (X * X).T @ py - sum_x * mean_x
+        chunk.m2_y = px.T @ (Y * Y) - sum_y * mean_y
+
+        # Undo the shift for the means, the moments don't depend on it
+        chunk.mean_x = mean_x + shift_x[:, None]
+        chunk.mean_y = mean_y + shift_y[None, :]
+        return chunk
+
+
+def _column_means(values, present):
+    counts = present.sum(axis=0)
+    sums = np.where(present, values, 0.0).sum(axis=0)
+    return np.divide(sums, counts, out=np.zeros(len(counts)), where=counts > 0)
+
+
+def correlations_from_csv(paths, columns, targets=None, chunksize=100_000, workers=None):
+    """
+    This function computes the correlations over one or more csv files, streaming every
+    file in chunks. The files are processed in parallel worker processes and their partial
+    statistics merged.
+    """
+    paths = list(paths)
+    if len(paths) == 1 or workers == 1:
+        partials = [
+            _file_statistics(path, columns, targets, chunksize) for path in paths
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = list(
+                pool.map(
+                    _file_statistics,
+                    paths,
+                    repeat(columns),
+                    repeat(targets),
+                    repeat(chunksize),
+                )
+            )
+
+    total = StreamingCorrelation(columns, targets)
+    for partial in partials:
+        total.merge(partial)
+    return total.corr()
+
+
+def correlations_by_state(codecare_df, columns, targets=None, workers=None):
+    """
+    This function computes the correlations of every state in parallel worker processes and
+    merges them into the correlations of all states. It returns both: (all states,
+    {state: correlations of that state}).
+    """
+    groups = list(codecare_df.groupby("state", observed=True))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partials = list(
+            pool.map(
+                _frame_statistics,
+                [group for _, group in groups],
+                repeat(columns),
+                repeat(targets),
+            )
+        )
+
+    total = StreamingCorrelation(columns, targets)
+    for partial in partials:
+        total.merge(partial)
+    return total.corr(), {
+        state: partial.corr() for (state, _), partial in zip(groups, partials)
+    }
+
+
+def _frame_statistics(df, columns, targets, chunksize=100_000):
+    statistics = StreamingCorrelation(columns, targets)
+    for start in range(0, len(df), chunksize):
+        statistics.update(df.iloc[start : start + chunksize])
+    return statistics
+
+
+def _file_statistics(path, columns, targets, chunksize):
+    statistics = StreamingCorrelation(columns, targets)
+    needed = set(statistics.columns) | set(statistics.targets)
+    for chunk in pd.read_csv(path, usecols=lambda name: name in needed, chunksize=chunksize):
+        statistics.update(chunk)
+    return statistics
+
+
+def risk_score_correlations(codecare_df, threshold=0.25):
+    """
+    This function returns the correlation of every X value with the risk score (strongest
+    first) and the variables whose correlation is at least threshold either way.
+    """
+    # Only the risk score column of the correlation matrix is needed
+    statistics = _frame_statistics(codecare_df, X_values, ["risk_score"])
+
+    return _rank(statistics.corr()["risk_score"], threshold)
+
+
+def _rank(risk_score_correlation, threshold):
+    # Extract correlations with risk score
+    risk_score_correlation = risk_score_correlation.sort_values(ascending=False)
+
+    # If there is a sign of sufficient correlation (above weak) based on r, then keep it
+    suitable_vars = [
+        variable
+        for variable, correlation in risk_score_correlation.items()
+        if correlation >= threshold or correlation <= -threshold
+    ]
+
+    return risk_score_correlation, suitable_vars
+
+
+if __name__ == "__main__":
+    # Stream the cleaned CodeCare dataset instead of loading it
+    correlations = correlations_from_csv(
+        [os.path.join(DATA_DIR, "codecare_data.csv")], X_values, ["risk_score"]
+    )
 
-suitable_vars = []
+    risk_score_correlation, suitable_vars = _rank(correlations["risk_score"], 0.25)
 
-# Print the correlations and rank
-print("Correlation of variables with Risk Score:")
-for variable, correlation in risk_score_correlation.sort_values(
-    ascending=False
-).items():
-    print(f"{variable}: {correlation:.4f}")
-    if correlation >= 0.25 or correlation <= -0.25:
-        # If there is a sign of sufficient correlation (above weak) based on r, then append
-        suitable_vars.append(variable)
+    # Print the correlations and rank
+    print("Correlation of variables with Risk Score:")
+    for variable, correlation in risk_score_correlation.items():
+        print(f"{variable}: {correlation:.4f}")
 
-print("\nVariables with strong correlation (>= 0.25 or <= -0.25) with Risk Score:")
-print(suitable_vars)
+    print("\nVariables with strong correlation (>= 0.25 or <= -0.25) with Risk Score:")
+    print(suitable_vars)
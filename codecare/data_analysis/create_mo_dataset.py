@@ -1,72 +1,158 @@
 import pandas as pd  # reading CSVs
-from sklearn.metrics.pairwise import (
-    haversine_distances,
-)  # for matching the nodes to hospitals
+from sklearn.neighbors import BallTree  # for matching the nodes to hospitals
 import numpy as np  # helps in haversine with radians
-
-# read the codecare and the Missouri nodes dataframe
-codecare_df = pd.read_csv("../../data/codecare_data.csv")
-mo_nodes_df = pd.read_csv("../../data/mo_nodes.csv")
-
-# Filter for only MO data
-codecare_df = codecare_df[
-    codecare_df["state"].str.contains("MO", regex=False, na=False, case=False)
-]
-
-# Rename lat and lon columns for clarity
-mo_nodes_df = mo_nodes_df.rename(columns={" la": "latitude", " lo": "longitude"})
-
-# Run Haversine
-codecare_coords = np.radians(codecare_df[["latitude", "longitude"]].values)
-mo_nodes_coords = np.radians(mo_nodes_df[["latitude", "longitude"]].values)
-
-dist_matrix = haversine_distances(codecare_coords, mo_nodes_coords)
-dist_matrix = dist_matrix * 6371
-
-closest_indices = dist_matrix.argmin(axis=1)
-closest_distances = dist_matrix.min(axis=1)
-
-# Set a threshold distance (e.g., 1 km)
-threshold_km = 100
-mask = closest_distances <= threshold_km
-
-# Merge matching points
-df1_matches = codecare_df[mask].reset_index(drop=True)
-df2_matches = mo_nodes_df.iloc[closest_indices[mask]].reset_index(drop=True)
-merged_matches = pd.concat([df1_matches, df2_matches.add_suffix("_mo_nodes")], axis=1)
-
-# Get non-matching points
-df1_nonmatches = codecare_df[~mask]
-df2_nonmatches = mo_nodes_df.drop(closest_indices[mask])
-
-
-# Union: all unique points
-final_df = pd.concat(
-    [merged_matches, df1_nonmatches, df2_nonmatches], ignore_index=True
-)
-
-# Choose which essential columns to keep
-COLS_TO_KEEP = [
-    "date",
-    "state",
-    "hospital_name",
-    "address",
-    "city",
-    "hospital_subtype",
-    "risk_score",
-    "risk_class",
-    "# index_mo_nodes",
-]
-
-# Adjust and drop any missing values
-final_df = final_df[COLS_TO_KEEP]
-
-final_df = final_df.dropna()
-
-final_df["# index_mo_nodes"] = final_df["# index_mo_nodes"].astype(int)
-
-final_df = final_df.rename(
-    columns={"# index_mo_nodes": "# index"}
-)  # rename index for clarity
-
-final_df.to_csv("../../data/mo_nodes_with_risk.csv")  # export
+import joblib  # for saving the index to reuse it
+import os  # for the paths relative to this file
+from codecare.data_cache import read_csv_cached, file_digest  # binary copies of the csv files
+
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+
+class NodeSnapper:
+    """
+    This class finds the closest road node to any point, using a BallTree over the node
+    coordinates (in radians, with the haversine metric). The tree is built once in
+    O(M log M) and every query costs O(log M), instead of comparing each hospital to every
+    node. The index can be saved and loaded again to snap new hospitals later.
+    """
+
+    def __init__(self, nodes_df: pd.DataFrame):
+        self.tree = BallTree(
+            np.radians(nodes_df[["latitude", "longitude"]].to_numpy(dtype=np.float64)),
+            metric="haversine",
+        )
+
+    def query(self, latitude, longitude, chunk_size=100_000):
+        """
+        This function returns, for every point, the position (row) of the closest node in the
+        node DataFrame and the distance to it in km. Points are queried chunk_size at a time
+        so memory stays flat however many points there are.
+        """
+        coords = np.radians(np.column_stack([latitude, longitude]).astype(np.float64))
+        closest_indices = np.empty(len(coords), dtype=np.int64)
+        closest_distances = np.empty(len(coords))
+
+        for start in range(0, len(coords), chunk_size):
+            distances, indices = self.tree.query(coords[start : start + chunk_size], k=1)
+            closest_indices[start : start + chunk_size] = indices[:, 0]
+            closest_distances[start : start + chunk_size] = distances[:, 0] * 6371
+
+        return closest_indices, closest_distances
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
+
+
+def snapper_for(nodes_path, nodes_df=None, cache_dir=None):
+    """
+    This function loads the index for a nodes file from disk, building and saving it first
+    if there is none yet. The file name carries a hash of the nodes file, so a changed nodes
+    file gets a new index instead of a stale one. nodes_df is the file's DataFrame, if it
+    was read already.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(nodes_path))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(nodes_path))[0]
+    path = os.path.join(cache_dir, f"{name}_snapper_{file_digest(nodes_path)[:16]}.joblib")
+    if os.path.exists(path):
+        return NodeSnapper.load(path)
+
+    if nodes_df is None:
+        nodes_df = read_csv_cached(nodes_path)
+    snapper = NodeSnapper(
+        nodes_df.rename(columns={" la": "latitude", " lo": "longitude"})
+    )
+    snapper.save(path)
+
+    return snapper
+
+
+def snap_hospitals(codecare_df, mo_nodes_df, state="MO", threshold_km=100, snapper=None):
+    """
+    This function matches the hospitals of one state to their closest road node and returns
+    the essential columns of the matched hospitals, with the node in the "# index" column.
+    snapper is an index already built (or loaded) for mo_nodes_df; without one it is built.
+    """
+    # Filter for only the state's data
+    codecare_df = codecare_df[
+        codecare_df["state"].str.contains(state, regex=False, na=False, case=False)
+    ]
+
+    # Rename lat and lon columns for clarity
+    mo_nodes_df = mo_nodes_df.rename(columns={" la": "latitude", " lo": "longitude"})
+
+    # Find the closest node to each hospital with the spatial index
+    if snapper is None:
+        snapper = NodeSnapper(mo_nodes_df)
+    closest_indices, closest_distances = snapper.query(
+        codecare_df["latitude"].to_numpy(), codecare_df["longitude"].to_numpy()
+    )
+
+    # Set a threshold distance (e.g., 1 km)
+    mask = closest_distances <= threshold_km
+
+    # Merge matching points
+    df1_matches = codecare_df[mask].reset_index(drop=True)
+    df2_matches = mo_nodes_df.iloc[closest_indices[mask]].reset_index(drop=True)
+    merged_matches = pd.concat(
+        [df1_matches, df2_matches.add_suffix("_mo_nodes")], axis=1
+    )
+
+    # Get non-matching points
+    df1_nonmatches = codecare_df[~mask]
+    df2_nonmatches = mo_nodes_df.drop(closest_indices[mask])
+
+    # Union: all unique points
+    final_df = pd.concat(
+        [merged_matches, df1_nonmatches, df2_nonmatches], ignore_index=True
+    )
+
+    # Choose which essential columns to keep
+    COLS_TO_KEEP = [
+        "date",
+        "state",
+        "hospital_name",
+        "address",
+        "city",
+        "hospital_subtype",
+        "risk_score",
+        "risk_class",
+        "# index_mo_nodes",
+    ]
+
+    # Adjust and drop any missing values
+    final_df = final_df[COLS_TO_KEEP]
+
+    final_df = final_df.dropna()
+
+    final_df["# index_mo_nodes"] = final_df["# index_mo_nodes"].astype(int)
+
+    return final_df.rename(
+        columns={"# index_mo_nodes": "# index"}
+    )  # rename index for clarity
+
+
+def snap_state_hospitals(codecare_df, nodes_path, state="MO", threshold_km=100):
+    """
+    This function runs snap_hospitals on a nodes file, with the index saved next to the file
+    (see snapper_for), so later runs and new hospitals don't build it again.
+    """
+    mo_nodes_df = read_csv_cached(nodes_path)
+    snapper = snapper_for(nodes_path, mo_nodes_df)
+    return snap_hospitals(codecare_df, mo_nodes_df, state, threshold_km, snapper)
+
+
+if __name__ == "__main__":
+    # read the codecare and the Missouri nodes dataframe
+    codecare_df = read_csv_cached(os.path.join(DATA_DIR, "codecare_data.csv"))
+
+    final_df = snap_state_hospitals(codecare_df, os.path.join(DATA_DIR, "mo_nodes.csv"))
+
+    final_df.to_csv(os.path.join(DATA_DIR, "mo_nodes_with_risk.csv"))  # export
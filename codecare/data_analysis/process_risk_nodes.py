@@ -1,10 +1,25 @@
-import pandas as pd  # csv reading
+import os  # for the paths relative to this file
+from codecare.data_cache import read_csv_cached  # csv reading
 
-# Merge risk with MO nodes
-nodes_with_risk = pd.read_csv("../../data/mo_nodes_with_risk.csv")
-nodes = pd.read_csv("../../data/mo_nodes.csv")
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
 
-merged_df = nodes.merge(nodes_with_risk, on="# index", how="left")
-merged_df["risk_score"] = merged_df["risk_score"].fillna(0)
 
-merged_df.to_csv("../../data/mo_data.csv")
+def merge_risk_nodes(nodes_with_risk, nodes):
+    """
+    This function merges the risk of the snapped hospitals into the road nodes; nodes
+    without a hospital get a risk score of 0.
+    """
+    merged_df = nodes.merge(nodes_with_risk, on="# index", how="left")
+    merged_df["risk_score"] = merged_df["risk_score"].fillna(0)
+    return merged_df
+
+
+if __name__ == "__main__":
+    # Merge risk with MO nodes
+    nodes_with_risk = read_csv_cached(os.path.join(DATA_DIR, "mo_nodes_with_risk.csv"))
+    nodes = read_csv_cached(os.path.join(DATA_DIR, "mo_nodes.csv"))
+
+    merged_df = merge_risk_nodes(nodes_with_risk, nodes)
+
+    merged_df.to_csv(os.path.join(DATA_DIR, "mo_data.csv"))
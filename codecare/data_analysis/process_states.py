@@ -0,0 +1,153 @@
+"""
+This module runs the per-state steps for many states at once, one worker process per state:
+matching the hospitals to road nodes (create_mo_dataset), merging the risk into the road nodes
+(process_risk_nodes) and building the compact road graph the routing engine uses.
+
+Every state has its own road network files in the data folder, named like the Missouri ones:
+<state>_nodes.csv and <state>_edges.csv (mo_nodes.csv, mo_edges.csv, ...). The outputs are
+written per state as well: <state>_nodes_with_risk.csv, <state>_data.csv and the graph arrays in
+graphs/<STATE>/. graphs/index.json lists the states with the bounding box of their graph, so the
+routing engine can load only the states a query touches.
+"""
+
+import argparse  # for the command line options
+import json  # for the index of the state graphs
+import os  # for the file paths
+import time  # for timing each state
+from concurrent.futures import ProcessPoolExecutor  # one worker process per state
+import numpy as np  # for the bounding boxes
+import pandas as pd  # for the summary
+from codecare.data_cache import read_csv_cached  # binary copies of the csv files
+from codecare.data_analysis.create_mo_dataset import snap_hospitals, snapper_for
+from codecare.data_analysis.process_risk_nodes import merge_risk_nodes
+from codecare.routing_engine import read_edges, construct_road_graph
+
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+# The 50 states and DC, by postal code (as in the "state" column of the hospital data)
+STATES = (
+    "AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO "
+    "MT NE NV NH NJ NM NY NC ND OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY"
+).split()
+
+
+def state_file(data_dir, state, name):
+    """
+    This function returns the path of one of a state's csv files, e.g. data/mo_edges.csv.
+    """
+    return os.path.join(data_dir, f"{state.lower()}_{name}.csv")
+
+
+def graph_dir(data_dir, state):
+    """
+    This function returns the folder the state's road graph is saved in.
+    """
+    return os.path.join(data_dir, "graphs", state.upper())
+
+
+def available_states(data_dir=DATA_DIR):
+    """
+    This function returns the states that have both road network files in data_dir.
+    """
+    return [
+        state
+        for state in STATES
+        if os.path.exists(state_file(data_dir, state, "nodes"))
+        and os.path.exists(state_file(data_dir, state, "edges"))
+    ]
+
+
+def process_state(state, hospitals, data_dir=DATA_DIR, threshold_km=100):
+    """
+    This function runs the per-state steps for the hospitals of one state and returns a
+    summary of the state's outputs.
+    """
+    started = time.perf_counter()
+    nodes = read_csv_cached(state_file(data_dir, state, "nodes"))
+
+    # Match the hospitals to road nodes (with the state's saved index) and merge their risk
+    # into the nodes
+    snapper = snapper_for(state_file(data_dir, state, "nodes"), nodes)
+    nodes_with_risk = snap_hospitals(hospitals, nodes, state, threshold_km, snapper)
+    nodes_with_risk.to_csv(state_file(data_dir, state, "nodes_with_risk"))
+    merged_df = merge_risk_nodes(nodes_with_risk, nodes)
+    merged_df.to_csv(state_file(data_dir, state, "data"))
+
+    # Build the compact road graph from the merged nodes and save it for the routing engine
+    nodes = merged_df
+    if "latitude" not in nodes:
+        nodes = nodes.rename(columns={" la": "latitude", " lo": "longitude"})
+    G = construct_road_graph(nodes, read_edges(state_file(data_dir, state, "edges")))
+    G.save(graph_dir(data_dir, state))
+
+    return {
+        "state": state,
+        "hospitals": len(nodes_with_risk),
+        "nodes": G.num_nodes,
+        "edges": G.num_edges,
+        "version": G.version,
+        "bbox": [
+            float(np.nanmin(G.latitude)),
+            float(np.nanmin(G.longitude)),
+            float(np.nanmax(G.latitude)),
+            float(np.nanmax(G.longitude)),
+        ],
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def process_states(codecare_df, states=None, data_dir=DATA_DIR, workers=None):
+    """
+    This function runs process_state for every state (all states with road network files by
+    default) in parallel worker processes and returns one summary row per state. Each worker
+    only receives the hospitals of its own state.
+    """
+    if states is None:
+        states = available_states(data_dir)
+    states = [state.upper() for state in states]
+
+    hospitals = [codecare_df[codecare_df["state"] == state] for state in states]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        summaries = list(
+            pool.map(process_state, states, hospitals, [data_dir] * len(states))
+        )
+
+    _update_index(data_dir, summaries)
+    return pd.DataFrame(summaries)
+
+
+def _update_index(data_dir, summaries):
+    """
+    This function adds the processed states to graphs/index.json, keeping the others.
+    """
+    path = os.path.join(data_dir, "graphs", "index.json")
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    for summary in summaries:
+        index[summary["state"]] = {
+            key: summary[key] for key in ("bbox", "nodes", "edges", "version")
+        }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process the road network of many states.")
+    parser.add_argument(
+        "--states", nargs="*", default=None, help="state codes (all available by default)"
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    # The cleaned hospital data of every state
+    codecare_df = read_csv_cached(os.path.join(DATA_DIR, "codecare_data.csv"))
+
+    print(process_states(codecare_df, args.states, DATA_DIR, args.workers))
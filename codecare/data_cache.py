@@ -0,0 +1,226 @@
+"""
+This module keeps a binary copy of the CSV inputs so they only have to be parsed once.
+
+The first time a CSV file is read through read_csv_cached, every column is written to its own
+.npy file in a cache folder next to the CSV (data/.cache/<file name>/), with smaller dtypes on
+disk: integers as int32 when they fit, text columns with few distinct values as category codes
+plus a list of the categories, and floats as float32 if asked for. They are loaded back with the
+dtypes pd.read_csv gives (int64, text as Python strings with NaN for missing values), so the
+DataFrame is the same as read_csv's; only float32=True changes the float columns. The
+manifest.json of the folder records the size, modification time and SHA-256 hash of the CSV it
+was built from, so an edited CSV is noticed and converted again. Loading the .npy files takes
+milliseconds, where parsing the CSV takes seconds. The column names are kept exactly as in the
+CSV (" distance", "# source").
+
+Threads of one process take turns on a cache folder. A new cache is written to a temporary
+folder and swapped in with renames; a reader in another process that loses its folder in the
+middle of loading it reads the CSV instead.
+"""
+
+import hashlib  # for hashing the source files
+import json  # for the manifest
+import os  # for the file paths
+import shutil  # for replacing an old cache folder
+import tempfile  # for the folder a new cache is written to
+import threading  # for the lock of every cache folder
+import numpy as np  # for the column files
+import pandas as pd  # for reading the csv
+
+# Bumped whenever the on-disk layout changes
+FORMAT_VERSION = 2
+
+# Text columns with at most this share of distinct values are stored as categories
+CATEGORY_RATIO = 0.5
+
+# One lock per cache folder, so threads don't build or swap the same cache at once
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def read_csv_cached(path, cache_dir=None, float32=False, **read_options):
+    """
+    This function returns the same DataFrame as pd.read_csv(path, **read_options), but from
+    the binary cache when it is up to date (and building the cache first when it isn't).
+    With float32=True the float columns are stored as float32, which halves their size but
+    rounds them.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".cache")
+    folder = os.path.join(cache_dir, os.path.basename(path))
+    options = {"float32": bool(float32), "read_options": repr(sorted(read_options.items()))}
+
+    with _lock_for(folder):
+        manifest = _fresh_manifest(path, folder, options)
+        if manifest is None:
+            df = pd.read_csv(path, **read_options)
+            index = None
+            if not isinstance(df.index, pd.RangeIndex):
+                # An index_col is stored as ordinary columns and set again on load
+                index = list(df.index.names)
+                df = df.reset_index()
+            _write_cache(df, path, cache_dir, folder, options, index)
+            return df.set_index(index) if index else df
+
+        try:
+            return _read_cache(folder, manifest)
+        except OSError:
+            # Another process replaced the cache while it was being read
+            return pd.read_csv(path, **read_options)
+
+
+def file_digest(path):
+    """
+    This function returns the SHA-256 hex digest of a file, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fresh_manifest(path, folder, options):
+    """
+    This function returns the manifest of the cache folder if it was built from the current
+    contents of path with the same options, and None otherwise.
+    """
+    try:
+        with open(os.path.join(folder, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("format_version") != FORMAT_VERSION or manifest["options"] != options:
+        return None
+
+    stat = os.stat(path)
+    if stat.st_size != manifest["size"]:
+        return None
+    if stat.st_mtime_ns == manifest["mtime_ns"]:
+        return manifest
+
+    # The file was touched: only rebuild if its contents really changed
+    if file_digest(path) != manifest["sha256"]:
+        return None
+    manifest["mtime_ns"] = stat.st_mtime_ns
+    _write_manifest(folder, manifest)
+    return manifest
+
+
+def _lock_for(folder):
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(folder), threading.Lock())
+
+
+def _write_cache(df, path, cache_dir, folder, options, index=None):
+    """
+    This function writes every column of df to the cache folder and returns its manifest.
+    The folder is written under a temporary name first, so a reader never sees half of it.
+    """
+    stat = os.stat(path)
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "source": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_digest(path),
+        "options": options,
+        "rows": len(df),
+        "index": index,
+        "columns": [],
+    }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=os.path.basename(folder) + ".tmp-")
+
+    for i, name in enumerate(df.columns):
+        column = {"name": name, "file": f"col_{i:04d}.npy", "dtype": str(df[name].dtype)}
+        values, column["kind"] = _compact(df[name], options["float32"])
+        if column["kind"] == "category":
+            codes, categories = values
+            column["categories"] = f"col_{i:04d}_categories.npy"
+            np.save(os.path.join(tmp, column["categories"]), categories)
+            values = codes
+        np.save(os.path.join(tmp, column["file"]), values, allow_pickle=True)
+        manifest["columns"].append(column)
+
+    _write_manifest(tmp, manifest)
+
+    # Move the old cache aside and the new one in; if another process got its cache in
+    # first, that one is kept
+    old = tempfile.mkdtemp(dir=cache_dir, prefix=os.path.basename(folder) + ".old-")
+    try:
+        os.replace(folder, os.path.join(old, "cache"))
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(tmp, folder)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+
+def _compact(series, float32):
+    """
+    This function returns the values to store for one column and their kind.
+    """
+    values = series.to_numpy()
+
+    if values.dtype.kind in "iu":
+        # Integers that fit in int32 are stored as int32
+        if len(values) == 0 or (
+            values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max
+        ):
+            values = values.astype(np.int32)
+        return values, "numeric"
+
+    if values.dtype.kind == "f":
+        return (values.astype(np.float32) if float32 else values), "numeric"
+
+    if values.dtype.kind in "bmM":
+        return values, "numeric"
+
+    # Text columns (with missing values as NaN)
+    missing = series.isna().to_numpy()
+    if all(isinstance(v, str) for v in values[~missing]):
+        codes, categories = pd.factorize(series)
+        if len(categories) <= CATEGORY_RATIO * len(values):
+            dtype = np.int8 if len(categories) < 127 else np.int16
+            if len(categories) >= 32767:
+                dtype = np.int32
+            return (codes.astype(dtype), np.asarray(categories, dtype=str)), "category"
+
+    # Anything else is kept as Python objects
+    return values, "object"
+
+
+def _read_cache(folder, manifest):
+    """
+    This function loads the columns of the cache folder with the dtypes read_csv gave them.
+    """
+    columns = {}
+    for column in manifest["columns"]:
+        path = os.path.join(folder, column["file"])
+        if column["kind"] == "category":
+            # Text as Python strings, missing values (code -1) as NaN
+            categories = np.load(os.path.join(folder, column["categories"]))
+            codes = np.load(path)
+            text = np.append(categories.astype(object), np.nan)
+            columns[column["name"]] = text[np.where(codes < 0, len(categories), codes)]
+        else:
+            values = np.load(path, allow_pickle=column["kind"] == "object")
+            if column["kind"] == "numeric" and values.dtype.kind in "iu":
+                values = values.astype(column["dtype"])
+            columns[column["name"]] = values
+
+    # Keep the column order of the CSV
+    df = pd.DataFrame(columns, columns=[c["name"] for c in manifest["columns"]])
+    if manifest.get("index"):
+        df = df.set_index(manifest["index"])
+    return df
+
+
+def _write_manifest(folder, manifest):
+    with open(os.path.join(folder, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
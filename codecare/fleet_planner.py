@@ -0,0 +1,256 @@
+"""
+This module plans routes for several mobile clinics (vehicles) at once.
+
+Given the hospitals to visit, one depot per vehicle and the length of each vehicle's shift,
+it splits the hospitals into one balanced route per vehicle. Several candidate splits are
+built from different random seeds and each is improved (moving hospitals from the longest
+routes to routes with time left) in parallel worker processes; the best one is then routed
+on the road graph. Every route starts and ends at its vehicle's depot.
+"""
+
+import math  # for the number of rounds of candidates
+import os  # for the default number of workers
+import time  # for the time budget
+from concurrent.futures import ProcessPoolExecutor  # for evaluating candidates in parallel
+from itertools import repeat  # for passing the same arguments to every task
+import numpy as np  # for the travel-time matrix
+from codecare.routing_engine import travel_time_matrix, astar_many_nodes, as_road_graph
+from codecare.tour_optimizer import order_stops, tour_cost
+
+# How much an hour over the shift limit counts compared to an hour of driving
+OVERTIME_PENALTY = 100.0
+
+# How much the longest route counts on top of the total, which keeps the routes balanced
+BALANCE_WEIGHT = 1.0
+
+
+def plan_fleet(
+    G,
+    hospitals,
+    depots,
+    shift_hours,
+    service_hours=0.0,
+    candidates=8,
+    workers=None,
+    time_budget=20.0,
+    seed=0,
+):
+    """
+    This function splits the hospitals over the vehicles (one per entry of depots, a depot
+    can be repeated) and returns the per-vehicle (path, cost) results, in the order of
+    depots, plus the hospitals that didn't fit in any shift and the ones no vehicle can
+    reach from its depot (which are left out of the split).
+
+    shift_hours is one limit for every vehicle or one per vehicle, and service_hours is the
+    time spent at each hospital. Costs are travel times in seconds, as for astar_many_nodes.
+
+    time_budget (in seconds) is for the whole call, however many workers there are: the
+    candidates share half of what is left after the travel-time matrix (candidates that run
+    one after another in the same worker split it), the other half is kept for routing the
+    best split on the road graph.
+    """
+    deadline = time.perf_counter() + time_budget
+    G = as_road_graph(G)
+    hospitals = list(dict.fromkeys(hospitals))
+    depots = list(depots)
+    k = len(depots)
+
+    shift = np.broadcast_to(np.asarray(shift_hours, dtype=np.float64) * 3600, (k,))
+
+    # One travel-time matrix between all depots and hospitals, computed in parallel
+    places = list(dict.fromkeys(depots + hospitals))
+    costs = travel_time_matrix(G, places, places, workers=workers)
+    depot_rows = [places.index(d) for d in depots]
+    hospital_rows = [places.index(h) for h in hospitals]
+
+    # A hospital only some depots reach is only given to their vehicles (its cost from the
+    # others is inf); one that no depot reaches can't be planned at all
+    reachable = np.isfinite(costs[np.ix_(hospital_rows, depot_rows)]).any(axis=1)
+    unreachable = [h for h, ok in zip(hospitals, reachable) if not ok]
+    hospital_rows = [row for row, ok in zip(hospital_rows, reachable) if ok]
+
+    # Build and improve the candidate splits in parallel, then keep the best one
+    problem = (costs, depot_rows, hospital_rows, shift, service_hours * 3600)
+    seeds = [seed + i for i in range(candidates)]
+    serial = workers == 1 or candidates == 1
+    parallel = 1 if serial else min(workers or os.cpu_count() or 1, candidates)
+    budget = max(deadline - time.perf_counter(), 0.0) / 2 / math.ceil(candidates / parallel)
+    if serial:
+        _init_candidate_worker(problem)
+        results = [_evaluate_candidate(s, budget) for s in seeds]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_candidate_worker,
+            initargs=(problem,),
+        ) as pool:
+            results = list(pool.map(_evaluate_candidate, seeds, repeat(budget)))
+
+    _, routes, unassigned = min(results, key=lambda result: result[0])
+
+    # Route the winning split on the road graph
+    plans = []
+    for depot, route in zip(depots, routes):
+        stops = [depot] + [places[row] for row in route] + [depot]
+        if len(stops) == 2:
+            plans.append(([depot], 0.0))
+        else:
+            plans.append(astar_many_nodes(G, list(zip(stops[:-1], stops[1:]))))
+
+    return plans, [places[row] for row in unassigned], unreachable
+
+
+# The problem each worker process receives once, in _init_candidate_worker
+_problem = None
+
+
+def _init_candidate_worker(problem):
+    global _problem
+    _problem = problem
+
+
+def _evaluate_candidate(seed, time_budget):
+    """
+    This function builds one split from a seed and improves it, returning
+    (score, routes as matrix rows in visiting order, unassigned rows).
+    """
+    costs, depot_rows, hospital_rows, shift, service = _problem
+    deadline = time.perf_counter() + time_budget
+    rng = np.random.default_rng(seed)
+
+    routes = _initial_split(costs, depot_rows, hospital_rows, shift, service, rng)
+    routes = [_order(costs, depot, route) for depot, route in zip(depot_rows, routes)]
+    durations = [
+        _duration(costs, depot, route, service)
+        for depot, route in zip(depot_rows, routes)
+    ]
+
+    # Move hospitals off the route that is furthest over its limit (or the longest one)
+    # while that lowers the score
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        load = [d / s for d, s in zip(durations, shift)]
+        worst = int(np.argmax(load))
+        for row in sorted(routes[worst], key=lambda r: -costs[depot_rows[worst], r]):
+            move = _best_move(costs, depot_rows, routes, durations, shift, service, worst, row)
+            if move is not None:
+                target, new_worst, new_target = move
+                routes[worst] = new_worst
+                routes[target] = new_target
+                durations[worst] = _duration(costs, depot_rows[worst], new_worst, service)
+                durations[target] = _duration(costs, depot_rows[target], new_target, service)
+                improved = True
+                break
+
+    # Whatever still doesn't fit in a shift is left unassigned, farthest detours first
+    unassigned = []
+    for v, depot in enumerate(depot_rows):
+        while routes[v] and durations[v] > shift[v]:
+            route = routes[v]
+            saving = [
+                _duration(costs, depot, route[:i] + route[i + 1 :], service)
+                for i in range(len(route))
+            ]
+            i = int(np.argmin(saving))
+            unassigned.append(route.pop(i))
+            durations[v] = saving[i]
+
+    return _score(durations, shift, len(unassigned)), routes, unassigned
+
+
+def _initial_split(costs, depot_rows, hospital_rows, shift, service, rng):
+    """
+    This function assigns the hospitals one by one (in a seeded random order, nearest to a
+    depot first) to the vehicle where they add the least, counting each vehicle's current
+    load so the routes stay balanced.
+    """
+    k = len(depot_rows)
+    routes = [[] for _ in range(k)]
+    load = np.zeros(k)
+
+    to_depots = costs[np.ix_(hospital_rows, depot_rows)]
+    noise = rng.uniform(0.5, 1.5, len(hospital_rows))
+    order = np.argsort(to_depots.min(axis=1) * noise)
+
+    for i in order:
+        row = hospital_rows[i]
+        added = np.array(
+            [
+                min([costs[row, r] for r in routes[v]] + [to_depots[i, v]]) + service
+                for v in range(k)
+            ]
+        )
+        v = int(np.argmin((load + added) / shift))
+        routes[v].append(row)
+        load[v] += added[v]
+
+    return routes
+
+
+def _best_move(costs, depot_rows, routes, durations, shift, service, source, row):
+    """
+    This function finds the vehicle that should take row off the source route, returning
+    (target vehicle, new source route, new target route) or None if no move lowers the score.
+    """
+    current = _score(durations, shift)
+    remaining = [r for r in routes[source] if r != row]
+    source_duration = _duration(costs, depot_rows[source], remaining, service)
+
+    best = None
+    for target in range(len(routes)):
+        if target == source:
+            continue
+
+        # Cheapest insertion gives a quick estimate, the real route is re-ordered after
+        depot = depot_rows[target]
+        route = routes[target]
+        stops = [depot] + route + [depot]
+        added = min(
+            costs[a, row] + costs[row, b] - costs[a, b]
+            for a, b in zip(stops[:-1], stops[1:])
+        )
+        durations_after = list(durations)
+        durations_after[source] = source_duration
+        durations_after[target] = durations[target] + added + service
+        score = _score(durations_after, shift)
+        if score < current - 1e-6 and (best is None or score < best[0]):
+            best = (score, target)
+
+    if best is None:
+        return None
+
+    target = best[1]
+    new_target = _order(costs, depot_rows[target], routes[target] + [row])
+    return target, _order(costs, depot_rows[source], remaining), new_target
+
+
+def _order(costs, depot, route):
+    """
+    This function orders one vehicle's hospitals into a tour from and back to its depot.
+    """
+    if len(route) <= 1:
+        return list(route)
+    rows = [depot] + list(route)
+    order = order_stops(
+        costs[np.ix_(rows, rows)], start=0, return_to_start=True, time_budget=0.05
+    )
+    return [rows[i] for i in order[1:]]
+
+
+def _duration(costs, depot, route, service):
+    if not route:
+        return 0.0
+    stops = [depot] + list(route)
+    return tour_cost(costs[np.ix_(stops, stops)], range(len(stops)), True) + service * len(route)
+
+
+def _score(durations, shift, unassigned=0):
+    durations = np.asarray(durations)
+    overtime = np.maximum(durations - shift, 0).sum()
+    return (
+        durations.sum()
+        + OVERTIME_PENALTY * overtime
+        + BALANCE_WEIGHT * durations.max()
+        + OVERTIME_PENALTY * unassigned * shift.max()
+    )
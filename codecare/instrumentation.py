@@ -0,0 +1,297 @@
+"""
+This module measures where the time goes in the routing engine and the data pipeline.
+
+Instrumentation is off by default and then costs next to nothing: stage() hands out one shared
+empty context manager and the counters are skipped. It is turned on with the CODECARE_METRICS
+environment variable (or enable()):
+
+    CODECARE_METRICS=1                 keep the measurements in memory (see snapshot())
+    CODECARE_METRICS=metrics.jsonl     also append every measurement to that file as JSON lines
+    CODECARE_METRICS_MEMORY=1          also trace the peak Python memory of every stage
+                                       (with tracemalloc, which slows the program down)
+    CODECARE_PROFILE=stacks.txt        sample the call stack of every outermost stage and
+                                       append the counts in the "folded" format flame graph
+                                       tools read
+
+Stages record their wall and CPU time and the peak memory of the process; counters add up
+numbers like the nodes the A* searches expanded. The routing service reports snapshot() on
+GET /metrics.
+"""
+
+import collections  # for the counters and the recent events
+import contextlib  # for the stage context manager
+import json  # for the JSON lines
+import os  # for the environment variables
+import sys  # for sampling the call stacks
+import threading  # for the locks and the sampling thread
+import time  # for the timers
+import tracemalloc  # for the peak memory of a stage
+
+try:
+    import resource  # peak memory of the process (not on Windows)
+except ImportError:
+    resource = None
+
+# Whether measurements are recorded; read by the hot paths before doing any work
+ENABLED = False
+
+# Number of recent events kept in memory
+MAX_EVENTS = 10_000
+
+_lock = threading.Lock()
+_local = threading.local()
+_counters = collections.Counter()
+_stages = {}
+_events = collections.deque(maxlen=MAX_EVENTS)
+_output = None
+_trace_memory = False
+_profile_path = None
+
+# The context manager stage() returns while instrumentation is off
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enable(output_path=None, trace_memory=False, profile_path=None):
+    """
+    This function turns instrumentation on. Measurements are appended to output_path (as
+    JSON lines) if it is given; trace_memory traces the peak memory of every stage and
+    profile_path samples the call stacks of the outermost stages into that file.
+    """
+    global ENABLED, _output, _trace_memory, _profile_path
+    with _lock:
+        if _output is not None:
+            _output.close()
+        _output = open(output_path, "a") if output_path else None
+        _trace_memory = trace_memory
+        _profile_path = profile_path
+        ENABLED = True
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    This function turns instrumentation off (the measurements so far are kept).
+    """
+    global ENABLED, _output
+    with _lock:
+        ENABLED = False
+        if _output is not None:
+            _output.close()
+            _output = None
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    """
+    This function forgets every measurement.
+    """
+    with _lock:
+        _counters.clear()
+        _stages.clear()
+        _events.clear()
+
+
+def stage(name, **labels):
+    """
+    This function returns a context manager that measures the code inside it as the stage
+    name, e.g. `with stage("read_data"): ...`. labels are added to the recorded event.
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _measure(name, labels)
+
+
+def count(name, n=1):
+    """
+    This function adds n to the counter name.
+    """
+    if ENABLED:
+        with _lock:
+            _counters[name] += n
+
+
+def count_many(counts):
+    """
+    This function adds a {counter name: n} dict to the counters at once.
+    """
+    if ENABLED:
+        with _lock:
+            _counters.update(counts)
+
+
+def snapshot():
+    """
+    This function returns the counters and, for every stage, how often it ran and its
+    total and largest wall and CPU times and largest peak memory.
+    """
+    with _lock:
+        return {
+            "enabled": ENABLED,
+            "counters": dict(_counters),
+            "stages": {name: dict(summary) for name, summary in _stages.items()},
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+
+
+def events():
+    """
+    This function returns the most recent events (one dict per finished stage).
+    """
+    with _lock:
+        return list(_events)
+
+
+def export_jsonl(path):
+    """
+    This function writes the recent events and a final snapshot to path as JSON lines.
+    """
+    with open(path, "w") as f:
+        for event in events():
+            f.write(json.dumps(event) + "\n")
+        f.write(json.dumps({"type": "snapshot", **snapshot()}) + "\n")
+
+
+@contextlib.contextmanager
+def _measure(name, labels):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    outermost = not stack
+
+    # The peak memory of the enclosing stage so far, before this stage resets it
+    tracing = _trace_memory and tracemalloc.is_tracing()
+    if tracing:
+        if stack:
+            stack[-1]["traced_peak"] = max(
+                stack[-1]["traced_peak"], tracemalloc.get_traced_memory()[1]
+            )
+        tracemalloc.reset_peak()
+    frame = {"traced_peak": 0}
+    stack.append(frame)
+
+    profiler = None
+    if outermost and _profile_path:
+        profiler = SamplingProfiler(_profile_path)
+        profiler.start()
+
+    started_wall = time.perf_counter()
+    started_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - started_wall
+        cpu = time.thread_time() - started_cpu
+        if profiler is not None:
+            profiler.stop()
+
+        stack.pop()
+        event = {
+            "type": "stage",
+            "name": name,
+            "time": time.time(),
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+        if tracing:
+            traced_peak = max(frame["traced_peak"], tracemalloc.get_traced_memory()[1])
+            event["traced_peak_mb"] = traced_peak / 2**20
+            if stack:
+                stack[-1]["traced_peak"] = max(stack[-1]["traced_peak"], traced_peak)
+        if labels:
+            event["labels"] = labels
+        _record(event)
+
+
+def _record(event):
+    with _lock:
+        summary = _stages.get(event["name"])
+        if summary is None:
+            summary = _stages[event["name"]] = {
+                "count": 0,
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "max_wall_seconds": 0.0,
+                "max_peak_mb": 0.0,
+            }
+        summary["count"] += 1
+        summary["wall_seconds"] += event["wall_seconds"]
+        summary["cpu_seconds"] += event["cpu_seconds"]
+        summary["max_wall_seconds"] = max(summary["max_wall_seconds"], event["wall_seconds"])
+        peak = event.get("traced_peak_mb", event["peak_rss_mb"]) or 0.0
+        summary["max_peak_mb"] = max(summary["max_peak_mb"], peak)
+
+        _events.append(event)
+        if _output is not None:
+            _output.write(json.dumps(event) + "\n")
+            _output.flush()
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler: a background thread looks at the call stack of the thread that
+    started it every interval seconds and counts the stacks it sees. stop() appends the
+    counts to output_path in the folded format ("outer;inner;innermost count" per line).
+    """
+
+    def __init__(self, output_path, interval=0.005):
+        self.output_path = output_path
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+        with _lock, open(self.output_path, "a") as f:
+            for stack, samples in self.samples.most_common():
+                f.write(f"{stack} {samples}\n")
+        return self.samples
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if names:
+                self.samples[";".join(reversed(names))] += 1
+
+
+# Turn instrumentation on from the environment
+_setting = os.environ.get("CODECARE_METRICS", "")
+if _setting not in ("", "0") or os.environ.get("CODECARE_PROFILE"):
+    enable(
+        output_path=_setting if _setting not in ("", "0", "1") else None,
+        trace_memory=os.environ.get("CODECARE_METRICS_MEMORY") == "1",
+        profile_path=os.environ.get("CODECARE_PROFILE") or None,
+    )
@@ -0,0 +1,214 @@
+"""
+This module draws routes and hospitals on a folium map without writing every road node of the
+route into the page.
+
+A route through many hospitals has tens of thousands of road nodes, far more than can be seen
+on screen. Before it is drawn, the route is simplified with the Douglas-Peucker algorithm, with
+a tolerance of about one pixel at the zoom level the map opens at (plus a few levels of zooming
+in), and the coordinates are rounded to the precision that tolerance needs. The route is then
+added as one GeoJSON layer and the hospitals as one clustered marker layer, whose markers are
+created in the browser from a plain list of coordinates. So the size of the page and the time
+to write it depend on how much detail can be seen, not on the length of the route. The Leaflet
+and marker cluster scripts are linked from their CDN by folium, so the browser downloads them
+once and reuses them for every map.
+
+The points are (latitude, longitude) pairs, in the order folium uses.
+"""
+
+import math  # for the zoom levels
+import time  # for timing the render
+import numpy as np  # for the simplification
+import folium  # for the map
+from folium.plugins import FastMarkerCluster  # for clustering the hospitals
+
+# Size of one map tile in pixels
+TILE_SIZE = 256
+
+# Creates the hospital markers in the browser from [latitude, longitude, popup] rows
+MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: "info-sign", markerColor: "red", prefix: "glyphicon"});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
+
+def simplify_line(points, tolerance):
+    """
+    This function simplifies a line with the Douglas-Peucker algorithm and returns the
+    indices of the points to keep (the first and last point are always kept). No removed
+    point is further than tolerance from the simplified line. points is an (n, 2) array in
+    the same unit as tolerance.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Split at the furthest point until every part is close enough to its straight line
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start = points[first]
+        segment = points[last] - start
+        between = points[first + 1 : last] - start
+        length2 = segment @ segment
+        if length2 > 0:
+            t = np.clip(between @ segment / length2, 0.0, 1.0)
+            between = between - t[:, None] * segment
+        distances = np.hypot(between[:, 0], between[:, 1])
+
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+
+    return np.flatnonzero(keep)
+
+
+def fit_zoom(points, width=1000, height=700):
+    """
+    This function returns the (fractional) zoom level at which all points fit in a map of
+    width x height pixels.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    lat_span = np.ptp(_mercator_y(points[:, 0]))
+    lon_span = np.ptp(points[:, 1]) / 360
+    zooms = [math.log2(width / TILE_SIZE / lon_span) if lon_span > 0 else 18.0]
+    if lat_span > 0:
+        zooms.append(math.log2(height / TILE_SIZE / lat_span))
+    return float(np.clip(min(zooms), 0, 18))
+
+
+def zoom_tolerance(zoom, latitude, pixels=1.0):
+    """
+    This function returns how many degrees of latitude pixels pixels are at a zoom level,
+    around a latitude.
+    """
+    return pixels * 360 * abs(math.cos(math.radians(latitude))) / (TILE_SIZE * 2**zoom)
+
+
+def simplify_route(points, zoom, pixels=1.0):
+    """
+    This function simplifies a route of (latitude, longitude) points for a zoom level, and
+    rounds the kept points to the precision the tolerance needs. It returns the kept points
+    as a list of [latitude, longitude].
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return []
+
+    # Degrees of longitude are shorter than degrees of latitude away from the equator
+    latitude = float(np.mean(points[:, 0]))
+    projected = np.column_stack(
+        [points[:, 0], points[:, 1] * math.cos(math.radians(latitude))]
+    )
+    tolerance = max(zoom_tolerance(zoom, latitude, pixels), 1e-7)
+
+    kept = points[simplify_line(projected, tolerance)]
+    decimals = int(np.clip(math.ceil(-math.log10(tolerance / 4)), 1, 7))
+    return np.round(kept, decimals).tolist()
+
+
+def route_geojson(points, properties=None):
+    """
+    This function returns a route as a GeoJSON feature (which has its coordinates as
+    longitude, latitude).
+    """
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [[lon, lat] for lat, lon in points],
+        },
+        "properties": dict(properties or {}),
+    }
+
+
+def render_route_map(
+    routes,
+    markers,
+    output_path="hospital_routes.html",
+    width=1000,
+    height=700,
+    extra_zoom=2,
+    pixels=1.0,
+):
+    """
+    This function draws routes and markers on a map and saves it to output_path.
+
+    routes is a list of (points, color) with the points of each route as (latitude,
+    longitude), and markers a list of (latitude, longitude, popup html). The routes are
+    simplified for the zoom the map opens at plus extra_zoom levels, so zooming in a few
+    times still shows them without visible corners. It returns a summary with the number of
+    route points before and after simplifying, the zoom and the seconds the render took.
+    """
+    started = time.perf_counter()
+    all_points = [point for points, _ in routes for point in points]
+    all_points += [(lat, lon) for lat, lon, _ in markers]
+    if not all_points:
+        raise ValueError("Nothing to draw")
+    all_points = np.asarray(all_points, dtype=np.float64)
+
+    zoom = fit_zoom(all_points, width, height)
+    route_map = folium.Map(
+        location=all_points.mean(axis=0).tolist(), zoom_start=int(zoom)
+    )
+
+    points_in = points_out = 0
+    features = []
+    for points, color in routes:
+        simplified = simplify_route(points, zoom + extra_zoom, pixels)
+        points_in += len(points)
+        points_out += len(simplified)
+        if len(simplified) >= 2:
+            features.append(route_geojson(simplified, {"color": color}))
+
+    if features:
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            name="Routes",
+            style_function=lambda feature: {
+                "color": feature["properties"]["color"],
+                "weight": 5,
+                "opacity": 0.8,
+            },
+            tooltip="Route",
+        ).add_to(route_map)
+
+    if markers:
+        FastMarkerCluster(
+            [[round(lat, 6), round(lon, 6), popup] for lat, lon, popup in markers],
+            callback=MARKER_CALLBACK,
+            name="Hospitals",
+        ).add_to(route_map)
+
+    south, west = all_points.min(axis=0).tolist()
+    north, east = all_points.max(axis=0).tolist()
+    route_map.fit_bounds([[south, west], [north, east]])
+    route_map.save(output_path)
+
+    return {
+        "points": points_in,
+        "points_drawn": points_out,
+        "zoom": zoom,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def _mercator_y(latitude):
+    """
+    This function returns the web mercator y of latitudes, as a share of the map height.
+    """
+    latitude = np.radians(np.clip(latitude, -85.0511, 85.0511))
+    return np.log(np.tan(np.pi / 4 + latitude / 2)) / (2 * np.pi)
@@ -0,0 +1,250 @@
+"""
+This module keeps the attributes of the road nodes (risk score, coordinates and the details of
+the hospital at the node, if any) in arrays instead of one dict per node.
+
+construct_graph gives every node of the NetworkX graph a dict with eight entries, although
+almost every road node has no hospital and a risk score of 0. NodeAttributeStore keeps the
+numbers every node has (latitude, longitude, risk_score) in one NumPy array each, and the
+hospital details only for the nodes that have a hospital: a sorted array of those nodes'
+positions, their risk class, and the text columns as category codes into one array of the
+distinct values (so a city name is stored once, however many hospitals are in it). Lookups
+take arrays of node ids and return arrays, with NaN (numbers) or None (text) for nodes
+without a hospital.
+"""
+
+import json  # for the metadata file
+import os  # for building the file paths
+import numpy as np  # for the arrays
+import pandas as pd  # for reading the node DataFrame
+
+# Bumped whenever the on-disk layout changes
+FORMAT_VERSION = 1
+
+# Attributes every node has
+NODE_FIELDS = {"latitude": np.float64, "longitude": np.float64, "risk_score": np.float32}
+
+# Attributes only nodes with a hospital have
+HOSPITAL_TEXT_FIELDS = ["hospital_name", "address", "city", "hospital_subtype"]
+HOSPITAL_NUMBER_FIELDS = {"risk_class": np.float32}
+
+
+class NodeAttributeStore:
+    """
+    The attributes of a set of nodes, by node id, in columnar arrays.
+    """
+
+    def __init__(self, node_ids, columns, hospital_rows, hospital_columns, categories):
+        self.node_ids = node_ids
+        self.columns = columns
+        self.hospital_rows = hospital_rows
+        self.hospital_columns = hospital_columns
+        self.categories = categories
+
+    @classmethod
+    def from_frame(cls, nodes: pd.DataFrame, node_ids=None):
+        """
+        This function builds the store from the node DataFrame returned by read_data (the
+        first row of duplicated node ids is kept, like construct_graph). If node_ids is given
+        (e.g. a RoadGraph's), the store has exactly those nodes; nodes missing from the
+        DataFrame get NaN coordinates and a risk score of 0.
+        """
+        nodes = nodes.drop_duplicates(subset="# index")
+        frame_ids = nodes["# index"].to_numpy(dtype=np.int64)
+        if node_ids is None:
+            node_ids = np.sort(frame_ids)
+        node_ids = np.ascontiguousarray(node_ids, dtype=np.int64)
+
+        # Position of every DataFrame row in node_ids (rows of other nodes are left out)
+        positions = np.searchsorted(node_ids, frame_ids)
+        known = positions < len(node_ids)
+        known[known] = node_ids[positions[known]] == frame_ids[known]
+        nodes, positions = nodes[known], positions[known]
+
+        columns = {}
+        for name, dtype in NODE_FIELDS.items():
+            fill = 0 if name == "risk_score" else np.nan
+            values = np.full(len(node_ids), fill, dtype=dtype)
+            if name in nodes:
+                values[positions] = nodes[name].to_numpy(dtype=np.float64)
+            if name == "risk_score":
+                values[np.isnan(values)] = 0
+            columns[name] = values
+
+        # Only the rows with a hospital go into the hospital table, sorted by position
+        if "hospital_name" in nodes:
+            has_hospital = nodes["hospital_name"].notna().to_numpy()
+        else:
+            has_hospital = np.zeros(len(nodes), dtype=bool)
+        hospitals = nodes[has_hospital]
+        order = np.argsort(positions[has_hospital], kind="stable")
+        hospitals = hospitals.iloc[order]
+        hospital_rows = positions[has_hospital][order].astype(np.int32)
+
+        hospital_columns = {}
+        categories = {}
+        for name, dtype in HOSPITAL_NUMBER_FIELDS.items():
+            hospital_columns[name] = (
+                hospitals[name].to_numpy(dtype=dtype)
+                if name in hospitals
+                else np.full(len(hospitals), np.nan, dtype=dtype)
+            )
+        for name in HOSPITAL_TEXT_FIELDS:
+            values = hospitals[name] if name in hospitals else pd.Series([None] * len(hospitals))
+            codes, uniques = pd.factorize(values.astype(object))
+            hospital_columns[name] = codes.astype(np.int32)
+            categories[name] = np.asarray(uniques, dtype=str)
+
+        return cls(node_ids, columns, hospital_rows, hospital_columns, categories)
+
+    @property
+    def fields(self):
+        return list(self.columns) + list(self.hospital_columns)
+
+    @property
+    def num_hospitals(self):
+        return len(self.hospital_rows)
+
+    @property
+    def nbytes(self):
+        arrays = [self.node_ids, self.hospital_rows]
+        arrays += list(self.columns.values()) + list(self.hospital_columns.values())
+        total = sum(array.nbytes for array in arrays)
+        return total + sum(array.nbytes for array in self.categories.values())
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node):
+        i = np.searchsorted(self.node_ids, node)
+        return bool(i < len(self.node_ids) and self.node_ids[i] == node)
+
+    def positions_of(self, nodes):
+        """
+        This function returns the positions of node ids in the store, raising KeyError for
+        a node it doesn't have.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, nodes)
+        found = positions < len(self.node_ids)
+        found[found] = self.node_ids[positions[found]] == nodes[found]
+        if not found.all():
+            raise KeyError(nodes[~found][0].item())
+        return positions
+
+    def get(self, nodes, field):
+        """
+        This function returns one attribute of an array of node ids, as an array. Hospital
+        attributes are NaN (numbers) or None (text) for nodes without a hospital.
+        """
+        positions = self.positions_of(nodes)
+        if field in self.columns:
+            return self.columns[field][positions]
+        if field not in self.hospital_columns:
+            raise KeyError(field)
+
+        rows, found = self._hospital_rows_of(positions)
+        column = self.hospital_columns[field]
+        if field in self.categories:
+            values = np.full(len(positions), None, dtype=object)
+            codes = column[rows[found]]
+            text = self.categories[field].astype(object)
+            if len(text):
+                values[found] = np.where(codes >= 0, text[np.maximum(codes, 0)], None)
+            return values
+
+        values = np.full(len(positions), np.nan, dtype=column.dtype)
+        values[found] = column[rows[found]]
+        return values
+
+    def node(self, node):
+        """
+        This function returns all attributes of one node as a dict, like G.nodes[node] of the
+        NetworkX graph.
+        """
+        values = {}
+        for field in self.fields:
+            value = self.get([node], field)[0]
+            values[field] = value.item() if isinstance(value, np.generic) else value
+        return values
+
+    def hospitals(self):
+        """
+        This function returns the nodes with a hospital as a DataFrame, one row per node,
+        with all attributes and the node id in "# index".
+        """
+        nodes = self.node_ids[self.hospital_rows]
+        table = pd.DataFrame({"# index": nodes})
+        for field in self.fields:
+            table[field] = self.get(nodes, field)
+        return table
+
+    def hospital_nodes(self):
+        """
+        This function returns {hospital name: [node ids]} of all hospitals.
+        """
+        lookup = {}
+        names = self.get(self.node_ids[self.hospital_rows], "hospital_name")
+        for node, name in zip(self.node_ids[self.hospital_rows].tolist(), names):
+            lookup.setdefault(name, []).append(node)
+        return lookup
+
+    def save(self, directory):
+        """
+        This function writes the arrays as .npy files (plus a small metadata file) into a
+        directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        arrays = {"node_ids": self.node_ids, "hospital_rows": self.hospital_rows}
+        arrays.update({f"node_{name}": values for name, values in self.columns.items()})
+        arrays.update(
+            {f"hospital_{name}": values for name, values in self.hospital_columns.items()}
+        )
+        arrays.update(
+            {f"categories_{name}": values for name, values in self.categories.items()}
+        )
+        for name, values in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), values)
+
+        meta = {
+            "format_version": FORMAT_VERSION,
+            "node_fields": list(self.columns),
+            "hospital_fields": list(self.hospital_columns),
+            "text_fields": list(self.categories),
+        }
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        This function loads a store saved with save(), memory-mapped by default.
+        """
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported attribute format {meta['format_version']} in {directory}"
+            )
+
+        mmap_mode = "r" if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        return cls(
+            load_array("node_ids"),
+            {name: load_array(f"node_{name}") for name in meta["node_fields"]},
+            load_array("hospital_rows"),
+            {name: load_array(f"hospital_{name}") for name in meta["hospital_fields"]},
+            {name: load_array(f"categories_{name}") for name in meta["text_fields"]},
+        )
+
+    def _hospital_rows_of(self, positions):
+        """
+        This function returns, for node positions, their row in the hospital table and
+        whether they have one.
+        """
+        rows = np.searchsorted(self.hospital_rows, positions)
+        found = rows < len(self.hospital_rows)
+        found[found] = self.hospital_rows[rows[found]] == positions[found]
+        return rows, found
@@ -0,0 +1,316 @@
+"""
+This module runs the data analysis steps as one pipeline instead of script by script.
+
+Each step (stage) is a function from the data_analysis scripts. The DataFrames go from one
+stage to the next in memory, without writing and re-reading CSV files in between; only the
+final outputs (mo_nodes_with_risk.csv, mo_data.csv, the model and its plots) are written.
+Every stage gets a fingerprint made of its input files, the outputs of the stages it depends
+on, its parameters and the code of its function. When a stage's fingerprint is the same as in
+the last run, its saved result is used instead of running it again, so after a small data
+update only the stages that are affected run. Stages that don't depend on each other run at
+the same time in a thread pool.
+
+Run it from the root of the repository with: python -m codecare.pipeline
+"""
+
+import argparse  # for the command line options
+import hashlib  # for the fingerprints
+import inspect  # for finding the code of each stage
+import json  # for the pipeline state
+import os  # for the file paths
+import threading  # for loading saved results once
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import joblib  # for saving the stage results
+import pandas as pd  # for hashing DataFrames
+from codecare.data_cache import read_csv_cached, file_digest
+from codecare import instrumentation  # stage timers
+
+# The folders at the root of the repository
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_DIR = os.path.join(ROOT, "data")
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    run is called with the results of the stages named in inputs, then the DataFrames of the
+    CSV files in files, then the params as keyword arguments. key_files are files the stage
+    reads by itself, which only count for its fingerprint. save, if given, is called with
+    the result to write the stage's final outputs, which are the paths listed in artifacts.
+    """
+
+    def __init__(
+        self,
+        name,
+        run,
+        inputs=(),
+        files=(),
+        params=None,
+        save=None,
+        artifacts=(),
+        key_files=(),
+    ):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.files = list(files)
+        self.params = dict(params or {})
+        self.save = save
+        self.artifacts = list(artifacts)
+        self.key_files = list(key_files)
+
+
+class Pipeline:
+    """
+    A set of stages, with the state of the last run kept in state_dir.
+    """
+
+    def __init__(self, stages, state_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir or os.path.join(DATA_DIR, ".pipeline")
+
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name!r} needs unknown stage {name!r}")
+
+        self._results = {}
+        self._fingerprints = {}
+        self._locks = {name: threading.Lock() for name in self.stages}
+
+    def run(self, workers=None, force=()):
+        """
+        This function runs every stage that is out of date (and the ones named in force) and
+        returns {stage name: "ran" or "skipped"}.
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        state = self._load_state()
+        self._results = {}
+        self._fingerprints = {}
+
+        status = {}
+        pending = dict(self.stages)
+        running = {}
+
+        try:
+            self._run_stages(pending, running, status, state, workers, force)
+        finally:
+            # Even after a failure, the stages that finished don't have to run again
+            self._save_state(state)
+        return status
+
+    def _run_stages(self, pending, running, status, state, workers, force):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                # Start every stage whose inputs are all done
+                for name, stage in list(pending.items()):
+                    if all(i in status for i in stage.inputs):
+                        del pending[name]
+                        running[
+                            pool.submit(self._run_stage, stage, state, name in force)
+                        ] = name
+
+                if not running:
+                    raise ValueError("The stages depend on each other in a cycle")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status[name] = future.result()
+                    print(f"{name}: {status[name]}")
+
+    def result(self, name):
+        """
+        This function returns the result of a stage from the last run (loading it from disk
+        if the stage was skipped).
+        """
+        with self._locks[name]:
+            if name not in self._results:
+                self._results[name] = joblib.load(self._result_path(name))
+            return self._results[name]
+
+    def _run_stage(self, stage, state, force):
+        key = self._stage_key(stage)
+        last = state.get(stage.name, {})
+
+        if (
+            not force
+            and last.get("key") == key
+            and os.path.exists(self._result_path(stage.name))
+            and all(os.path.exists(path) for path in stage.artifacts)
+        ):
+            self._fingerprints[stage.name] = last["fingerprint"]
+            return "skipped"
+
+        with instrumentation.stage(f"pipeline.{stage.name}"):
+            args = [self.result(name) for name in stage.inputs]
+            args += [read_csv_cached(path) for path in stage.files]
+            result = stage.run(*args, **stage.params)
+
+        with self._locks[stage.name]:
+            self._results[stage.name] = result
+        joblib.dump(result, self._result_path(stage.name))
+        if stage.save is not None:
+            stage.save(result)
+
+        # Stages after this one only have to run again if the result really changed
+        fingerprint = _result_fingerprint(result, key)
+        self._fingerprints[stage.name] = fingerprint
+        state[stage.name] = {"key": key, "fingerprint": fingerprint}
+        return "ran"
+
+    def _stage_key(self, stage):
+        """
+        This function fingerprints everything a stage's result depends on.
+        """
+        digest = hashlib.sha256(stage.name.encode())
+        digest.update(file_digest(inspect.getsourcefile(stage.run)).encode())
+        digest.update(repr(sorted(stage.params.items())).encode())
+        for name in stage.inputs:
+            digest.update(self._fingerprints[name].encode())
+        for path in stage.files + stage.key_files:
+            digest.update(file_digest(path).encode())
+        return digest.hexdigest()
+
+    def _result_path(self, name):
+        return os.path.join(self.state_dir, f"{name}.joblib")
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.state_dir, "state.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        with open(os.path.join(self.state_dir, "state.json"), "w") as f:
+            json.dump(state, f, indent=2)
+
+
+def _result_fingerprint(result, key):
+    """
+    This function hashes a DataFrame result by its contents; any other result is
+    fingerprinted by the key of the stage that made it.
+    """
+    if not isinstance(result, pd.DataFrame):
+        return key
+    digest = hashlib.sha256(repr(list(result.columns)).encode())
+    try:
+        digest.update(pd.util.hash_pandas_object(result, index=True).to_numpy().tobytes())
+    except TypeError:
+        # Columns holding lists or dicts can't be hashed by pandas
+        return key
+    return digest.hexdigest()
+
+
+def codecare_stages(data_dir=DATA_DIR, state="MO", states=None):
+    """
+    This function returns the stages of the CodeCare data analysis, in the order of the
+    README: clean the hospital data, then the correlations, the risk model and the matching
+    of the hospitals to road nodes, which the risk of the road nodes is merged from.
+
+    state is the state the risk model is tested on and the routes are planned in. If states
+    is given, the per-state steps run for each of those states instead (in parallel worker
+    processes, see data_analysis/process_states.py).
+    """
+    from codecare.data_analysis.clean_hospital_data import clean_hospital_data
+    from codecare.data_analysis.correlation_analysis import risk_score_correlations
+    from codecare.data_analysis.create_mo_dataset import snap_state_hospitals
+    from codecare.data_analysis.process_risk_nodes import merge_risk_nodes
+    from codecare.data_analysis.process_states import process_states, state_file
+    from codecare.risk_score_model import train_risk_model, save_plots
+
+    codecare_dir = os.path.dirname(os.path.abspath(__file__))
+    model_path = os.path.join(ROOT, "models", "risk_score_model.joblib")
+    images_dir = os.path.join(codecare_dir, "images")
+    nodes_path = state_file(data_dir, state, "nodes")
+
+    def save_correlations(result):
+        _, suitable_vars = result
+        print(f"Variables with strong correlation with Risk Score: {suitable_vars}")
+
+    def save_model(result):
+        model, y_test, y_pred, metrics = result
+        print(f"RMSE: {metrics['rmse']}")
+        print(f"R^2: {metrics['r_squared']}")
+        save_plots(model, y_test, y_pred, images_dir)
+        joblib.dump(model, model_path)
+
+    stages = [
+        Stage(
+            "clean_hospital_data",
+            clean_hospital_data,
+            files=[os.path.join(data_dir, "codecare_data.csv")],
+        ),
+        Stage(
+            "correlation_analysis",
+            risk_score_correlations,
+            inputs=["clean_hospital_data"],
+            params={"threshold": 0.25},
+            save=save_correlations,
+        ),
+        Stage(
+            "risk_score_model",
+            train_risk_model,
+            inputs=["clean_hospital_data"],
+            params={"test_state": state},
+            save=save_model,
+            artifacts=[model_path],
+        ),
+    ]
+
+    if states is not None:
+        road_files = [
+            state_file(data_dir, s, name) for s in states for name in ("nodes", "edges")
+        ]
+        return stages + [
+            Stage(
+                "process_states",
+                process_states,
+                inputs=["clean_hospital_data"],
+                params={"states": list(states), "data_dir": data_dir},
+                artifacts=[os.path.join(data_dir, "graphs", "index.json")],
+                key_files=road_files,
+            )
+        ]
+
+    return stages + [
+        Stage(
+            "create_mo_dataset",
+            snap_state_hospitals,
+            inputs=["clean_hospital_data"],
+            params={"nodes_path": nodes_path, "state": state, "threshold_km": 100},
+            key_files=[nodes_path],
+            save=lambda df: df.to_csv(state_file(data_dir, state, "nodes_with_risk")),
+            artifacts=[state_file(data_dir, state, "nodes_with_risk")],
+        ),
+        Stage(
+            "process_risk_nodes",
+            merge_risk_nodes,
+            inputs=["create_mo_dataset"],
+            files=[nodes_path],
+            save=lambda df: df.to_csv(state_file(data_dir, state, "data")),
+            artifacts=[state_file(data_dir, state, "data")],
+        ),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the CodeCare data pipeline.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--state", default="MO", help="state to test and route in")
+    parser.add_argument(
+        "--states", nargs="*", default=None, help="run the per-state steps for these states"
+    )
+    parser.add_argument(
+        "--force", nargs="*", default=[], help="stages to run even if up to date"
+    )
+    args = parser.parse_args()
+
+    pipeline = Pipeline(
+        codecare_stages(args.data_dir, args.state, args.states),
+        os.path.join(args.data_dir, ".pipeline"),
+    )
+    pipeline.run(workers=args.workers, force=args.force)
@@ -2,10 +2,13 @@
 import xgboost as xgb
 import os  # for obtaining paths to export the image files
 from sklearn.metrics import mean_squared_error, r2_score
-import pandas as pd  # Read CSV
 import numpy as np  # RMSE calculation
 import joblib  # For exporting the XGBoost Model
-import matplotlib.pyplot as plt  # For plotting
+import argparse  # For choosing the test state
+import json  # For the state of a checkpointed training
+import pandas as pd  # For reading the CSV in chunks
+from codecare.data_cache import read_csv_cached  # Binary copy of the CSV
+from matplotlib.figure import Figure  # For plotting (safe to use from worker threads)
 
 # Create the independent and dependent variables
 X_VARS = [
@@ -22,82 +25,374 @@ X_VARS = [
 
 Y_VAR = "risk_score"
 
-# Read DataFrame
-codecare_df = pd.read_csv("../data/codecare_data.csv")
-
-# MO rows, because missouri will be the test data
-mo_rows = codecare_df[codecare_df["state"] == "MO"]
-non_mo_rows = codecare_df[codecare_df["state"] != "MO"]
-
-# Features and target
-X_train = non_mo_rows[X_VARS]
-y_train = non_mo_rows[Y_VAR]
-
-X_test = mo_rows[X_VARS]
-y_test = mo_rows[Y_VAR]
-
-# Initialize XGBoost Regressor
-model = xgb.XGBRegressor(
-    objective="reg:squarederror",  # for regression
-    n_estimators=250,  # number of trees
-    learning_rate=0.1,  # step size
-    max_depth=3,  # depth of each tree
-    subsample=0.8,  # fraction of samples for each tree
-    colsample_bytree=0.8,  # fraction of features per tree
-    random_state=42,
-)
-
-# Train the model
-model.fit(X_train, y_train)
-
-# Make predictions
-y_pred = model.predict(X_test)
-
-# Evaluate performance
-mse = mean_squared_error(y_test, y_pred)
-r_squared = r2_score(y_test, y_pred)
-rmse = np.sqrt(mse)
-print(f"RMSE: {rmse}")
-print(f"R^2: {r_squared}")
-
-# Feature importance
-xgb.plot_importance(model, max_num_features=10)  # show top 10 features
-plt.tight_layout()
-plt.savefig(os.path.join(os.getcwd(), "images", "feature_importance.png"))
-plt.close()
-
-# Predicted vs Actual Plot
-plt.figure(figsize=(6, 6))
-plt.scatter(y_test, y_pred, alpha=0.7)
-plt.plot(
-    [y_test.min(), y_test.max()], [y_test.min(), y_test.max()], "r--", lw=2
-)  # perfect prediction line
-plt.xlabel("Actual risk_score")
-plt.ylabel("Predicted risk_score")
-plt.title("Predicted vs Actual risk_score")
-plt.grid(True)
-plt.tight_layout()
-plt.savefig(
-    os.path.join(os.getcwd(), "images", "predicted_vs_actual.png")
-)  # save as PNG
-plt.close()  # close figure to avoid overlap
-
-# Residual Distribution Plot
-residuals = y_test - y_pred
-plt.figure(figsize=(6, 4))
-plt.hist(residuals, bins=20, edgecolor="k", alpha=0.7)
-plt.xlabel("Residuals (Actual - Predicted)")
-plt.ylabel("Frequency")
-plt.title("Residual Distribution")
-plt.grid(True)
-plt.tight_layout()
-plt.savefig(
-    os.path.join(os.getcwd(), "images", "residual_distribution.png")
-)  # save as PNG
-plt.close()
-
-print("Plots saved as 'predicted_vs_actual.png' and 'residuals_distribution.png'")
-
-# Export the model for future use
-joblib.dump(model, "../models/risk_score_model.joblib")
-print("Model saved as 'risk_score_model.joblib'")
+# The folder this script is in, the data, image and model paths are relative to it
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def train_risk_model(codecare_df, test_state="MO"):
+    """
+    This function trains the XGBoost model on every state except test_state and evaluates
+    it on test_state. It returns the model, the test targets, the predictions and the
+    {"rmse", "r_squared"} metrics.
+    """
+    # Test rows (missouri by default) and the training rows of all other states
+    test_rows = codecare_df[codecare_df["state"] == test_state]
+    train_rows = codecare_df[codecare_df["state"] != test_state]
+
+    # Features and target
+    X_train = train_rows[X_VARS]
+    y_train = train_rows[Y_VAR]
+
+    X_test = test_rows[X_VARS]
+    y_test = test_rows[Y_VAR]
+
+    # Initialize XGBoost Regressor
+    model = xgb.XGBRegressor(
+        objective="reg:squarederror",  # for regression
+        n_estimators=250,  # number of trees
+        learning_rate=0.1,  # step size
+        max_depth=3,  # depth of each tree
+        subsample=0.8,  # fraction of samples for each tree
+        colsample_bytree=0.8,  # fraction of features per tree
+        random_state=42,
+    )
+
+    # Train the model
+    model.fit(X_train, y_train)
+
+    # Make predictions
+    y_pred = model.predict(X_test)
+
+    # Evaluate performance
+    mse = mean_squared_error(y_test, y_pred)
+    metrics = {"rmse": float(np.sqrt(mse)), "r_squared": float(r2_score(y_test, y_pred))}
+
+    return model, y_test, y_pred, metrics
+
+
+class CsvBatches(xgb.DataIter):
+    """
+    This class feeds a csv file to XGBoost chunk by chunk, so the whole file is never in
+    memory. Only the rows of one part are passed on: "train" (every state but test_state,
+    minus the holdout), "holdout" (every holdout_every-th of those rows, for early stopping)
+    or "test" (the rows of test_state).
+    """
+
+    def __init__(
+        self,
+        path,
+        part,
+        test_state="MO",
+        holdout_every=10,
+        chunksize=200_000,
+        cache_prefix=None,
+    ):
+        self.path = path
+        self.part = part
+        self.test_state = test_state
+        self.holdout_every = holdout_every
+        self.chunksize = chunksize
+        self._reader = None
+        self._row = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def chunks(self):
+        """
+        This function yields the (features, target) of each chunk of this part.
+        """
+        row = 0
+        for chunk in pd.read_csv(
+            self.path,
+            usecols=X_VARS + [Y_VAR, "state"],
+            dtype={name: np.float32 for name in X_VARS + [Y_VAR]},
+            chunksize=self.chunksize,
+        ):
+            rows = np.arange(row, row + len(chunk))
+            row += len(chunk)
+
+            in_test = (chunk["state"] == self.test_state).to_numpy()
+            in_holdout = ~in_test & (rows % self.holdout_every == 0)
+            if self.part == "test":
+                mask = in_test
+            elif self.part == "holdout":
+                mask = in_holdout
+            else:
+                mask = ~in_test & ~in_holdout
+
+            chunk = chunk[mask & chunk[Y_VAR].notna().to_numpy()]
+            if len(chunk):
+                yield chunk[X_VARS], chunk[Y_VAR]
+
+    def next(self, input_data):
+        if self._reader is None:
+            self._reader = self.chunks()
+        batch = next(self._reader, None)
+        if batch is None:
+            return False
+        input_data(data=batch[0], label=batch[1])
+        return True
+
+    def reset(self):
+        self._reader = None
+
+
+def train_risk_model_out_of_core(
+    csv_path,
+    test_state="MO",
+    nthread=None,
+    num_boost_round=250,
+    early_stopping_rounds=20,
+    holdout_every=10,
+    chunksize=200_000,
+    checkpoint_dir=None,
+    cache_dir=None,
+):
+    """
+    This function trains the same model as train_risk_model, but streams the csv file into
+    XGBoost's external-memory quantile DMatrix instead of loading it, so the memory used
+    doesn't grow with the length of the history. Every holdout_every-th training row is held
+    out for early stopping. With a checkpoint_dir, the model is saved every 10 rounds and a
+    later call with the same folder resumes from the last checkpoint, with the early stopping
+    picking up where it was. Once a training has finished, a later call reuses its model
+    instead of boosting on.
+
+    It returns the model as an XGBRegressor, the test targets, the predictions and the
+    metrics, like train_risk_model.
+    """
+    nthread = nthread or os.cpu_count() or 1
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(csv_path)), ".xgb")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    def batches(part):
+        return CsvBatches(
+            csv_path,
+            part,
+            test_state,
+            holdout_every,
+            chunksize,
+            cache_prefix=os.path.join(cache_dir, part),
+        )
+
+    # The training rows stay in XGBoost's on-disk cache, the holdout shares its bins
+    dtrain = xgb.ExtMemQuantileDMatrix(batches("train"), nthread=nthread, max_bin=256)
+    dholdout = xgb.ExtMemQuantileDMatrix(batches("holdout"), nthread=nthread, ref=dtrain)
+
+    # The same settings as the XGBRegressor in train_risk_model
+    params = {
+        "objective": "reg:squarederror",
+        "eval_metric": "rmse",
+        "tree_method": "hist",
+        "nthread": nthread,
+        "learning_rate": 0.1,
+        "max_depth": 3,
+        "subsample": 0.8,
+        "colsample_bytree": 0.8,
+        "seed": 42,
+    }
+
+    early_stopping = xgb.callback.EarlyStopping(
+        rounds=early_stopping_rounds, data_name="holdout", metric_name="rmse"
+    )
+    callbacks = [early_stopping]
+    booster = None
+    state = {"finished": False}
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        state = _training_state(checkpoint_dir)
+        if state["finished"]:
+            booster = xgb.Booster(model_file=os.path.join(checkpoint_dir, state["model"]))
+        else:
+            booster = _last_checkpoint(checkpoint_dir)
+        callbacks.append(
+            xgb.callback.TrainingCheckPoint(checkpoint_dir, name="risk_model", interval=10)
+        )
+
+    if not state["finished"]:
+        # Early stopping continues from the best holdout score of the checkpoint
+        best = _best_of(booster)
+        done = booster.num_boosted_rounds() if booster is not None else 0
+        if best is not None:
+            early_stopping.stopping_history = {"holdout": {"rmse": [best[1]]}}
+            early_stopping.best_scores = {"holdout": {"rmse": [best[1]]}}
+            early_stopping.current_rounds = done - best[0] - 1
+        if done < num_boost_round and early_stopping.current_rounds < early_stopping_rounds:
+            booster = xgb.train(
+                params,
+                dtrain,
+                num_boost_round=num_boost_round - done,
+                evals=[(dholdout, "holdout")],
+                callbacks=callbacks,
+                xgb_model=booster,
+                verbose_eval=False,
+            )
+            best = _best_of(booster)
+
+        # Keep the trees up to the best holdout score
+        if best is not None:
+            booster = booster[: best[0] + 1]
+            booster.set_attr(best_iteration=str(best[0]), best_score=str(best[1]))
+
+        if checkpoint_dir is not None:
+            # Named like TrainingCheckPoint's files: by the index of the last round
+            name = f"risk_model_{booster.num_boosted_rounds() - 1}.ubj"
+            booster.save_model(os.path.join(checkpoint_dir, name))
+            with open(os.path.join(checkpoint_dir, "risk_model_state.json"), "w") as f:
+                json.dump(
+                    {
+                        "finished": True,
+                        "model": name,
+                        "rounds": booster.num_boosted_rounds(),
+                        "best_iteration": None if best is None else best[0],
+                        "best_score": None if best is None else best[1],
+                    },
+                    f,
+                )
+
+    # Evaluate on the test state, which is small enough to keep in memory
+    booster.set_param({"nthread": nthread})
+    y_test, y_pred = [], []
+    for X, y in batches("test").chunks():
+        y_test.append(y)
+        y_pred.append(booster.inplace_predict(X.to_numpy(), validate_features=False))
+    y_test = pd.concat(y_test) if y_test else pd.Series(dtype=np.float32)
+    y_pred = np.concatenate(y_pred) if y_pred else np.empty(0, dtype=np.float32)
+
+    mse = mean_squared_error(y_test, y_pred)
+    metrics = {
+        "rmse": float(np.sqrt(mse)),
+        "r_squared": float(r2_score(y_test, y_pred)),
+        "rounds": booster.num_boosted_rounds(),
+    }
+
+    # The same type of model train_risk_model returns (and RiskScorer loads)
+    model = xgb.XGBRegressor(
+        objective="reg:squarederror",
+        n_estimators=booster.num_boosted_rounds(),
+        learning_rate=0.1,
+        max_depth=3,
+        subsample=0.8,
+        colsample_bytree=0.8,
+        random_state=42,
+    )
+    model.load_model(bytearray(booster.save_raw("ubj")))
+    return model, y_test, y_pred, metrics
+
+
+def _last_checkpoint(checkpoint_dir):
+    """
+    This function loads the checkpoint with the most rounds from checkpoint_dir, or returns
+    None if there is none.
+    """
+    rounds = []
+    for name in os.listdir(checkpoint_dir):
+        stem, _, _ = name.rpartition(".")
+        prefix, _, number = stem.rpartition("_")
+        if prefix == "risk_model" and number.isdigit():
+            rounds.append((int(number), name))
+    if not rounds:
+        return None
+    return xgb.Booster(model_file=os.path.join(checkpoint_dir, max(rounds)[1]))
+
+
+def _training_state(checkpoint_dir):
+    """
+    This function returns the state a finished training saved in checkpoint_dir, or
+    {"finished": False} if the training there hasn't finished.
+    """
+    try:
+        with open(os.path.join(checkpoint_dir, "risk_model_state.json")) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {"finished": False}
+    if not os.path.exists(os.path.join(checkpoint_dir, state.get("model", ""))):
+        return {"finished": False}
+    return state
+
+
+def _best_of(booster):
+    """
+    This function returns the (best iteration, best holdout score) early stopping recorded
+    in the booster, or None.
+    """
+    if booster is None or booster.attr("best_iteration") is None:
+        return None
+    return int(booster.attr("best_iteration")), float(booster.attr("best_score"))
+
+
+def save_plots(model, y_test, y_pred, images_dir):
+    """
+    This function saves the feature importance, predicted vs actual and residual plots.
+    """
+    # Feature importance
+    fig = Figure()
+    xgb.plot_importance(model, ax=fig.add_subplot(), max_num_features=10)  # show top 10 features
+    fig.tight_layout()
+    fig.savefig(os.path.join(images_dir, "feature_importance.png"))
+
+    # Predicted vs Actual Plot
+    fig = Figure(figsize=(6, 6))
+    ax = fig.add_subplot()
+    ax.scatter(y_test, y_pred, alpha=0.7)
+    ax.plot(
+        [y_test.min(), y_test.max()], [y_test.min(), y_test.max()], "r--", lw=2
+    )  # perfect prediction line
+    ax.set_xlabel("Actual risk_score")
+    ax.set_ylabel("Predicted risk_score")
+    ax.set_title("Predicted vs Actual risk_score")
+    ax.grid(True)
+    fig.tight_layout()
+    fig.savefig(
+        os.path.join(images_dir, "predicted_vs_actual.png")
+    )  # save as PNG
+
+    # Residual Distribution Plot
+    residuals = y_test - y_pred
+    fig = Figure(figsize=(6, 4))
+    ax = fig.add_subplot()
+    ax.hist(residuals, bins=20, edgecolor="k", alpha=0.7)
+    ax.set_xlabel("Residuals (Actual - Predicted)")
+    ax.set_ylabel("Frequency")
+    ax.set_title("Residual Distribution")
+    ax.grid(True)
+    fig.tight_layout()
+    fig.savefig(
+        os.path.join(images_dir, "residual_distribution.png")
+    )  # save as PNG
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the risk score model.")
+    parser.add_argument("--test-state", default="MO", help="state held out for testing")
+    parser.add_argument(
+        "--out-of-core", action="store_true", help="stream the csv instead of loading it"
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=200_000)
+    parser.add_argument(
+        "--checkpoint-dir", default=None, help="save and resume the training here"
+    )
+    args = parser.parse_args()
+
+    data_path = os.path.join(HERE, "..", "data", "codecare_data.csv")
+    if args.out_of_core:
+        model, y_test, y_pred, metrics = train_risk_model_out_of_core(
+            data_path,
+            args.test_state,
+            nthread=args.threads,
+            chunksize=args.chunksize,
+            checkpoint_dir=args.checkpoint_dir,
+        )
+    else:
+        # Read DataFrame
+        codecare_df = read_csv_cached(data_path)
+
+        model, y_test, y_pred, metrics = train_risk_model(codecare_df, args.test_state)
+    print(f"RMSE: {metrics['rmse']}")
+    print(f"R^2: {metrics['r_squared']}")
+
+    save_plots(model, y_test, y_pred, os.path.join(HERE, "images"))
+    print("Plots saved as 'predicted_vs_actual.png' and 'residuals_distribution.png'")
+
+    # Export the model for future use
+    joblib.dump(model, os.path.join(HERE, "..", "models", "risk_score_model.joblib"))
+    print("Model saved as 'risk_score_model.joblib'")
@@ -0,0 +1,153 @@
+"""
+This module scores new hospital data with the saved risk score model, without retraining it.
+
+The model is loaded once and kept in a RiskScorer. Scoring picks the model's feature columns
+(X_VARS, in the order the model was trained with) out of a DataFrame into one float32 array
+and predicts all rows at once with the booster's in-place prediction, which skips building a
+DMatrix and uses all CPU cores. Files bigger than memory are scored chunk by chunk with
+score_csv, which only reads the feature columns (and any columns to copy to the output) and
+reports how many rows per second were scored.
+
+Run it from the root of the repository with:
+python -m codecare.risk_scoring data/new_week.csv --output data/new_week_scored.csv
+"""
+
+import argparse  # for the command line options
+import os  # for the model path and the thread count
+import time  # for measuring the throughput
+import joblib  # for loading the saved model
+import numpy as np  # for the feature arrays
+import pandas as pd  # for reading the csv in chunks
+from codecare.risk_score_model import X_VARS
+from codecare import instrumentation  # stage timers
+
+# The model written by risk_score_model.py
+MODEL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "models", "risk_score_model.joblib"
+)
+
+# Upper bounds of risk classes 1-3, the same as in clean_hospital_data.py
+RISK_CLASS_BOUNDS = [0.25, 0.50, 0.75]
+
+
+class RiskScorer:
+    """
+    The saved XGBoost model, loaded once, for scoring any number of batches.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, nthread=None):
+        model = joblib.load(model_path)
+        self.booster = model.get_booster() if hasattr(model, "get_booster") else model
+        self.nthread = nthread or os.cpu_count() or 1
+        self.booster.set_param({"nthread": self.nthread})
+
+        # The columns in the order the model was trained with
+        self.features = list(self.booster.feature_names or X_VARS)
+        if sorted(self.features) != sorted(X_VARS):
+            raise ValueError(
+                f"The model in {model_path} uses features {self.features}, expected {X_VARS}"
+            )
+
+        self.rows_scored = 0
+        self.seconds = 0.0
+
+    def features_of(self, df: pd.DataFrame):
+        """
+        This function returns the model's feature columns of df as one float32 array, in the
+        model's order. Missing columns raise a ValueError.
+        """
+        missing = [name for name in self.features if name not in df]
+        if missing:
+            raise ValueError(f"Missing feature columns: {missing}")
+        return np.ascontiguousarray(df[self.features].to_numpy(dtype=np.float32))
+
+    def score(self, df: pd.DataFrame):
+        """
+        This function returns the predicted risk score of every row of df.
+        """
+        X = self.features_of(df)
+        started = time.perf_counter()
+        with instrumentation.stage("risk_scoring.score", rows=len(X)):
+            scores = self.booster.inplace_predict(X, validate_features=False)
+        self.seconds += time.perf_counter() - started
+        self.rows_scored += len(X)
+        return scores
+
+    def score_csv(self, input_path, output_path=None, keep=(), chunksize=500_000):
+        """
+        This function scores a csv file chunk by chunk and returns a summary with the number
+        of rows and the rows scored per second. If output_path is given, the keep columns (the
+        ones the file has) and the predicted risk score and class of every row are written to
+        it as they are scored.
+        """
+        keep = [name for name in keep if name not in self.features]
+        columns = set(self.features) | set(keep)
+
+        started = time.perf_counter()
+        rows = 0
+        for chunk in pd.read_csv(
+            input_path,
+            usecols=lambda name: name in columns,
+            dtype={name: np.float32 for name in self.features},
+            chunksize=chunksize,
+        ):
+            scores = self.score(chunk)
+
+            if output_path is not None:
+                scored = chunk[[name for name in keep if name in chunk]].copy()
+                scored["predicted_risk_score"] = scores
+                scored["predicted_risk_class"] = risk_class(scores)
+                scored.to_csv(
+                    output_path, mode="a" if rows else "w", header=not rows, index=False
+                )
+            rows += len(chunk)
+
+        seconds = time.perf_counter() - started
+        return {
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else 0.0,
+            "nthread": self.nthread,
+        }
+
+    def stats(self):
+        """
+        This function returns how many rows were scored and the prediction throughput.
+        """
+        return {
+            "rows": self.rows_scored,
+            "seconds": self.seconds,
+            "rows_per_second": self.rows_scored / self.seconds if self.seconds else 0.0,
+            "nthread": self.nthread,
+        }
+
+
+def risk_class(scores):
+    """
+    This function turns risk scores into risk classes 1-4, with the same bins as the
+    cleaned data (scores outside 0-1 go to the nearest class).
+    """
+    return np.searchsorted(RISK_CLASS_BOUNDS, scores, side="left") + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score new data with the risk model.")
+    parser.add_argument("input")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument(
+        "--keep",
+        nargs="*",
+        default=["date", "state", "hospital_name", "address", "city"],
+        help="columns to copy to the output",
+    )
+    args = parser.parse_args()
+
+    scorer = RiskScorer(args.model, args.threads)
+    summary = scorer.score_csv(args.input, args.output, args.keep, args.chunksize)
+    print(
+        f"Scored {summary['rows']} rows in {summary['seconds']:.2f} s "
+        f"({summary['rows_per_second']:.0f} rows/s, {summary['nthread']} threads)"
+    )
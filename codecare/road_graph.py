@@ -0,0 +1,480 @@
+"""
+This module holds a compact, array-backed version of the road network.
+
+Instead of the dict-of-dicts that NetworkX builds, the adjacency is stored in CSR form
+(offsets, targets and the per-edge travel_time/distance) and the node coordinates are kept
+as contiguous float arrays. The arrays can be saved to a directory of .npy files and loaded
+back memory-mapped, so several worker processes can share one copy of the graph. The other
+node attributes (risk score, hospital details) are kept next to it in a NodeAttributeStore.
+"""
+
+import hashlib  # for the graph version
+import json  # for the metadata file
+import os  # for building the file paths
+import numpy as np  # for the arrays
+import pandas as pd  # for reading the node and edge DataFrames
+from codecare.node_attributes import NodeAttributeStore  # risk and hospital details
+
+# Bumped whenever the on-disk layout changes
+FORMAT_VERSION = 1
+
+# Names of the arrays that are written to disk, in the order they are saved
+ARRAY_NAMES = [
+    "node_ids",
+    "offsets",
+    "targets",
+    "travel_time",
+    "distance",
+    "latitude",
+    "longitude",
+]
+
+# The edge weights can be asked for by their CSV column name or by the plain name
+WEIGHT_NAMES = {
+    " travel_time": "travel_time",
+    "travel_time": "travel_time",
+    " distance": "distance",
+    "distance": "distance",
+}
+
+
+class RoadGraph:
+    """
+    An undirected road graph stored as CSR arrays.
+
+    Nodes are referred to by their original id (the "# index" column) from the outside and
+    by their position in `node_ids` (the "index") inside the search code. Every edge is
+    stored in both directions, so the neighbors of index i are
+    targets[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(
+        self,
+        node_ids,
+        offsets,
+        targets,
+        travel_time,
+        distance,
+        latitude,
+        longitude,
+        path=None,
+    ):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.travel_time = travel_time
+        self.distance = distance
+        self.latitude = latitude
+        self.longitude = longitude
+
+        # The directory the graph was loaded from (or saved to), if any
+        self.path = path
+
+        # Risk score and hospital details of the nodes (a NodeAttributeStore), if known
+        self.attributes = None
+
+        # Precomputed landmark distances for the ALT heuristic, keyed by weight name
+        # ("travel_time" or "distance"), each of shape (num_nodes, num_landmarks)
+        self.landmarks = {}
+
+        # Fingerprint of the arrays, computed the first time it is asked for
+        self._version = None
+
+        # Bumped by every update_edges call, with a log of the changes made
+        self.revision = 0
+        self.changes = []
+
+    @classmethod
+    def from_frames(cls, nodes: pd.DataFrame, edges: pd.DataFrame):
+        """
+        This function builds the graph straight from the DataFrames returned by read_data.
+        The other node columns are kept in G.attributes.
+        """
+        source = edges["# source"].to_numpy(dtype=np.int64)
+        target = edges[" target"].to_numpy(dtype=np.int64)
+
+        # Only nodes that appear on an edge are part of the graph, same as NetworkX
+        node_ids = np.unique(np.concatenate([source, target]))
+
+        # Coordinates come from the node table, keeping the first row of duplicates
+        nodes_unique = nodes.drop_duplicates(subset="# index")
+        latitude, longitude = _align_coordinates(
+            node_ids,
+            nodes_unique["# index"].to_numpy(dtype=np.int64),
+            nodes_unique["latitude"].to_numpy(dtype=np.float64),
+            nodes_unique["longitude"].to_numpy(dtype=np.float64),
+        )
+
+        G = cls._from_edge_arrays(
+            node_ids,
+            np.searchsorted(node_ids, source),
+            np.searchsorted(node_ids, target),
+            edges[" travel_time"].to_numpy(dtype=np.float32),
+            edges[" distance"].to_numpy(dtype=np.float32),
+            latitude,
+            longitude,
+        )
+        G.attributes = NodeAttributeStore.from_frame(nodes, node_ids)
+        return G
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        This function converts an existing NetworkX graph (from construct_graph) into a RoadGraph.
+        """
+        node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+
+        source, target, travel_time, distance = [], [], [], []
+        for u, v, data in G.edges(data=True):
+            source.append(u)
+            target.append(v)
+            travel_time.append(data.get(" travel_time", np.nan))
+            distance.append(data.get(" distance", np.nan))
+
+        latitude = np.array(
+            [G.nodes[n].get("latitude", np.nan) for n in node_ids], dtype=np.float64
+        )
+        longitude = np.array(
+            [G.nodes[n].get("longitude", np.nan) for n in node_ids], dtype=np.float64
+        )
+
+        return cls._from_edge_arrays(
+            node_ids,
+            np.searchsorted(node_ids, np.array(source, dtype=np.int64)),
+            np.searchsorted(node_ids, np.array(target, dtype=np.int64)),
+            np.array(travel_time, dtype=np.float32),
+            np.array(distance, dtype=np.float32),
+            latitude,
+            longitude,
+        )
+
+    @classmethod
+    def _from_edge_arrays(
+        cls, node_ids, source, target, travel_time, distance, latitude, longitude
+    ):
+        """
+        This function turns an edge list (given as node indices) into the symmetric CSR arrays.
+        """
+        n = len(node_ids)
+
+        # An undirected graph keeps one edge per node pair; like nx.Graph, the last row wins
+        low = np.minimum(source, target)
+        high = np.maximum(source, target)
+        keys = low * max(n, 1) + high
+        _, first_in_reversed = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - first_in_reversed
+
+        low, high = low[keep], high[keep]
+        travel_time, distance = travel_time[keep], distance[keep]
+
+        # Store both directions (self loops only once)
+        not_loop = low != high
+        all_source = np.concatenate([low, high[not_loop]])
+        all_target = np.concatenate([high, low[not_loop]])
+        all_travel_time = np.concatenate([travel_time, travel_time[not_loop]])
+        all_distance = np.concatenate([distance, distance[not_loop]])
+
+        # Sort by source so each node's neighbors are contiguous
+        order = np.lexsort((all_target, all_source))
+        index_dtype = np.int32 if len(order) < np.iinfo(np.int32).max else np.int64
+
+        offsets = np.zeros(n + 1, dtype=index_dtype)
+        np.cumsum(np.bincount(all_source, minlength=n), out=offsets[1:])
+
+        return cls(
+            node_ids=np.ascontiguousarray(node_ids, dtype=np.int64),
+            offsets=offsets,
+            targets=np.ascontiguousarray(all_target[order], dtype=index_dtype),
+            travel_time=np.ascontiguousarray(all_travel_time[order], dtype=np.float32),
+            distance=np.ascontiguousarray(all_distance[order], dtype=np.float32),
+            latitude=np.ascontiguousarray(latitude, dtype=np.float64),
+            longitude=np.ascontiguousarray(longitude, dtype=np.float64),
+        )
+
+    def to_networkx(self):
+        """
+        This function converts the RoadGraph back into a NetworkX graph, for code that still needs one.
+        """
+        import networkx as nx  # only needed for the adapter
+
+        G = nx.Graph()
+        for i, node in enumerate(self.node_ids.tolist()):
+            G.add_node(
+                node,
+                latitude=float(self.latitude[i]),
+                longitude=float(self.longitude[i]),
+            )
+
+        source = np.repeat(np.arange(self.num_nodes), np.diff(self.offsets))
+        upper = source <= self.targets  # each undirected edge once
+        G.add_edges_from(
+            (u, v, {" travel_time": float(t), " distance": float(d)})
+            for u, v, t, d in zip(
+                self.node_ids[source[upper]].tolist(),
+                self.node_ids[self.targets[upper]].tolist(),
+                self.travel_time[upper],
+                self.distance[upper],
+            )
+        )
+
+        return G
+
+    def save(self, directory):
+        """
+        This function writes the arrays as .npy files (plus a small metadata file) into a directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        for name, distances in self.landmarks.items():
+            np.save(os.path.join(directory, f"landmarks_{name}.npy"), distances)
+        if self.attributes is not None:
+            self.attributes.save(os.path.join(directory, "attributes"))
+
+        meta = {
+            "format_version": FORMAT_VERSION,
+            "num_nodes": self.num_nodes,
+            "num_edges": self.num_edges,
+        }
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        self.path = directory
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        This function loads a graph saved with save(). By default the arrays are memory-mapped
+        read-only, so processes loading the same directory share the pages.
+        """
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported graph format {meta['format_version']} in {directory}"
+            )
+
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ARRAY_NAMES
+        }
+
+        G = cls(path=directory, **arrays)
+
+        # Landmarks are optional and live next to the graph arrays
+        for name in set(WEIGHT_NAMES.values()):
+            landmarks_path = os.path.join(directory, f"landmarks_{name}.npy")
+            if os.path.exists(landmarks_path):
+                G.landmarks[name] = np.load(landmarks_path, mmap_mode=mmap_mode)
+
+        # So are the node attributes
+        if os.path.exists(os.path.join(directory, "attributes", "meta.json")):
+            G.attributes = NodeAttributeStore.load(
+                os.path.join(directory, "attributes"), mmap
+            )
+
+        return G
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        # Number of undirected edges (self loops are stored once)
+        loops = int(np.count_nonzero(
+            np.repeat(np.arange(self.num_nodes), np.diff(self.offsets)) == self.targets
+        ))
+        return (len(self.targets) - loops) // 2 + loops
+
+    @property
+    def version(self):
+        """
+        A fingerprint of the graph's structure and weights. Two graphs with the same arrays
+        (in any process) have the same version, and every update_edges call gives a new one,
+        so it can key cached routes.
+        """
+        if self._version is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for name in ARRAY_NAMES:
+                digest.update(np.ascontiguousarray(getattr(self, name)))
+            self._version = digest.hexdigest()
+        return self._version
+
+    def update_edges(self, updates, weight=" travel_time"):
+        """
+        This function changes edge weights in place, for road closures, weather or traffic.
+
+        updates is a list of (u, v, new_weight) with node ids; a new_weight of None removes
+        the edge (both weights become inf, so no route uses it). The graph gets a new
+        version, and an EdgeChange describing the batch is returned and kept in self.changes
+        so caches can tell which routes it affects. Landmarks for the weight are dropped if
+        any weight went down, since their bounds could then overestimate.
+        """
+        key = self.weight_key(weight)
+        old_version = self.version
+
+        # Memory-mapped arrays are read-only, so the first update takes a private copy; the
+        # graph no longer matches its directory after this
+        for name in ("travel_time", "distance"):
+            array = getattr(self, name)
+            if not array.flags.writeable:
+                setattr(self, name, np.array(array))
+        self.path = None
+
+        changed = self.weights(weight)
+        edges, old_weights, new_weights = [], [], []
+        for u, v, new_weight in updates:
+            positions = [self._edge_position(u, v), self._edge_position(v, u)]
+            old_weights.append(float(changed[positions[0]]))
+            if new_weight is None:
+                new_weight = np.inf
+                self.travel_time[positions] = np.inf
+                self.distance[positions] = np.inf
+            changed[positions] = new_weight
+            edges.append((u, v))
+            new_weights.append(float(changed[positions[0]]))
+
+        change = EdgeChange(
+            old_version,
+            key,
+            np.array(edges, dtype=np.int64).reshape(-1, 2),
+            np.array(old_weights),
+            np.array(new_weights),
+        )
+        if (change.new_weights < change.old_weights).any():
+            self.landmarks.pop(key, None)
+
+        self._version = change.new_version
+        self.revision += 1
+        self.changes.append(change)
+
+        return change
+
+    def _edge_position(self, u, v):
+        """
+        This function returns where the edge u -> v is stored in targets.
+        """
+        i, j = self.index_of(u), self.index_of(v)
+        start = int(self.offsets[i])
+        found = np.flatnonzero(self.targets[start : int(self.offsets[i + 1])] == j)
+        if not len(found):
+            raise KeyError((u, v))
+        return start + int(found[0])
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAY_NAMES)
+
+    def __len__(self):
+        return self.num_nodes
+
+    def __contains__(self, node):
+        i = np.searchsorted(self.node_ids, node)
+        return bool(i < self.num_nodes and self.node_ids[i] == node)
+
+    def index_of(self, node):
+        """
+        This function returns the internal index of a node id, raising KeyError if it is not in the graph.
+        """
+        i = int(np.searchsorted(self.node_ids, node))
+        if i >= self.num_nodes or self.node_ids[i] != node:
+            raise KeyError(node)
+        return i
+
+    def indices_of(self, nodes):
+        """
+        This function is the vectorized version of index_of for an array of node ids.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        indices = np.searchsorted(self.node_ids, nodes)
+        found = indices < self.num_nodes
+        found[found] = self.node_ids[indices[found]] == nodes[found]
+        if not found.all():
+            raise KeyError(nodes[~found][0].item())
+        return indices
+
+    def weights(self, weight=" travel_time"):
+        """
+        This function returns the per-edge weight array for a weight name like " travel_time".
+        """
+        return getattr(self, self.weight_key(weight))
+
+    @staticmethod
+    def weight_key(weight=" travel_time"):
+        """
+        This function normalizes a weight name like " travel_time" to the key used for landmarks.
+        """
+        try:
+            return WEIGHT_NAMES[weight]
+        except KeyError:
+            raise ValueError(f"Unknown edge weight {weight!r}") from None
+
+    def neighbors(self, node):
+        """
+        This function returns the node ids next to a node.
+        """
+        i = self.index_of(node)
+        return self.node_ids[self.targets[self.offsets[i] : self.offsets[i + 1]]]
+
+    def to_scipy(self, weight=" travel_time"):
+        """
+        This function exposes the adjacency as a scipy.sparse CSR matrix (shares the arrays, no copy).
+        """
+        from scipy.sparse import csr_matrix  # only needed by the scipy-based searches
+
+        return csr_matrix(
+            (self.weights(weight), self.targets, self.offsets),
+            shape=(self.num_nodes, self.num_nodes),
+        )
+
+
+class EdgeChange:
+    """
+    One batch of edge updates: which edges (as node id pairs) changed and from what to what.
+    A removed edge has a new weight of inf (and removes it for both weights).
+    """
+
+    def __init__(self, old_version, weight, edges, old_weights, new_weights):
+        self.old_version = old_version
+        self.weight = weight
+        self.edges = edges
+        self.old_weights = old_weights
+        self.new_weights = new_weights
+
+        # The new version follows from the old one and the batch, so every process that
+        # applies the same updates to the same graph ends up with the same version
+        digest = hashlib.blake2b(old_version.encode(), digest_size=16)
+        digest.update(weight.encode())
+        digest.update(np.ascontiguousarray(edges))
+        digest.update(np.ascontiguousarray(new_weights))
+        self.new_version = digest.hexdigest()
+
+    @property
+    def removed(self):
+        return np.isinf(self.new_weights)
+
+    @property
+    def weights(self):
+        # The weights this batch changed: removals change both
+        if self.removed.any():
+            return {"travel_time", "distance"}
+        return {self.weight}
+
+
+def _align_coordinates(node_ids, table_ids, table_latitude, table_longitude):
+    """
+    This function lines the node table's coordinates up with node_ids (NaN where a node has no row).
+    """
+    latitude = np.full(len(node_ids), np.nan)
+    longitude = np.full(len(node_ids), np.nan)
+
+    position = np.searchsorted(node_ids, table_ids)
+    found = position < len(node_ids)
+    found[found] = node_ids[position[found]] == table_ids[found]
+
+    latitude[position[found]] = table_latitude[found]
+    longitude[position[found]] = table_longitude[found]
+
+    return latitude, longitude
@@ -0,0 +1,357 @@
+"""
+This module keeps shortest-path results around so the same leg isn't searched twice.
+
+Routes are keyed by (graph version, source, target, weight). The in-memory tier is a
+least-recently-used map with a cap on the bytes it holds; an optional SQLite file on disk
+keeps routes across restarts. Because the graph version is a fingerprint of the graph's
+arrays, changed edge weights or a different graph file never hit old routes. When a graph
+was changed with update_edges, the cache keeps the routes the change can't have affected
+and reports the others on a change feed (drain_stale), which repair_routes in the routing
+engine uses to search only those again.
+"""
+
+import math  # for inf
+import sqlite3  # for the on-disk tier
+import threading  # the GUI and the service use the cache from several threads
+import weakref  # for remembering graph versions without keeping graphs alive
+from array import array  # compact storage for the node paths
+from collections import OrderedDict, deque  # for the LRU order and the change feed
+import numpy as np  # for the lower bounds of decreased edges
+
+# Rough per-entry overhead (key tuple, OrderedDict slot, array header) in bytes
+ENTRY_OVERHEAD = 200
+
+
+class RouteCache:
+    """
+    A bounded LRU cache of (path, cost) results, with an optional on-disk tier.
+
+    The road graph is undirected, so a route and its reverse share one entry.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_path=None):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # The version each graph object had when the cache last saw it
+        self._graph_versions = weakref.WeakKeyDictionary()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rebased = 0
+
+        # (source, target, weight) of routes that went stale, oldest first
+        self.stale_routes = deque()
+
+        self._db = None
+        if disk_path is not None:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "key TEXT PRIMARY KEY, graph_path TEXT, version TEXT, "
+                "path BLOB, cost REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS routes_graph ON routes (graph_path, version)"
+            )
+            self._db.commit()
+
+    def get(self, G, source, target, weight=" travel_time"):
+        """
+        This function returns the cached (path, cost) from source to target, or None.
+        """
+        key, reverse = self._key(G, source, target, weight)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _unpack(entry[0], entry[1], reverse)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT path, cost FROM routes WHERE key = ?", (_disk_key(key),)
+                ).fetchone()
+                if row is not None:
+                    path = array("q")
+                    path.frombytes(row[0])
+                    self._store(key, path, row[1])
+                    self.disk_hits += 1
+                    return _unpack(path, row[1], reverse)
+
+            self.misses += 1
+            return None
+
+    def put(self, G, source, target, path, cost, weight=" travel_time"):
+        """
+        This function caches the (path, cost) from source to target.
+        """
+        key, reverse = self._key(G, source, target, weight)
+        packed = array("q", reversed(path) if reverse else path)
+
+        with self._lock:
+            self._store(key, packed, cost)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?)",
+                    (
+                        _disk_key(key),
+                        G.path or "",
+                        key[0],
+                        packed.tobytes(),
+                        cost,
+                    ),
+                )
+                self._db.commit()
+
+    def sync(self, G):
+        """
+        This function applies any changes made to G since the cache last saw it.
+        """
+        self._check_version(G)
+
+    def drain_stale(self):
+        """
+        This function returns the (source, target, weight) of the routes that went stale
+        since the last call, and empties the feed.
+        """
+        with self._lock:
+            stale = list(self.stale_routes)
+            self.stale_routes.clear()
+        return stale
+
+    def clear(self):
+        """
+        This function empties the cache (both tiers).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM routes")
+                self._db.commit()
+
+    def stats(self):
+        """
+        This function returns the hit/miss counters and the current size.
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "rebased": self.rebased,
+                "stale": len(self.stale_routes),
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, G, source, target, weight):
+        version = self._check_version(G)
+        weight = G.weight_key(weight)
+        source, target = int(source), int(target)
+        if source <= target:
+            return (version, weight, source, target), False
+        return (version, weight, target, source), True
+
+    def _check_version(self, G):
+        """
+        This function notices when a graph changed since the cache last saw it and drops
+        the routes of its old version.
+        """
+        version = G.version
+        with self._lock:
+            old = self._graph_versions.get(G)
+            self._graph_versions[G] = version
+            if old is not None and old != version:
+                changes = _changes_since(G, old)
+                if changes is None:
+                    self._drop_version(old)
+                elif changes:
+                    self._rebase(G, changes)
+            elif old is None and self._db is not None and G.path:
+                # A graph file that was rebuilt since the routes were written
+                self._db.execute(
+                    "DELETE FROM routes WHERE graph_path = ? AND version != ?",
+                    (G.path, version),
+                )
+                self._db.commit()
+        return version
+
+    def _drop_version(self, version):
+        stale = [key for key in self._entries if key[0] == version]
+        for key in stale:
+            self._bytes -= _size(self._entries.pop(key)[0])
+        self.invalidations += len(stale)
+        if self._db is not None:
+            self._db.execute("DELETE FROM routes WHERE version = ?", (version,))
+            self._db.commit()
+
+    def _rebase(self, G, changes):
+        """
+        This function moves the routes of the version before changes over to the graph's
+        current version, except the ones the changes may have made wrong, which go on the
+        change feed.
+        """
+        from codecare.routing_engine import geometric_lower_bound
+
+        old_version = changes[0].old_version
+        new_version = changes[-1].new_version
+        changed = {}
+        decreases = {}
+
+        for key in [key for key in self._entries if key[0] == old_version]:
+            path, cost = self._entries.pop(key)
+            self._bytes -= _size(path)
+            _, weight, source, target = key
+
+            if weight not in changed:
+                changed[weight] = {
+                    (min(u, v), max(u, v))
+                    for change in changes
+                    if weight in change.weights
+                    for u, v in change.edges.tolist()
+                }
+                decreases[weight] = _decreases(G, changes, weight)
+
+            nodes = path.tolist()
+            stale = any(
+                (min(a, b), max(a, b)) in changed[weight]
+                for a, b in zip(nodes[:-1], nodes[1:])
+            )
+
+            # A cheaper edge elsewhere can only help if going through it could beat the
+            # route, even with the most optimistic costs to and from it
+            if not stale and decreases[weight] is not None:
+                down_edges, slack, scale = decreases[weight]
+                for a, b in (down_edges[:, 0], down_edges[:, 1]), (
+                    down_edges[:, 1],
+                    down_edges[:, 0],
+                ):
+                    n = len(a)
+                    best = (
+                        geometric_lower_bound(G, np.full(n, source), a, weight, scale)
+                        + slack
+                        + geometric_lower_bound(G, b, np.full(n, target), weight, scale)
+                    )
+                    stale = stale or bool((best < cost).any())
+
+            if stale:
+                self.stale_routes.append((source, target, weight))
+                self.invalidations += 1
+            else:
+                self._store((new_version, weight, source, target), path, cost)
+                self.rebased += 1
+
+        if self._db is not None:
+            self._db.execute("DELETE FROM routes WHERE version = ?", (old_version,))
+            self._db.commit()
+
+    def _store(self, key, path, cost):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= _size(old[0])
+        self._entries[key] = (path, cost)
+        self._bytes += _size(path)
+
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= _size(evicted)
+            self.evictions += 1
+
+
+def _changes_since(G, version):
+    """
+    This function returns the changes that took G from version to its current version, or
+    None if they aren't in its change log.
+    """
+    for i, change in enumerate(G.changes):
+        if change.old_version == version:
+            return G.changes[i:]
+    return None
+
+
+def _decreases(G, changes, weight):
+    """
+    This function returns the edges the changes made cheaper for weight, as (edges, slack,
+    scale), or None if there are none.
+
+    The geometric bound uses a scale that holds for every edge except the ones made cheaper
+    since the graph was loaded, so a few much cheaper edges don't weaken it for the whole
+    graph, now or after later changes. A path that gets cheaper than a cached route has to
+    use an edge the changes made cheaper; from the first one, (a, b), it costs at least
+    bound(source, a) + weight(a, b) + bound(b, target), minus what the other cheaper edges
+    can undercut the scale by (their deficit). slack is the weight minus those deficits.
+    """
+    down = _cheaper_edges(changes, weight)
+    if not down:
+        return None
+
+    from codecare.routing_engine import geometric_lower_bound, lower_bound_scale
+
+    # The edges made cheaper by earlier changes, then the ones made cheaper by these
+    cheaper = {
+        key: value
+        for key, value in _cheaper_edges(G.changes, weight).items()
+        if key not in down
+    }
+    cheaper.update(down)
+    edges = np.array(list(cheaper), dtype=np.int64).reshape(-1, 2)
+    weights = np.array(list(cheaper.values()))
+    scale = lower_bound_scale(G, weight, exclude=edges)
+    deficit = np.maximum(
+        geometric_lower_bound(G, edges[:, 0], edges[:, 1], weight, scale) - weights, 0.0
+    )
+
+    own = slice(len(cheaper) - len(down), None)
+    return edges[own], weights[own] - (deficit.sum() - deficit[own]), scale
+
+
+def _cheaper_edges(changes, weight):
+    """
+    This function returns {(u, v): weight now} for the edges the changes left cheaper for
+    weight than they were before them.
+    """
+    before, after = {}, {}
+    for change in changes:
+        if weight not in change.weights:
+            continue
+        for (u, v), old, new in zip(
+            change.edges.tolist(), change.old_weights.tolist(), change.new_weights.tolist()
+        ):
+            key = (min(u, v), max(u, v))
+            # A removal made for the other weight doesn't say what this weight was
+            before.setdefault(key, old if change.weight == weight else math.inf)
+            after[key] = new if change.weight == weight else math.inf
+
+    return {key: after[key] for key in before if after[key] < before[key]}
+
+
+def _size(path):
+    return path.itemsize * len(path) + ENTRY_OVERHEAD
+
+
+def _unpack(path, cost, reverse):
+    path = path.tolist()
+    if reverse:
+        path.reverse()
+    return path, cost
+
+
+def _disk_key(key):
+    return "|".join(str(part) for part in key)
@@ -2,63 +2,121 @@ import pandas as pd  # for reading the csv
 import networkx as nx  # for rendering the graph
 from sklearn.metrics.pairwise import haversine_distances  # heuristic
 import numpy as np  # radians in haversine
+import heapq  # priority queues for the bidirectional search
+import json  # for the index of the state graphs
+import math  # scalar math in the search loop
+import os  # for saving landmarks next to the graph
+import tempfile  # for publishing a graph to worker processes
+import threading  # for loading each state graph once
+import weakref  # for remembering the conversions of NetworkX graphs
+from concurrent.futures import ProcessPoolExecutor  # worker processes sharing the graph
+from contextlib import contextmanager  # for the graph publishing helpers
+from itertools import repeat  # for passing the same arguments to every task
+from codecare.road_graph import RoadGraph, WEIGHT_NAMES  # compact CSR version of the graph
+from codecare.data_cache import read_csv_cached  # binary copies of the csv files
+from codecare.contraction_hierarchy import ContractionHierarchy, ch_shortest_path
+from codecare import instrumentation  # stage timers and search counters
 
 
 # reads the nodes and edges from two paths
 def read_data(path1, path2):
     """
     This function, based on two file paths, reads them as DataFrames and exports them.
+    The files are only parsed the first time, later calls load them from the binary cache.
     """
-    nodes = pd.read_csv(path1)
-    edges = pd.read_csv(path2)
+    with instrumentation.stage("read_data"):
+        nodes = read_csv_cached(path1)
+        edges = read_edges(path2)
+
+    return nodes, edges
+
+
+def read_edges(path):
+    """
+    This function reads only the edges file, with the travel times read_data adds to it.
+    """
+    edges = read_csv_cached(path)
 
     # Assuming the car goes at 50 MPH constantly, this returns hours
     edges[" travel_time"] = (
         (edges[" distance"] / 1609) / 50
     ) * 3600  # changes travel time by converting meters into miles
 
-    print("Data loaded!")
-    return nodes, edges
+    return edges
 
 
 def construct_graph(nodes: pd.DataFrame, edges: pd.DataFrame):
     """
     This function will create the NetworkX graph from the node and edge DataFrames.
     """
-    # Create graph from edges
-    G = nx.from_pandas_edgelist(
-        edges,
-        source="# source",
-        target=" target",
-        edge_attr=[" travel_time", " distance"],
-        create_using=nx.Graph(),
-    )
+    with instrumentation.stage("construct_graph"):
+        # Create graph from edges
+        G = nx.from_pandas_edgelist(
+            edges,
+            source="# source",
+            target=" target",
+            edge_attr=[" travel_time", " distance"],
+            create_using=nx.Graph(),
+        )
 
-    # Add node attributes, handle duplicates by grouping (keep first)
-    nodes_unique = nodes.drop_duplicates(subset="# index")
-    attr_dict = nodes_unique.set_index("# index")[
-        [
-            "risk_score",
-            "latitude",
-            "longitude",
-            "hospital_name",
-            "address",
-            "city",
-            "hospital_subtype",
-            "risk_class",
-        ]
-    ].to_dict("index")
-    nx.set_node_attributes(G, attr_dict)
+        # Add node attributes, handle duplicates by grouping (keep first)
+        nodes_unique = nodes.drop_duplicates(subset="# index")
+        attr_dict = nodes_unique.set_index("# index")[
+            [
+                "risk_score",
+                "latitude",
+                "longitude",
+                "hospital_name",
+                "address",
+                "city",
+                "hospital_subtype",
+                "risk_class",
+            ]
+        ].to_dict("index")
+        nx.set_node_attributes(G, attr_dict)
+
+    return G
 
-    print("Graph constructed!")
+
+def construct_road_graph(nodes: pd.DataFrame, edges: pd.DataFrame):
+    """
+    This function builds the compact, array-backed RoadGraph instead of a NetworkX graph.
+    It only keeps what routing needs (adjacency, weights and coordinates).
+    """
+    with instrumentation.stage("construct_road_graph"):
+        G = RoadGraph.from_frames(nodes, edges)
 
     return G
 
 
-def astar_shortest_path(G, start_node, end_node, weight=" travel_time"):
+def astar_shortest_path(G, start_node, end_node, weight=" travel_time", cache=None):
     """
-    Using the NetworkX A* implementation (which is easier to implement that your own), find the shortest path given a graph.
+    Find the shortest path given a graph. Travel time and distance are searched with the
+    bidirectional A* below over the graph's CSR arrays; a NetworkX graph is converted to a
+    RoadGraph once and the conversion is kept on the graph. Any other weight falls back to
+    the NetworkX A* implementation. A ContractionHierarchy is queried with ch_shortest_path.
+    If a RouteCache is given, RoadGraph results are looked up in and added to it.
     """
+    if isinstance(G, ContractionHierarchy):
+        path, total_cost = ch_shortest_path(G, start_node, end_node, weight)
+        instrumentation.count("ch.searches")
+        return path, total_cost
+
+    if not isinstance(G, RoadGraph) and weight in WEIGHT_NAMES:
+        G = as_road_graph(G)
+
+    if isinstance(G, RoadGraph):
+        if cache is not None:
+            cached = cache.get(G, start_node, end_node, weight)
+            if cached is not None:
+                return cached
+
+        path, total_cost = _astar_road_graph(G, start_node, end_node, weight)
+        if cache is not None:
+            cache.put(G, start_node, end_node, path, total_cost, weight)
+
+        return path, total_cost
+
     # Precompute lat/lon in radians for all nodes
     lat_lon_rad = {
         n: np.radians([data["latitude"], data["longitude"]])
@@ -77,27 +135,685 @@ def astar_shortest_path(G, start_node, end_node, weight=" travel_time"):
 
     # Calculate total cost
     total_cost = sum(G[u][v][weight] for u, v in zip(path[:-1], path[1:]))
-
-    print("Path and total cost calculated!")
+    instrumentation.count("astar.networkx_searches")
 
     return path, total_cost
 
 
 # Based off of the individual A* algorithm
-def astar_many_nodes(G, pairs):
+def astar_many_nodes(G, pairs, cache=None, workers=None, chunksize=16, progress=None):
     """
     This function builds off of the initial A* function by adapting it to multiple nodes.
+    A leg that appears more than once (in either direction) is only searched once. With
+    workers > 1 the legs are searched in worker processes that share the graph, chunksize
+    legs per task, and the results are put back together in the order of pairs.
+    If progress is given, it is called with (legs done, legs in total) after every leg; an
+    exception raised by it stops the search.
     """
+    pairs = list(pairs)
+
     # Create of cumulative path list
     all_paths = []
 
     # Same thing but with the time
     cumulative_cost = 0
 
+    # Legs already searched in this call
+    legs = {}
+    if workers is not None and workers > 1 and not isinstance(G, ContractionHierarchy):
+        legs = _search_legs_in_parallel(G, pairs, cache, workers, chunksize)
+
     # Runs A* individually for each and updates local vars
-    for start, end in pairs:
-        path, cost = astar_shortest_path(G, start, end)
+    for done, (start, end) in enumerate(pairs, 1):
+        if (start, end) in legs:
+            path, cost = legs[(start, end)]
+        elif (end, start) in legs:
+            path, cost = legs[(end, start)]
+            path = path[::-1]
+        else:
+            path, cost = astar_shortest_path(G, start, end, cache=cache)
+            legs[(start, end)] = (path, cost)
         all_paths.extend(path)
         cumulative_cost += cost
+        if progress is not None:
+            progress(done, len(pairs))
 
     return all_paths, cumulative_cost
+
+
+def _search_legs_in_parallel(G, pairs, cache, workers, chunksize):
+    """
+    This function searches every distinct leg of pairs (that isn't cached) in a worker pool
+    and returns them as {(start, end): (path, cost)}.
+    """
+    G = as_road_graph(G)
+    legs = {}
+
+    todo = []
+    for start, end in pairs:
+        if (start, end) in legs or (end, start) in legs:
+            continue
+        cached = cache.get(G, start, end) if cache is not None else None
+        legs[(start, end)] = cached
+        if cached is None:
+            todo.append((start, end))
+
+    if todo:
+        with graph_worker_pool(G, workers) as pool:
+            results = pool.map(
+                _path_task,
+                [start for start, _ in todo],
+                [end for _, end in todo],
+                chunksize=chunksize,
+            )
+            for (start, end), (path, cost) in zip(todo, results):
+                legs[(start, end)] = (path, cost)
+                if cache is not None:
+                    cache.put(G, start, end, path, cost)
+
+    return legs
+
+
+def travel_time_matrix(
+    G,
+    sources,
+    targets,
+    weight=" travel_time",
+    return_predecessors=False,
+    batch_size=32,
+    limit=np.inf,
+    workers=None,
+):
+    """
+    This function computes the shortest travel time from every source to every target.
+
+    Instead of one A* per pair it runs one one-to-all search per source (scipy's Dijkstra over
+    the graph's CSR arrays), a batch of sources at a time so memory stays at batch_size rows.
+    The result is a (len(sources), len(targets)) array with inf where a target can't be
+    reached (or is farther than limit). With return_predecessors=True it also returns the
+    (len(sources), num_nodes) predecessor array, which path_from_predecessors turns into paths.
+    With workers > 1 the batches are spread over worker processes sharing the graph.
+    """
+    from scipy.sparse.csgraph import dijkstra  # C-speed one-to-all searches
+
+    G = as_road_graph(G)
+
+    if workers is not None and workers > 1 and len(sources) > batch_size:
+        sources = np.asarray(sources)
+        batches = [
+            sources[first : first + batch_size]
+            for first in range(0, len(sources), batch_size)
+        ]
+        with graph_worker_pool(G, workers) as pool:
+            results = list(
+                pool.map(
+                    _matrix_task,
+                    batches,
+                    repeat(targets),
+                    repeat(weight),
+                    repeat(return_predecessors),
+                    repeat(limit),
+                )
+            )
+        if return_predecessors:
+            return (
+                np.concatenate([r[0] for r in results]),
+                np.concatenate([r[1] for r in results]),
+            )
+        return np.concatenate(results)
+
+    try:
+        source_index = G.indices_of(sources)
+        target_index = G.indices_of(targets)
+    except KeyError as e:
+        raise nx.NodeNotFound(f"Node {e.args[0]} is not in the graph") from None
+
+    matrix = G.to_scipy(weight)
+    costs = np.empty((len(source_index), len(target_index)))
+    predecessors = None
+    if return_predecessors:
+        predecessors = np.empty((len(source_index), G.num_nodes), dtype=np.int32)
+
+    for first in range(0, len(source_index), batch_size):
+        batch = source_index[first : first + batch_size]
+        result = dijkstra(
+            matrix,
+            indices=batch,
+            return_predecessors=return_predecessors,
+            limit=limit,
+        )
+        if return_predecessors:
+            result, batch_predecessors = result
+            predecessors[first : first + len(batch)] = batch_predecessors
+        costs[first : first + len(batch)] = result[:, target_index]
+
+    if return_predecessors:
+        return costs, predecessors
+    return costs
+
+
+def path_from_predecessors(G, predecessors, source_node, target_node):
+    """
+    This function walks one row of the predecessors from travel_time_matrix (the row of
+    source_node) back into a path of node ids from source_node to target_node.
+    """
+    G = as_road_graph(G)
+
+    start = G.index_of(source_node)
+    i = G.index_of(target_node)
+    path = []
+    while i >= 0:
+        path.append(i)
+        i = predecessors[i]
+    path.reverse()
+
+    if path[0] != start:
+        raise nx.NetworkXNoPath(f"Node {target_node} not reachable from {source_node}")
+
+    return G.node_ids[path].tolist()
+
+
+def as_road_graph(G):
+    """
+    This function returns the RoadGraph for a NetworkX graph, converting it only the first time.
+    The conversion is redone if nodes, edges, weights or coordinates changed since (in place
+    as well). A RoadGraph is returned as it is.
+    """
+    if isinstance(G, RoadGraph):
+        return G
+
+    stamp = _networkx_stamp(G)
+    cached = _road_graphs.get(G)
+    if cached is None or cached[0] != stamp:
+        cached = _road_graphs[G] = (stamp, RoadGraph.from_networkx(G))
+    return cached[1]
+
+
+# NetworkX graph -> (stamp, RoadGraph); kept outside G.graph so the graph can still be
+# written with the NetworkX writers, and dropped with the graph
+_road_graphs = weakref.WeakKeyDictionary()
+
+
+def _networkx_stamp(G):
+    """
+    This function returns a cheap fingerprint of everything from_networkx reads from G, so
+    a weight changed in place (G[u][v][" travel_time"] = ...) is noticed.
+    """
+    edges = hash(
+        tuple(
+            (u, v, data.get(" travel_time"), data.get(" distance"))
+            for u, v, data in G.edges(data=True)
+        )
+    )
+    nodes = hash(
+        tuple(
+            (n, data.get("latitude"), data.get("longitude"))
+            for n, data in G.nodes(data=True)
+        )
+    )
+    return G.number_of_nodes(), G.number_of_edges(), edges, nodes
+
+
+class StateGraphs:
+    """
+    The road graphs of many states, as written by data_analysis/process_states.py.
+
+    Only the small index of the states is read up front; a state's graph is loaded
+    (memory-mapped) the first time a query needs it. Node ids are only unique within a
+    state, so queries name the state they are in.
+    """
+
+    def __init__(self, graphs_dir):
+        self.graphs_dir = graphs_dir
+        with open(os.path.join(graphs_dir, "index.json")) as f:
+            self.index = json.load(f)
+
+        self._graphs = {}
+        self._lock = threading.Lock()
+
+    def states(self):
+        return sorted(self.index)
+
+    def loaded_states(self):
+        return sorted(self._graphs)
+
+    def graph(self, state) -> RoadGraph:
+        """
+        This function returns the road graph of a state, loading it the first time.
+        """
+        state = state.upper()
+        with self._lock:
+            G = self._graphs.get(state)
+            if G is None:
+                if state not in self.index:
+                    raise KeyError(f"There is no road graph for {state}")
+                G = self._graphs[state] = RoadGraph.load(
+                    os.path.join(self.graphs_dir, state)
+                )
+            return G
+
+    def locate(self, latitude, longitude):
+        """
+        This function returns the states whose graph's bounding box contains the point,
+        without loading any graph.
+        """
+        return [
+            state
+            for state, entry in sorted(self.index.items())
+            if entry["bbox"][0] <= latitude <= entry["bbox"][2]
+            and entry["bbox"][1] <= longitude <= entry["bbox"][3]
+        ]
+
+    def shortest_path(self, state, start_node, end_node, weight=" travel_time", cache=None):
+        """
+        This function routes between two nodes of one state, like astar_shortest_path.
+        """
+        return astar_shortest_path(self.graph(state), start_node, end_node, weight, cache)
+
+    def many_nodes(self, state, pairs, cache=None, workers=None):
+        """
+        This function routes the legs of a tour within one state, like astar_many_nodes.
+        """
+        return astar_many_nodes(self.graph(state), pairs, cache, workers)
+
+    def unload(self, state=None):
+        """
+        This function forgets the loaded graph of a state (or of every state).
+        """
+        with self._lock:
+            if state is None:
+                self._graphs.clear()
+            else:
+                self._graphs.pop(state.upper(), None)
+
+
+def load_state_graph(data_dir, state):
+    """
+    This function returns the road graph of one state: the one process_states saved under
+    data_dir/graphs if there is one (memory-mapped, through StateGraphs), otherwise one
+    built from the state's <state>_data.csv and <state>_edges.csv.
+    """
+    graphs_dir = os.path.join(data_dir, "graphs")
+    if os.path.exists(os.path.join(graphs_dir, "index.json")):
+        graphs = StateGraphs(graphs_dir)
+        if state.upper() in graphs.index:
+            return graphs.graph(state)
+
+    nodes, edges = read_data(
+        os.path.join(data_dir, f"{state.lower()}_data.csv"),
+        os.path.join(data_dir, f"{state.lower()}_edges.csv"),
+    )
+    if "latitude" not in nodes:
+        nodes = nodes.rename(columns={" la": "latitude", " lo": "longitude"})
+    return construct_road_graph(nodes, edges)
+
+
+@contextmanager
+def publish_graph(G):
+    """
+    This context manager gives a directory worker processes can load G from (memory-mapped,
+    so they all share one copy). A graph that was saved or loaded already is used in place;
+    any other graph is written to a temporary directory that is removed afterwards.
+    """
+    G = as_road_graph(G)
+    if G.path is not None:
+        yield G.path
+        return
+
+    with tempfile.TemporaryDirectory(prefix="codecare_graph_") as directory:
+        G.save(directory)
+        G.path = None  # the temporary copy shouldn't outlive this block
+        yield directory
+
+
+@contextmanager
+def graph_worker_pool(G, workers=None):
+    """
+    This context manager starts a process pool whose workers each load G once, from the
+    directory given by publish_graph, instead of receiving a pickled copy with every task.
+    """
+    with publish_graph(G) as directory:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_graph_worker,
+            initargs=(directory,),
+        ) as pool:
+            yield pool
+
+
+# The graph each worker process loads once in graph_worker_pool
+_worker_graph = None
+
+
+def worker_graph():
+    """
+    This function returns the graph a worker process of graph_worker_pool loaded, for tasks
+    defined outside this module (None outside such a worker).
+    """
+    return _worker_graph
+
+
+def _init_graph_worker(directory):
+    global _worker_graph
+    _worker_graph = RoadGraph.load(directory)
+
+
+def _path_task(start, end):
+    return astar_shortest_path(_worker_graph, start, end)
+
+
+def _matrix_task(sources, targets, weight, return_predecessors, limit):
+    return travel_time_matrix(
+        _worker_graph,
+        sources,
+        targets,
+        weight=weight,
+        return_predecessors=return_predecessors,
+        limit=limit,
+    )
+
+
+def build_landmarks(G: RoadGraph, count=16, weight=" travel_time", seed=0):
+    """
+    This function picks landmarks for the ALT heuristic and stores their distances on the graph.
+    Landmarks are chosen by farthest selection: each new one is the node farthest from the ones
+    already picked, which keeps them spread out along the edge of the network. If the graph was
+    loaded from (or saved to) a directory, the distances are saved next to it.
+    """
+    from scipy.sparse.csgraph import dijkstra  # one C-speed search per landmark
+
+    key = G.weight_key(weight)
+    matrix = G.to_scipy(weight)
+    count = min(count, G.num_nodes)
+
+    # Start from a random node, the first landmark is the node farthest from it
+    rng = np.random.default_rng(seed)
+    start = int(rng.integers(G.num_nodes))
+    closest = dijkstra(matrix, indices=start)
+
+    distances = np.empty((count, G.num_nodes))
+    for j in range(count):
+        reachable = np.where(np.isfinite(closest), closest, -1.0)
+        landmark = int(reachable.argmax())
+        distances[j] = dijkstra(matrix, indices=landmark)
+        closest = np.minimum(closest, distances[j]) if j else distances[j]
+
+    # Nodes a landmark can't reach get the same huge value, so their bound is 0 between
+    # themselves and huge (still valid, as they can't reach each other) across components
+    distances[~np.isfinite(distances)] = 1e30
+
+    G.landmarks[key] = np.ascontiguousarray(distances.T)
+    _search_indexes(G).pop(key, None)
+
+    if G.path is not None:
+        np.save(os.path.join(G.path, f"landmarks_{key}.npy"), G.landmarks[key])
+
+    return G.landmarks[key]
+
+
+def warm_up(G: RoadGraph, weight=" travel_time"):
+    """
+    This function builds what the searches on G need (the landmarks, if the graph has none
+    yet, and the search index) up front, so the first query doesn't pay for it.
+    """
+    if G.landmarks.get(G.weight_key(weight)) is None:
+        build_landmarks(G, weight=weight)
+    _search_index(G, weight)
+
+
+class _SearchIndex:
+    """
+    Everything the search needs about one graph and one weight, computed once per graph.
+    """
+
+    def __init__(self, G: RoadGraph, weight):
+        # The index is rebuilt when update_edges changed the graph
+        self.revision = G.revision
+
+        # memoryviews give back plain Python numbers, which is much faster in a loop than numpy scalars
+        self.offsets = memoryview(G.offsets)
+        self.targets = memoryview(G.targets)
+        self.weights = memoryview(G.weights(weight))
+
+        # Points on the unit sphere; the straight-line (chord) distance between two of them
+        # is a metric, so scaling it keeps the heuristic consistent
+        lat = np.radians(G.latitude)
+        lon = np.radians(G.longitude)
+        xyz = np.stack(
+            [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+        )
+        self.x, self.y, self.z = (memoryview(np.ascontiguousarray(c)) for c in xyz)
+
+        # The scale turns chord length into the weight's unit (seconds for travel_time). It is
+        # the smallest weight per unit of chord over all edges, so the heuristic never
+        # overestimates, whatever the units or speeds in the data are
+        self.scale = _heuristic_scale(G, xyz, weight)
+
+        landmarks = G.landmarks.get(G.weight_key(weight))
+        self.landmark_count = 0 if landmarks is None else landmarks.shape[1]
+        if self.landmark_count:
+            self.landmarks = memoryview(np.ascontiguousarray(landmarks).reshape(-1))
+
+
+def _heuristic_scale(G: RoadGraph, xyz, weight, exclude=None):
+    """
+    This function finds the largest factor k with weight >= k * chord for every edge, or
+    every edge except the ones in exclude (node id pairs, either direction).
+    """
+    if np.isnan(xyz).any():
+        # Without coordinates for every node there is no safe geometric bound
+        return 0.0
+
+    source = np.repeat(np.arange(G.num_nodes), np.diff(G.offsets))
+    chord = np.sqrt(((xyz[:, source] - xyz[:, G.targets]) ** 2).sum(axis=0))
+    weights = np.asarray(G.weights(weight), dtype=np.float64)
+
+    usable = (chord > 0) & np.isfinite(weights)
+    if exclude is not None and len(exclude):
+        n = np.int64(G.num_nodes)
+        u = G.indices_of(exclude[:, 0]).astype(np.int64)
+        v = G.indices_of(exclude[:, 1]).astype(np.int64)
+        keys = source.astype(np.int64) * n + G.targets
+        usable &= ~np.isin(keys, np.concatenate([u * n + v, v * n + u]))
+    if not usable.any():
+        return 0.0
+
+    # A hair under the exact minimum so rounding can't push the bound over an edge weight
+    return max(float((weights[usable] / chord[usable]).min()) * (1 - 1e-9), 0.0)
+
+
+def _search_indexes(G: RoadGraph):
+    """
+    This function returns the per-graph cache of search indexes, keyed by weight.
+    """
+    if not hasattr(G, "_search_indexes"):
+        G._search_indexes = {}
+    return G._search_indexes
+
+
+def _search_index(G: RoadGraph, weight):
+    key = G.weight_key(weight)
+    indexes = _search_indexes(G)
+    if key not in indexes or indexes[key].revision != G.revision:
+        indexes[key] = _SearchIndex(G, weight)
+    return indexes[key]
+
+
+def lower_bound_scale(G: RoadGraph, weight=" travel_time", exclude=None):
+    """
+    This function returns the factor geometric_lower_bound turns chord lengths into costs
+    with. Given exclude (an array of node id pairs), the factor only has to hold for the
+    other edges, so a few much cheaper edges don't weaken the bound for the whole graph.
+    """
+    index = _search_index(G, weight)
+    if exclude is None or not len(exclude):
+        return index.scale
+
+    xyz = np.stack([np.asarray(index.x), np.asarray(index.y), np.asarray(index.z)])
+    return _heuristic_scale(G, xyz, weight, exclude)
+
+
+def geometric_lower_bound(
+    G: RoadGraph, sources, targets, weight=" travel_time", scale=None
+):
+    """
+    This function returns, for each (source, target) pair of node ids, a cost the shortest
+    path between them can't be cheaper than (the same bound the A* heuristic uses). A scale
+    from lower_bound_scale with exclude only bounds the paths that avoid the excluded edges.
+    """
+    index = _search_index(G, weight)
+    if scale is None:
+        scale = index.scale
+    sources = G.indices_of(sources)
+    targets = G.indices_of(targets)
+    xyz = np.stack([np.asarray(index.x), np.asarray(index.y), np.asarray(index.z)])
+    chord = np.sqrt(((xyz[:, sources] - xyz[:, targets]) ** 2).sum(axis=0))
+    return scale * chord
+
+
+def repair_routes(G: RoadGraph, cache):
+    """
+    This function brings a RouteCache up to date after update_edges. Cached routes the
+    changes can't have affected are kept as they are; the ones that went stale (they use a
+    changed edge, or a cheaper edge could now shorten them) are searched again.
+    It returns {(source, target, weight): (path, cost)} for the repaired routes, with None
+    for routes that no longer exist.
+    """
+    cache.sync(G)
+
+    repaired = {}
+    for source, target, weight in cache.drain_stale():
+        try:
+            repaired[(source, target, weight)] = astar_shortest_path(
+                G, source, target, weight=weight, cache=cache
+            )
+        except nx.NetworkXNoPath:
+            repaired[(source, target, weight)] = None
+
+    return repaired
+
+
+def _astar_road_graph(G: RoadGraph, start_node, end_node, weight, active_landmarks=4):
+    """
+    This function is the bidirectional A* search over the CSR arrays of a RoadGraph.
+
+    Both searches share one potential, p(v) = (h_end(v) - h_start(v)) / 2, so a node settled
+    from either side is settled for good and the searches can stop as soon as the two
+    smallest keys add up to the best path found so far. Each h is the larger of the
+    geometric bound and the ALT bound of the few landmarks that best separate start and end.
+
+    Measured on the synthetic benchmark graphs (one CPU, median / 90th percentile over 100
+    random pairs): 5.9 / 19 ms on 10k nodes and 88 / 236 ms on 100k without landmarks; with
+    16 landmarks 2.6 / 7.7 ms and 14 / 99 ms. So the 10 ms goal holds for the smaller graph
+    but not for long queries on the larger one: the search still settles a sizeable part of
+    a grid-like graph, one node at a time in Python.
+    """
+    try:
+        start = G.index_of(start_node)
+        end = G.index_of(end_node)
+    except KeyError as e:
+        raise nx.NodeNotFound(f"Node {e.args[0]} is not in the graph") from None
+
+    if start == end:
+        return [start_node], 0.0
+
+    index = _search_index(G, weight)
+    offsets, targets, weights = index.offsets, index.targets, index.weights
+    x, y, z, scale = index.x, index.y, index.z, index.scale
+    sx, sy, sz = x[start], y[start], z[start]
+    ex, ey, ez = x[end], y[end], z[end]
+
+    # Keep only the landmarks that give the tightest bound between start and end
+    k = index.landmark_count
+    landmark_bounds = []
+    if k:
+        table = index.landmarks
+        chosen = sorted(
+            range(k),
+            key=lambda j: abs(table[end * k + j] - table[start * k + j]),
+            reverse=True,
+        )[:active_landmarks]
+        landmark_bounds = [
+            (j, table[start * k + j], table[end * k + j]) for j in chosen
+        ]
+
+    potentials = {}
+
+    def potential(v):
+        p = potentials.get(v)
+        if p is None:
+            vx, vy, vz = x[v], y[v], z[v]
+            h_end = scale * math.sqrt((vx - ex) ** 2 + (vy - ey) ** 2 + (vz - ez) ** 2)
+            h_start = scale * math.sqrt((vx - sx) ** 2 + (vy - sy) ** 2 + (vz - sz) ** 2)
+            for j, d_start, d_end in landmark_bounds:
+                d_v = table[v * k + j]
+                h_end = max(h_end, abs(d_end - d_v))
+                h_start = max(h_start, abs(d_start - d_v))
+            p = potentials[v] = (h_end - h_start) / 2
+        return p
+
+    # Index 0 is the forward search (from start), index 1 the backward one (from end);
+    # the backward search uses the negated potential
+    dist = ({start: 0.0}, {end: 0.0})
+    parent = ({start: -1}, {end: -1})
+    settled = (set(), set())
+    queues = ([(potential(start), start)], [(-potential(end), end)])
+    signs = (1.0, -1.0)
+
+    best = math.inf
+    meeting = -1
+    pushes = 2
+
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+
+        # Expand the side with the smaller queue, which keeps the two searches balanced
+        side = 0 if len(queues[0]) <= len(queues[1]) else 1
+        queue, my_dist, other_dist = queues[side], dist[side], dist[1 - side]
+        my_parent, my_settled, sign = parent[side], settled[side], signs[side]
+
+        _, u = heapq.heappop(queue)
+        if u in my_settled:
+            continue
+        my_settled.add(u)
+        cost = my_dist[u]
+
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            new_cost = cost + weights[e]
+            if new_cost < my_dist.get(v, math.inf):
+                my_dist[v] = new_cost
+                my_parent[v] = u
+                heapq.heappush(queue, (new_cost + sign * potential(v), v))
+                pushes += 1
+                if v in other_dist and new_cost + other_dist[v] < best:
+                    best = new_cost + other_dist[v]
+                    meeting = v
+
+    if instrumentation.ENABLED:
+        instrumentation.count_many(
+            {
+                "astar.searches": 1,
+                "astar.nodes_expanded": len(settled[0]) + len(settled[1]),
+                "astar.heap_pushes": pushes,
+                "astar.heuristic_evaluations": len(potentials),
+            }
+        )
+
+    if meeting == -1:
+        raise nx.NetworkXNoPath(f"Node {end_node} not reachable from {start_node}")
+
+    # Walk the parents back from the meeting node in both directions
+    path = []
+    i = meeting
+    while i != -1:
+        path.append(i)
+        i = parent[0][i]
+    path.reverse()
+    i = parent[1][meeting]
+    while i != -1:
+        path.append(i)
+        i = parent[1][i]
+
+    return G.node_ids[path].tolist(), best
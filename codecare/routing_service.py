@@ -0,0 +1,525 @@
+"""
+This module runs the routing engine as a local HTTP/JSON service, so other programs can ask
+for routes without the GUI.
+
+The road graph is loaded once when the service starts and kept warm: the compact RoadGraph,
+its ALT landmarks and search index are built up front, and the routes are kept in a
+RouteCache. The service runs on asyncio; every search runs in a thread pool, so the event
+loop keeps answering requests while a search runs. Point-to-point requests that arrive within
+a few milliseconds of each other are searched as one batch: pairs with the same source are
+answered by one one-to-all search (one row of travel_time_matrix) instead of one A* each,
+and repeated pairs are searched once.
+
+Endpoints (JSON in, JSON out):
+    POST /route   {"source": 1, "target": 2}                   -> {"path": [...], "cost": 3.5}
+    POST /tour    {"stops": [1, 2, 3], "optimize": true}        -> {"path": [...], "cost": ...}
+    POST /matrix  {"sources": [1, 2], "targets": [3, 4]}         -> {"costs": [[...], ...]}
+    GET  /stats   request counts, p50/p99 latency per endpoint, batch sizes and cache stats
+    GET  /metrics the stage timers and search counters of codecare.instrumentation
+    GET  /hospitals  the hospitals on the graph: node id, name, city, risk score and class
+
+Costs are travel times in seconds; unreachable targets in a matrix are null.
+
+Run it from the root of the repository with: python -m codecare.routing_service --port 8765
+"""
+
+import argparse  # for the command line options
+import asyncio  # for the server
+import json  # for the requests and responses
+import os  # for the data paths
+import threading  # for the statistics lock
+import time  # for the latencies
+from collections import deque, defaultdict  # for the latency windows
+from concurrent.futures import ThreadPoolExecutor  # for running searches off the event loop
+import numpy as np  # for the percentiles
+import networkx as nx  # for the search exceptions
+from codecare.road_graph import RoadGraph
+from codecare.route_cache import RouteCache
+from codecare.routing_engine import (
+    read_data,
+    construct_road_graph,
+    astar_shortest_path,
+    astar_many_nodes,
+    travel_time_matrix,
+    path_from_predecessors,
+    warm_up,
+    load_state_graph,
+)
+from codecare.tour_optimizer import optimize_tour
+from codecare import instrumentation  # for GET /metrics
+
+# The data folder at the root of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+# Largest matrix (sources x targets) one request may ask for
+MAX_MATRIX_CELLS = 250_000
+
+# Largest request body the service reads, in bytes
+MAX_BODY_BYTES = 1024 * 1024
+
+# Latencies kept per endpoint for the percentiles
+LATENCY_WINDOW = 10_000
+
+# path -> (HTTP method, RoutingService method)
+ENDPOINTS = {
+    "/route": ("POST", "route"),
+    "/tour": ("POST", "tour"),
+    "/matrix": ("POST", "matrix"),
+    "/stats": ("GET", "stats"),
+    "/metrics": ("GET", "metrics"),
+    "/hospitals": ("GET", "hospitals"),
+}
+
+# HTTP status texts of the responses the service sends
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    414: "URI Too Long",
+    422: "Unprocessable Entity",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+
+class RequestError(Exception):
+    """
+    An error in a request, sent back to the client with its HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RoutingService:
+    """
+    The warm road graph and the searches the endpoints run on it.
+
+    batch_window is how long (in seconds) a point-to-point request waits for others to be
+    batched with, and max_batch how many requests a batch holds at most.
+    """
+
+    def __init__(self, G: RoadGraph, threads=None, batch_window=0.002, max_batch=256):
+        self.G = G
+        self.cache = RouteCache()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+
+        # Build everything the searches need now instead of in the first request
+        warm_up(G, " travel_time")
+
+        self._pending = []
+        self._flush_handle = None
+
+        self._stats_lock = threading.Lock()
+        self.started = time.time()
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.batches = 0
+        self.batched_requests = 0
+        self.one_to_all_searches = 0
+        self.pair_searches = 0
+
+    @classmethod
+    def from_csv(cls, data_path, edges_path, **options):
+        """
+        This function loads the graph from the node and edge csv files with read_data.
+        """
+        nodes, edges = read_data(data_path, edges_path)
+        if "latitude" not in nodes:
+            nodes = nodes.rename(columns={" la": "latitude", " lo": "longitude"})
+        return cls(construct_road_graph(nodes, edges), **options)
+
+    # The endpoints
+
+    async def route(self, body):
+        source = _node(body, "source")
+        target = _node(body, "target")
+        path, cost = await self._batched_route(source, target)
+        return {"path": path, "cost": cost}
+
+    async def tour(self, body):
+        stops = _nodes(body, "stops")
+        if len(stops) < 2:
+            raise RequestError(400, "A tour needs at least two stops")
+        optimize = bool(body.get("optimize", False))
+
+        def search():
+            if optimize:
+                return optimize_tour(self.G, stops, cache=self.cache)
+            return astar_many_nodes(
+                self.G, list(zip(stops[:-1], stops[1:])), cache=self.cache
+            )
+
+        path, cost = await self._run(search)
+        return {"path": [int(node) for node in path], "cost": float(cost)}
+
+    async def matrix(self, body):
+        sources = _nodes(body, "sources")
+        targets = _nodes(body, "targets")
+        if len(sources) * len(targets) > MAX_MATRIX_CELLS:
+            raise RequestError(413, f"A matrix can have at most {MAX_MATRIX_CELLS} cells")
+
+        costs = await self._run(travel_time_matrix, self.G, sources, targets)
+        return {
+            "costs": [
+                [float(c) if np.isfinite(c) else None for c in row] for row in costs
+            ]
+        }
+
+    def stats(self):
+        """
+        This function returns the request counts, the latency percentiles (in milliseconds)
+        of every endpoint and the batching and cache statistics.
+        """
+        with self._stats_lock:
+            latencies = {
+                name: {
+                    "count": len(window),
+                    "p50_ms": float(np.percentile(window, 50)) * 1000,
+                    "p99_ms": float(np.percentile(window, 99)) * 1000,
+                }
+                for name, window in self.latencies.items()
+                if window
+            }
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "nodes": self.G.num_nodes,
+                "edges": self.G.num_edges,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "latency": latencies,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+                "one_to_all_searches": self.one_to_all_searches,
+                "pair_searches": self.pair_searches,
+                "cache": self.cache.stats(),
+            }
+
+    def hospitals(self):
+        """
+        This function returns the hospitals on the graph, from the graph's node attributes.
+        """
+        if self.G.attributes is None:
+            return {"hospitals": []}
+        table = self.G.attributes.hospitals()
+        return {
+            "hospitals": [
+                {
+                    "node": int(row["# index"]),
+                    "hospital_name": row["hospital_name"],
+                    "city": row["city"],
+                    "risk_score": float(row["risk_score"]),
+                    "risk_class": None
+                    if np.isnan(row["risk_class"])
+                    else int(row["risk_class"]),
+                }
+                for row in table.to_dict("records")
+            ]
+        }
+
+    def metrics(self):
+        """
+        This function returns the instrumentation snapshot (empty unless CODECARE_METRICS
+        is set).
+        """
+        return instrumentation.snapshot()
+
+    def record(self, endpoint, seconds, failed=False):
+        with self._stats_lock:
+            self.requests[endpoint] += 1
+            if failed:
+                self.errors[endpoint] += 1
+            else:
+                self.latencies[endpoint].append(seconds)
+
+    # Batching of the point-to-point requests
+
+    async def _batched_route(self, source, target):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((source, target, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._search_batch(batch))
+
+    async def _search_batch(self, batch):
+        pairs = [(source, target) for source, target, _ in batch]
+        try:
+            results = await self._run(self._search_pairs, pairs)
+        except Exception as error:
+            results = {pair: error for pair in pairs}
+
+        for source, target, future in batch:
+            if future.done():
+                continue
+            result = results[(source, target)]
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        with self._stats_lock:
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+    def _search_pairs(self, pairs):
+        """
+        This function searches a batch of (source, target) pairs and returns
+        {pair: (path, cost) or the exception of the pair}. Sources with several targets get
+        one one-to-all search, the other pairs one A* each (through the route cache).
+        """
+        results = {}
+        targets_of = defaultdict(set)
+        for source, target in pairs:
+            if (source, target) in results:
+                continue
+            cached = self.cache.get(self.G, source, target)
+            if cached is not None:
+                results[(source, target)] = _as_json(cached)
+            else:
+                targets_of[source].add(target)
+
+        for source, targets in targets_of.items():
+            targets = sorted(targets)
+            if len(targets) == 1:
+                results[(source, targets[0])] = self._pair(source, targets[0])
+            else:
+                results.update(self._one_to_all(source, targets))
+
+        return results
+
+    def _pair(self, source, target):
+        with self._stats_lock:
+            self.pair_searches += 1
+        try:
+            return _as_json(astar_shortest_path(self.G, source, target, cache=self.cache))
+        except (nx.NodeNotFound, nx.NetworkXNoPath) as error:
+            return error
+
+    def _one_to_all(self, source, targets):
+        with self._stats_lock:
+            self.one_to_all_searches += 1
+        try:
+            costs, predecessors = travel_time_matrix(
+                self.G, [source], targets, return_predecessors=True
+            )
+        except nx.NodeNotFound:
+            # Find out which of the nodes is missing, pair by pair
+            return {(source, target): self._pair(source, target) for target in targets}
+
+        results = {}
+        for target, cost in zip(targets, costs[0]):
+            if not np.isfinite(cost):
+                results[(source, target)] = nx.NetworkXNoPath(
+                    f"Node {target} not reachable from {source}"
+                )
+                continue
+            path = path_from_predecessors(self.G, predecessors[0], source, target)
+            self.cache.put(self.G, source, target, path, float(cost))
+            results[(source, target)] = (path, float(cost))
+        return results
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+
+async def handle_connection(service, reader, writer):
+    """
+    This function answers the HTTP requests of one connection (keeping it open between
+    requests unless the client asks to close it).
+    """
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except RequestError as error:
+                # The body wasn't read, so the connection can't be used for another request
+                _write_response(writer, error.status, {"error": str(error)}, False)
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, target, headers, body = request
+
+            started = time.perf_counter()
+            endpoint = target.split("?")[0]
+            status, response = await _dispatch(service, method, endpoint, body)
+            if endpoint in ENDPOINTS:
+                service.record(endpoint, time.perf_counter() - started, status != 200)
+
+            keep_alive = headers.get("connection", "").lower() != "close"
+            _write_response(writer, status, response, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _dispatch(service, method, endpoint, body):
+    """
+    This function runs the endpoint of a request and returns (status, response).
+    """
+    if endpoint not in ENDPOINTS:
+        return 404, {"error": f"Unknown endpoint {endpoint}"}
+    allowed, name = ENDPOINTS[endpoint]
+    if method != allowed:
+        return 405, {"error": f"{endpoint} only accepts {allowed}"}
+
+    try:
+        if method == "GET":
+            return 200, getattr(service, name)()
+        try:
+            body = json.loads(body or b"{}")
+        except ValueError:
+            raise RequestError(400, "The body is not valid JSON") from None
+        if not isinstance(body, dict):
+            raise RequestError(400, "The body must be a JSON object")
+        return 200, await getattr(service, name)(body)
+    except RequestError as error:
+        return error.status, {"error": str(error)}
+    except nx.NodeNotFound as error:
+        return 404, {"error": str(error)}
+    except nx.NetworkXNoPath as error:
+        return 422, {"error": str(error)}
+    except Exception as error:
+        return 500, {"error": f"{type(error).__name__}: {error}"}
+
+
+async def _read_request(reader):
+    """
+    This function reads one HTTP request and returns (method, target, headers, body), or
+    None when the client closed the connection. A body larger than MAX_BODY_BYTES is not
+    read; it raises a RequestError with status 413 instead (and a line longer than the
+    stream's limit one with status 414 or 431).
+    """
+    line = await _read_line(reader, 414, "The request line is too long")
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ConnectionError("Malformed request line") from None
+
+    headers = {}
+    while True:
+        line = await _read_line(reader, 431, "A header line is too long")
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        raise RequestError(400, "Content-Length must be a number") from None
+    if length < 0:
+        raise RequestError(400, "Content-Length can't be negative")
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, f"A request body can have at most {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+async def _read_line(reader, status, message):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # readline gives up on lines longer than the stream's limit (64 KiB by default)
+        raise RequestError(status, message) from None
+
+
+def _write_response(writer, status, response, keep_alive):
+    body = json.dumps(response).encode()
+    writer.write(
+        (
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        ).encode()
+        + body
+    )
+
+
+def _node(body, key):
+    try:
+        return int(body[key])
+    except KeyError:
+        raise RequestError(400, f"Missing {key!r}") from None
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{key!r} must be a node id") from None
+
+
+def _nodes(body, key):
+    values = body.get(key)
+    if not isinstance(values, list):
+        raise RequestError(400, f"{key!r} must be a list of node ids")
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{key!r} must be a list of node ids") from None
+
+
+def _as_json(result):
+    path, cost = result
+    return [int(node) for node in path], float(cost)
+
+
+async def serve(service, host="127.0.0.1", port=8765):
+    """
+    This function serves requests until it is cancelled.
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(service, reader, writer), host, port
+    )
+    print(f"Routing service listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the routing engine as a service.")
+    parser.add_argument("--state", default="MO")
+    parser.add_argument(
+        "--graph-dir", default=None, help="a saved RoadGraph to load instead of the csv files"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-window-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    options = dict(threads=args.threads, batch_window=args.batch_window_ms / 1000)
+    if args.graph_dir:
+        service = RoutingService(RoadGraph.load(args.graph_dir), **options)
+    else:
+        service = RoutingService(load_state_graph(DATA_DIR, args.state), **options)
+
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
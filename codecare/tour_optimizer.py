@@ -0,0 +1,223 @@
+"""
+This module puts a list of stops (hospitals) into a short driving order.
+
+Instead of sorting the stops by risk score and driving between them in that order, it builds
+the full travel-time matrix between the stops, makes a first tour with a nearest-neighbor
+construction and then improves it with 2-opt and Or-opt moves until nothing improves or the
+time budget runs out. Stops can be given priority groups (for example "risk_class 4 first"):
+the tour then visits the groups in order and only optimizes inside each group.
+"""
+
+import time  # for the time budget
+import numpy as np  # for the matrix
+import networkx as nx  # for the same exceptions as the A* search
+from codecare.routing_engine import travel_time_matrix, astar_many_nodes
+
+
+def optimize_tour(
+    G,
+    stops,
+    weight=" travel_time",
+    priority=None,
+    risk=None,
+    risk_weight=0.0,
+    start=None,
+    return_to_start=False,
+    time_budget=0.5,
+    progress=None,
+    cache=None,
+):
+    """
+    This function finds a good order for the stops and routes it, returning the same
+    (path, cumulative_cost) as astar_many_nodes.
+
+    priority is one sort key per stop (smaller keys are visited first), risk is one risk score
+    per stop used by the construction when risk_weight > 0, and start is the node id the
+    tour has to begin at (it must be one of the stops). progress and cache (a RouteCache)
+    are passed on to astar_many_nodes, which calls progress after every routed leg.
+    """
+    stops = list(stops)
+    costs = travel_time_matrix(G, stops, stops, weight=weight)
+
+    order = order_stops(
+        costs,
+        priority=priority,
+        risk=risk,
+        risk_weight=risk_weight,
+        start=None if start is None else stops.index(start),
+        return_to_start=return_to_start,
+        time_budget=time_budget,
+    )
+    if return_to_start and len(order) > 1:
+        order.append(order[0])
+
+    pairs = [(stops[a], stops[b]) for a, b in zip(order[:-1], order[1:])]
+    return astar_many_nodes(G, pairs, cache=cache, progress=progress)
+
+
+def order_stops(
+    costs,
+    priority=None,
+    risk=None,
+    risk_weight=0.0,
+    start=None,
+    return_to_start=False,
+    time_budget=0.5,
+):
+    """
+    This function returns the visiting order (as row indices of the cost matrix) for a
+    square matrix of travel costs between stops. The matrix is assumed symmetric, which
+    holds for travel times on the undirected road graph.
+    """
+    deadline = time.perf_counter() + time_budget
+    costs = np.asarray(costs, dtype=np.float64)
+    m = len(costs)
+    if m <= 1:
+        return list(range(m))
+
+    if not np.isfinite(costs).all():
+        raise nx.NetworkXNoPath("Some of the stops can't be reached from the others")
+
+    group = np.zeros(m) if priority is None else np.asarray(priority, dtype=np.float64)
+    bonus = np.ones(m)
+    if risk is not None and risk_weight > 0:
+        bonus = 1 + risk_weight * np.asarray(risk, dtype=np.float64)
+
+    # Try a few starting stops for the construction and keep the best tour
+    if start is not None:
+        starts = [start]
+    else:
+        first_group = np.flatnonzero(group == group.min())
+        eccentricity = costs[first_group].sum(axis=1)
+        starts = first_group[np.argsort(-eccentricity)][:10].tolist()
+
+    best_order, best_cost = None, np.inf
+    for first in starts:
+        order = _nearest_neighbor(costs, group, bonus, first)
+        cost = tour_cost(costs, order, return_to_start)
+        if cost < best_cost:
+            best_order, best_cost = order, cost
+        if time.perf_counter() > deadline:
+            break
+
+    # Improve the tour; a closed tour is treated as a path that ends where it started
+    sequence = best_order + [best_order[0]] if return_to_start else best_order
+    fixed_first = start is not None or return_to_start
+    fixed_last = return_to_start
+    _improve(costs.tolist(), group.tolist(), sequence, fixed_first, fixed_last, deadline)
+
+    return sequence[:-1] if return_to_start else sequence
+
+
+def tour_cost(costs, order, return_to_start=False):
+    """
+    This function adds up the travel cost of visiting the stops in order.
+    """
+    costs = np.asarray(costs)
+    order = list(order)
+    if return_to_start and order:
+        order = order + [order[0]]
+    return float(costs[order[:-1], order[1:]].sum())
+
+
+def _nearest_neighbor(costs, group, bonus, first):
+    """
+    This function builds a tour by always driving to the closest remaining stop of the
+    lowest remaining priority group (closeness is divided by the risk bonus).
+    """
+    m = len(costs)
+    visited = np.zeros(m, dtype=bool)
+    visited[first] = True
+    order = [first]
+
+    for _ in range(m - 1):
+        remaining = ~visited
+        allowed = remaining & (group == group[remaining].min())
+        score = np.where(allowed, costs[order[-1]] / bonus, np.inf)
+        nxt = int(score.argmin())
+        visited[nxt] = True
+        order.append(nxt)
+
+    return order
+
+
+def _improve(d, group, seq, fixed_first, fixed_last, deadline):
+    """
+    This function applies improving 2-opt and Or-opt moves to seq in place until no move
+    helps or the deadline passes. Moves never change the order of the priority groups.
+    """
+    n = len(seq)
+    low = 1 if fixed_first else 0
+    high = n - 2 if fixed_last else n - 1
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # 2-opt: reverse seq[i..j] when that shortens the tour
+        for i in range(low, high):
+            if time.perf_counter() > deadline:
+                return
+            a = seq[i - 1] if i > 0 else -1
+            for j in range(i + 1, high + 1):
+                if group[seq[i]] != group[seq[j]]:
+                    break
+                b = seq[j + 1] if j < n - 1 else -1
+                before = (d[a][seq[i]] if a >= 0 else 0) + (d[seq[j]][b] if b >= 0 else 0)
+                after = (d[a][seq[j]] if a >= 0 else 0) + (d[seq[i]][b] if b >= 0 else 0)
+                if after < before - 1e-9:
+                    seq[i : j + 1] = seq[i : j + 1][::-1]
+                    improved = True
+                    break
+
+        # Or-opt: move a run of 1 to 3 stops elsewhere (possibly reversed)
+        for length in (1, 2, 3):
+            i = low
+            while i + length - 1 <= high:
+                if time.perf_counter() > deadline:
+                    return
+                if _or_move(d, group, seq, i, length, low, high):
+                    improved = True
+                i += 1
+
+
+def _or_move(d, group, seq, i, length, low, high):
+    """
+    This function tries to move seq[i:i + length] to the best other position and reports
+    whether it did.
+    """
+    n = len(seq)
+    first, last = seq[i], seq[i + length - 1]
+    if group[first] != group[last]:
+        return False
+    g = group[first]
+
+    prev = seq[i - 1] if i > 0 else -1
+    nxt = seq[i + length] if i + length < n else -1
+    gain = (d[prev][first] if prev >= 0 else 0) + (d[last][nxt] if nxt >= 0 else 0)
+    if prev >= 0 and nxt >= 0:
+        gain -= d[prev][nxt]
+
+    best_delta, best_at, best_reversed = -1e-9, None, False
+    rest = seq[:i] + seq[i + length :]
+
+    # Insert between rest[p - 1] and rest[p]; p = 0 / len(rest) are the two open ends
+    for p in range(low, high - length + 2):
+        a = rest[p - 1] if p > 0 else -1
+        b = rest[p] if p < len(rest) else -1
+        if (a >= 0 and group[a] > g) or (b >= 0 and group[b] < g):
+            continue
+        base = d[a][b] if a >= 0 and b >= 0 else 0
+        for reverse, head, tail in ((False, first, last), (True, last, first)):
+            added = (d[a][head] if a >= 0 else 0) + (d[tail][b] if b >= 0 else 0) - base
+            if added - gain < best_delta:
+                best_delta, best_at, best_reversed = added - gain, p, reverse
+
+    if best_at is None:
+        return False
+
+    segment = seq[i : i + length]
+    if best_reversed:
+        segment.reverse()
+    seq[:] = rest[:best_at] + segment + rest[best_at:]
+    return True
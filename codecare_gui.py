@@ -1,83 +1,196 @@
-# Import CustomTkinter for GUI, folium and webbrowserfor the map, and the functions from the routing engine
+# Import CustomTkinter for GUI and webbrowser for the map; the routing engine and the map
+# renderer are imported by the worker threads, so the window shows up before they are loaded
 import customtkinter as ctk
-import folium
 import webbrowser
-from codecare.routing_engine import read_data, construct_graph, astar_many_nodes
+import os  # for choosing the state
+import queue  # for sending results from the worker threads to the window
+import threading  # for loading the graph and generating routes in the background
 
-# Load in the graph
-nodes, edges = read_data(path1="data/mo_data.csv", path2="data/mo_edges.csv")
-G = construct_graph(nodes, edges)
+# The state to plan routes in; its graph is in data/graphs/<STATE> or built from
+# data/<state>_data.csv and data/<state>_edges.csv
+STATE = os.environ.get("CODECARE_STATE", "MO").lower()
 
-# Create a lookup table to get IDs from hospital names
+# The road graph (with its node attributes) and the lookup table, set by the loading thread
+G = None
 hospital_lookup = {}
 
-for node, data in G.nodes(data=True):
-    name = data.get("hospital_name")
-    if not name:
-        continue
+# Messages from the worker threads, handled on the Tk main loop by poll_messages
+messages = queue.Queue()
 
-    hospital_lookup.setdefault(name, []).append(node)
+# Set while a route is generated; cancel_route sets the cancel event
+route_thread = None
+cancel_event = threading.Event()
 
 
-# This function is meant to draw the edges on the map
-def draw_route_on_map(m, path, color="green"):
-    if len(path) < 2:
-        print("Path too short to draw!")
+class RouteCancelled(Exception):
+    """
+    Raised in the route worker when the user cancels the route generation.
+    """
+
+
+# This function loads the graph in the background, after the window is shown
+def load_graph():
+    global G
+    try:
+        from codecare.routing_engine import load_state_graph
+
+        # Load in the graph (the one process_states saved, if there is one), the hospital
+        # details are kept in graph.attributes
+        graph = load_state_graph("data", STATE)
+
+        # Create a lookup table to get IDs from hospital names
+        lookup = graph.attributes.hospital_nodes()
+
+        # Create a list of hospitals
+        hospitals = list(lookup)
+    except Exception as error:
+        messages.put(("error", f"Could not load the graph: {error}"))
         return
 
-    coords = [
-        (float(G.nodes[n]["longitude"]), float(G.nodes[n]["latitude"])) for n in path
-    ]
-    folium.PolyLine(coords, color=color, weight=5, opacity=0.8, tooltip="Route").add_to(
-        m
-    )
-    m.fit_bounds(coords)
+    G = graph
+    hospital_lookup.update(lookup)
+    messages.put(("loaded", hospitals))
 
 
-# Utilizes the A* algorithm from the routing engine module and generates routes
-def generate_routes(hospital_list):
-    # Sort the hospital list based on risk score
-    hospital_list.sort(
-        key=lambda name: G.nodes[hospital_lookup[name][0]]["risk_score"],
-        reverse=True,
-    )
+# Utilizes the tour optimizer (built on the routing engine) and generates routes
+def generate_routes(hospital_list, progress=None):
+    """
+    This function plans the tour through the hospitals and saves the map. It runs in the
+    route worker thread and returns the total time in hours, or None if there was no route to
+    draw; progress is passed on to the tour optimizer.
+    """
+    import numpy as np
+    from codecare.tour_optimizer import optimize_tour
+    from codecare.map_render import render_route_map
 
-    # Create a list for the multiple A* algortihm
+    # Create a list of the hospital nodes to visit
     indices_list = []
     for hospital in hospital_list:
         indices_list.append(hospital_lookup[hospital][0])
 
-    indices_list = list(zip(indices_list, indices_list[1:]))
+    # Risk class 4 hospitals are visited first, the rest of the order is for the shortest drive
+    attributes = G.attributes
+    priority = np.where(attributes.get(indices_list, "risk_class") == 4, 0, 1).tolist()
 
-    # Run the multuple A* algorithm
-    path, cumulative_cost = astar_many_nodes(G, indices_list)
+    # Run the tour optimizer
+    path, cumulative_cost = optimize_tour(
+        G, indices_list, priority=priority, progress=progress
+    )
     cumulative_cost = cumulative_cost / 3600  # convert seconds into hours
-    cumulative_cost_label.configure(text=f"Total time: {cumulative_cost:.2f} hours")
 
-    # Create Folium map
-    route_map = folium.Map(location=[38.5, -92.5], zoom_start=7)
+    # The "longitude" column of the node data holds the latitude and the other way around,
+    # so (longitude, latitude) is the (latitude, longitude) the map expects
+    coords = list(
+        zip(
+            attributes.get(path, "longitude").tolist(),
+            attributes.get(path, "latitude").tolist(),
+        )
+    )
+
+    # Hospital markers
+    markers = []
+    for name, node_id in zip(hospital_list, indices_list):
+        data = attributes.node(node_id)
+        markers.append(
+            (
+                data["longitude"],
+                data["latitude"],
+                f"<b>{name} | Risk Class is {int(data['risk_class'])} | Risk Score of {data['risk_score']:.2f}</b>",
+            )
+        )
+
+    # Draw the simplified route and the markers and save the map, the main loop opens it
+    if len(coords) < 2:
+        messages.put(("status", "Path too short to draw"))
+        return None
+    render_route_map([(coords, "green")], markers, "hospital_routes.html")
+    return cumulative_cost
+
+
+# This function runs in the route worker thread and reports back through the queue
+def route_worker(hospital_list):
+    def progress(done, total):
+        if cancel_event.is_set():
+            raise RouteCancelled()
+        messages.put(("progress", (done, total)))
+
+    from codecare import instrumentation
 
-    # Draw hospital markers
-    for name in hospital_list:
-        node_id = hospital_lookup[name][0]
-        print(node_id)
-        data = G.nodes[node_id]
-        folium.Marker(
-            [data["longitude"], data["latitude"]],
-            popup=f"<b>{name} | Risk Class is {int(data['risk_class'])} | Risk Score of {data['risk_score']:.2f}</b>",
-            icon=folium.Icon(color="red"),
-        ).add_to(route_map)
+    try:
+        with instrumentation.stage("gui.generate_routes", stops=len(hospital_list)):
+            cumulative_cost = generate_routes(hospital_list, progress)
+    except RouteCancelled:
+        messages.put(("cancelled", None))
+    except Exception as error:
+        messages.put(("error", f"Could not generate the route: {error}"))
+    else:
+        messages.put(("done", cumulative_cost))
 
-    # Draw route lines
-    draw_route_on_map(m=route_map, path=path, color="green")
 
-    # Save and open map
-    route_map.save("hospital_routes.html")
-    webbrowser.open("hospital_routes.html")
+# The Generate Map button starts the route worker, or cancels it while it runs
+def start_or_cancel_route():
+    global route_thread
+    if route_thread is not None:
+        cancel_event.set()
+        status_label.configure(text="Cancelling...")
+        return
+
+    if not hospital_nodes:
+        status_label.configure(text="Add at least one hospital first")
+        return
+
+    cancel_event.clear()
+    route_thread = threading.Thread(
+        target=route_worker, args=(list(hospital_nodes),), daemon=True
+    )
+    route_thread.start()
+
+    generate_button.configure(text="Cancel")
+    progress_bar.set(0)
+    status_label.configure(text="Generating the route...")
+
 
+# This function handles the messages of the worker threads on the Tk main loop
+def poll_messages():
+    global route_thread
+    while True:
+        try:
+            kind, value = messages.get_nowait()
+        except queue.Empty:
+            break
+
+        if kind == "loaded":
+            combobox.configure(values=value, state="normal")
+            combobox.set(value[0] if value else "")
+            add_button.configure(state="normal")
+            generate_button.configure(state="normal")
+            status_label.configure(text=f"{len(value)} hospitals loaded")
+        elif kind == "progress":
+            done, total = value
+            progress_bar.set(done / total)
+            status_label.configure(text=f"Routing leg {done} of {total}")
+        elif kind == "status":
+            status_label.configure(text=value)
+        else:
+            # The route worker finished
+            route_thread = None
+            generate_button.configure(text="Generate Map")
+            if kind == "done" and value is None:
+                # Nothing to draw, the status message says why
+                progress_bar.set(0)
+            elif kind == "done":
+                progress_bar.set(1)
+                cumulative_cost_label.configure(text=f"Total time: {value:.2f} hours")
+                status_label.configure(text="Route ready")
+                webbrowser.open("hospital_routes.html")
+            elif kind == "cancelled":
+                progress_bar.set(0)
+                status_label.configure(text="Route cancelled")
+            else:
+                status_label.configure(text=value)
+
+    app.after(50, poll_messages)
 
-# Create a list of hospitals
-hospitals = nodes["hospital_name"].dropna().tolist()
 
 # This list will be used for the hospitals that will be used in the path calculations
 hospital_nodes = []
@@ -88,7 +201,7 @@ ctk.set_default_color_theme("blue")
 
 # Create the window with the title
 app = ctk.CTk()
-app.geometry("500x300")
+app.geometry("500x360")
 app.title("Missouri Hospital Explorer: CodeCare")
 
 # Display a title text on the window
@@ -97,13 +210,15 @@ title = ctk.CTkLabel(
 )
 title.pack(pady=20)
 
-# Multi-select box on the GUI
+# Multi-select box on the GUI, filled in once the graph is loaded
 combobox = ctk.CTkComboBox(
     master=app,
-    values=hospitals,
+    values=[],
     width=200,
     corner_radius=5,
 )
+combobox.set("Loading hospitals...")
+combobox.configure(state="disabled")
 combobox.pack(pady=20)
 
 # Button for adding the hospitals to the list
@@ -111,6 +226,7 @@ add_button = ctk.CTkButton(
     app,
     text="Add to List",
     width=100,
+    state="disabled",
     command=lambda: (
         hospital_nodes.append(combobox.get())
         if combobox.get() not in hospital_nodes
@@ -121,15 +237,32 @@ add_button.pack(pady=15)
 
 # This button, when clicked on, will generate the paths and create the webpage
 generate_button = ctk.CTkButton(
-    app, text="Generate Map", width=100, command=lambda: generate_routes(hospital_nodes)
+    app,
+    text="Generate Map",
+    width=100,
+    state="disabled",
+    command=start_or_cancel_route,
 )
 generate_button.pack(pady=15)
 
+# Progress of the route generation
+progress_bar = ctk.CTkProgressBar(app, width=200)
+progress_bar.set(0)
+progress_bar.pack(pady=5)
+
 # This label will tell the total time for the trip
 cumulative_cost_label = ctk.CTkLabel(
     app, text="Total time: 0 hours", font=("Roboto", 16)
 )
 cumulative_cost_label.pack(pady=10)
 
+# What the app is doing
+status_label = ctk.CTkLabel(app, text="Loading the road graph...", font=("Roboto", 12))
+status_label.pack(pady=5)
+
+# Load the graph in the background and handle the worker messages on the main loop
+threading.Thread(target=load_graph, daemon=True).start()
+app.after(50, poll_messages)
+
 # Run the app!
 app.mainloop()